@@ -6,6 +6,7 @@ Streaming responses, AI router visualizer, file upload panel.
 import json
 import re
 import time
+import uuid
 from datetime import datetime
 from pathlib import Path
 
@@ -238,6 +239,7 @@ for k, v in [
     ("show_sql", False),
     ("show_routing", True),
     ("uploads", []),
+    ("conversation_id", uuid.uuid4().hex),   # lets the backend reuse this chat's result sets
 ]:
     if k not in st.session_state:
         st.session_state[k] = v
@@ -322,16 +324,31 @@ with st.sidebar:
     )
     if uploaded_file and uploaded_file.name != st.session_state.get("_last_uploaded"):
         st.session_state["_last_uploaded"] = uploaded_file.name
-        with st.spinner(f"Indexing {uploaded_file.name}..."):
+        with st.spinner(f"Uploading {uploaded_file.name}..."):
             try:
                 r = requests.post(
                     f"{BACKEND}/upload",
                     files={"file": (uploaded_file.name, uploaded_file.read(), uploaded_file.type)},
                     timeout=30,
                 )
-                if r.status_code == 200:
-                    st.success(f"✓ {uploaded_file.name} — ready to query")
-                    refresh_uploads()
+                if r.status_code in (200, 202):
+                    job = r.json()
+                    status = st.empty()
+                    # Parsing runs as a background job — follow its progress events
+                    with requests.get(f"{BACKEND}{job['events_url']}", stream=True, timeout=300) as resp:
+                        for event in sseclient.SSEClient(resp).events():
+                            if not event.data:
+                                continue
+                            job = json.loads(event.data)
+                            status.caption(f"⏳ {uploaded_file.name} — {job['state']}...")
+                    status.empty()
+                    if job.get("state") == "done":
+                        st.success(f"✓ {uploaded_file.name} — ready to query")
+                        refresh_uploads()
+                    elif job.get("state") == "cancelled":
+                        st.warning(f"{uploaded_file.name} was deleted before indexing finished")
+                    else:
+                        st.error(f"Indexing failed: {job.get('error') or 'unknown error'}")
                 else:
                     st.error(r.json().get("detail", "Upload failed"))
             except Exception as e:
@@ -431,6 +448,7 @@ with st.sidebar:
     with col1:
         if st.button("🗑 Clear chat", use_container_width=True):
             st.session_state.messages = []
+            st.session_state.conversation_id = uuid.uuid4().hex
             st.rerun()
     with col2:
         if st.button("🔄 Reload", use_container_width=True):
@@ -572,6 +590,7 @@ def stream_response(question: str):
 
     routing_data = {}
     sql_data = None
+    previews = {}     # plan part label (None for a single query) → {"columns", "rows", "fetched"}
     accumulated = ""
     metadata = {}
 
@@ -581,7 +600,8 @@ def stream_response(question: str):
     try:
         with requests.post(
             f"{BACKEND}/query",
-            json={"question": question, "history": history},
+            json={"question": question, "history": history,
+                  "conversation_id": st.session_state.conversation_id},
             stream=True,
             timeout=120,
         ) as response:
@@ -609,9 +629,26 @@ def stream_response(question: str):
                             unsafe_allow_html=True,
                         )
 
+                elif evt == "rows":
+                    # Live preview while BigQuery pages arrive; replaced once the answer streams
+                    pv = previews.setdefault(d.get("part"), {"columns": [], "rows": [], "fetched": 0})
+                    pv["columns"] = d.get("columns") or pv["columns"]
+                    pv["rows"] += d.get("rows", [])
+                    pv["fetched"] = d.get("fetched", len(pv["rows"]))
+                    with placeholder.container():
+                        for part, pv in previews.items():
+                            label = f" · {part}" if part else ""
+                            st.caption(f"📥 {pv['fetched']} rows fetched from BigQuery{label}…")
+                            if pv["rows"]:
+                                st.dataframe([dict(zip(pv["columns"], r)) for r in pv["rows"]],
+                                             use_container_width=True, hide_index=True)
+
                 elif evt == "sql":
                     sql_data = d.get("sql")
 
+                elif evt == "upload_sql" and d.get("sql"):
+                    sql_data = "\n\n".join(filter(None, [sql_data, f"-- uploads (local)\n{d['sql']}"]))
+
                 elif d.get("done"):
                     metadata = d.get("metadata", {})
                     break
@@ -0,0 +1,288 @@
+"""
+saasmetrics.ai  |  Benchmarks + load tests
+Run: python bench.py load                      (in-process, simulated latency)
+     python bench.py load --url http://localhost:8000   (against a live backend)
+     python bench.py excel --rows 100000        (Excel parser peak RSS + throughput)
+
+load  — fires N concurrent /query streams while probing /health.
+        In-process mode swaps Gemini + BigQuery for fakes with realistic
+        latency. The fake BigQuery client blocks its thread (like the real
+        one does), so any call that sneaks back onto the event loop shows
+        up immediately as /health latency.
+        Exits non-zero if /health p99 exceeds --health-budget-ms.
+
+excel — generates large workbooks and parses each one in a fresh process
+        with the streaming parser and with the old full-load parser, then
+        reports wall time, rows/s and peak RSS above the import baseline.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import httpx
+
+
+# ════════════════════════════════════════════════════════════════
+# FAKES  (simulated Gemini + BigQuery latency)
+# ════════════════════════════════════════════════════════════════
+class FakeModel:
+    """Async Gemini stand-in. `latency` is seconds per call (or per chunk when streaming)."""
+
+    def __init__(self, text: str, latency: float, chunks: int = 1):
+        self.text = text
+        self.latency = latency
+        self.chunks = chunks
+
+    async def generate_content_async(self, prompt, stream=False):
+        if not stream:
+            await asyncio.sleep(self.latency)
+            return SimpleNamespace(text=self.text)
+        return self._stream()
+
+    async def _stream(self):
+        step = max(1, len(self.text) // self.chunks)
+        for i in range(0, len(self.text), step):
+            await asyncio.sleep(self.latency)
+            yield SimpleNamespace(text=self.text[i:i + step])
+
+
+class FakeBQClient:
+    """Blocking BigQuery stand-in — sleeps on the calling thread like the real client."""
+
+    def __init__(self, latency: float, rows: int = 25):
+        self.latency = latency
+        self.rows = [{"customer_id": f"C{i:03d}", "arr_usd": 1000 * i} for i in range(rows)]
+
+    def query(self, sql, job_config=None, **kwargs):
+        time.sleep(self.latency)
+        if "__TABLES__" in sql:
+            rows = [{"table_id": "customers", "last_modified_time": 1727740800000}]
+        else:
+            rows = list(self.rows)
+        return SimpleNamespace(result=lambda *a, **k: rows)
+
+
+def install_fakes(main, router_s: float, sql_s: float, bq_s: float, answer_s: float,
+                  result_cache: bool = False, backend: str = "fake"):
+    router_json = json.dumps({
+        "sources": ["bigquery"], "needs_sql": True, "sql_intent": "top customers by ARR",
+        "query_type": "single_source", "intent_tag": "revenue", "reasoning": "bench",
+    })
+    answer = "Apex Financial leads on ARR [BigQuery: customers].\nConfidence: HIGH\n" \
+             'METADATA::{"sources_used": ["bigquery"], "confidence": "high"}'
+
+    main.GENAI_OK = True
+    main.BQ_OK = True
+    # "local" runs real SQL against bq_setup.sql in SQLite, with bq_s as the simulated round trip
+    main._bq_client = FakeBQClient(bq_s) if backend == "fake" else main.LocalBQClient(main.BASE_DIR / "bq_setup.sql", bq_s)
+    main._router_model = FakeModel(router_json, router_s)
+    main._answer_model = FakeModel("SELECT name, arr_usd FROM `p.d.customers`", sql_s)
+    if not result_cache:
+        main._bq_result_cache = main.ResultCache(0, 0)
+    main.genai = SimpleNamespace(
+        GenerativeModel=lambda *a, **k: FakeModel(answer, answer_s / 8, chunks=8)
+    )
+
+
+# ════════════════════════════════════════════════════════════════
+# LOAD TEST
+# ════════════════════════════════════════════════════════════════
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def _one_query(client: httpx.AsyncClient, i: int) -> float:
+    t0 = time.perf_counter()
+    async with client.stream("POST", "/query", json={"question": f"top customers by ARR #{i}", "history": []}) as r:
+        async for _ in r.aiter_lines():
+            pass
+    return time.perf_counter() - t0
+
+
+async def _probe_health(client: httpx.AsyncClient, stop: asyncio.Event, out: list[float], every_s: float):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await client.get("/health")
+        out.append((time.perf_counter() - t0) * 1000)
+        await asyncio.sleep(every_s)
+
+
+async def run_load(client: httpx.AsyncClient, concurrency: int, requests: int) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    health_ms: list[float] = []
+    stop = asyncio.Event()
+
+    async def bounded(i):
+        async with sem:
+            return await _one_query(client, i)
+
+    probe = asyncio.create_task(_probe_health(client, stop, health_ms, 0.02))
+    t0 = time.perf_counter()
+    latencies = await asyncio.gather(*(bounded(i) for i in range(requests)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await probe
+    prompt_cache = (await client.get("/health")).json().get("prompt_cache")
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 3),
+        "query_p50_s": round(statistics.median(latencies), 3),
+        "query_max_s": round(max(latencies), 3),
+        "serial_estimate_s": round(sum(latencies), 3),
+        "health_probes": len(health_ms),
+        "health_p50_ms": round(_pct(health_ms, 50), 2),
+        "health_p99_ms": round(_pct(health_ms, 99), 2),
+        "health_max_ms": round(max(health_ms, default=0.0), 2),
+        "prompt_cache": prompt_cache,
+    }
+
+
+def cmd_load(args) -> int:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=300)
+    else:
+        import main
+        install_fakes(main, args.router_s, args.sql_s, args.bq_s, args.answer_s, args.with_cache, args.backend)
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://bench", timeout=300
+        )
+
+    async def _go():
+        async with client:
+            return await run_load(client, args.concurrency, args.requests)
+
+    report = asyncio.run(_go())
+    print(json.dumps(report, indent=2))
+
+    if report["health_p99_ms"] > args.health_budget_ms:
+        print(f"FAIL: /health p99 {report['health_p99_ms']} ms > budget {args.health_budget_ms} ms")
+        return 1
+    print("PASS: /health stayed responsive under load")
+    return 0
+
+
+# ════════════════════════════════════════════════════════════════
+# EXCEL PARSER BENCH
+# ════════════════════════════════════════════════════════════════
+def _make_workbook(path: str, rows: int, cols: int, sheets: int):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    for s in range(sheets):
+        ws = wb.create_sheet(f"Export_{s + 1}")
+        ws.append([f"col_{c}" for c in range(cols)])
+        for r in range(rows):
+            ws.append([f"C{r:06d}", r * 7 % 9973, round(r * 0.37, 2), "Enterprise", "NA"][:cols]
+                      + [f"note {r}-{c}" for c in range(5, cols)])
+    wb.save(path)
+
+
+def _parse_full_mode(content: bytes, label: str) -> str:
+    """The pre-streaming parser, kept here as the comparison baseline."""
+    import openpyxl
+    wb = openpyxl.load_workbook(io.BytesIO(content), data_only=True)
+    parts = [f"=== {label} ==="]
+    for name in wb.sheetnames:
+        rows = [
+            "\t".join(str(v) if v is not None else "" for v in row)
+            for row in wb[name].iter_rows(values_only=True)
+            if any(v is not None for v in row)
+        ]
+        if rows:
+            parts.append(f"--- Sheet: {name} ---\n" + "\n".join(rows[:500]))
+    return "\n\n".join(parts)
+
+
+def _maxrss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _excel_child(mode: str, path: str) -> dict:
+    import main
+    with open(path, "rb") as f:
+        content = f.read()
+    baseline = _maxrss_mb()
+    t0 = time.perf_counter()
+    text = main._parse_excel_bytes(content, "bench") if mode == "streaming" else _parse_full_mode(content, "bench")
+    return {
+        "seconds": round(time.perf_counter() - t0, 3),
+        "peak_rss_mb": round(_maxrss_mb() - baseline, 1),
+        "chars": len(text),
+    }
+
+
+def cmd_excel(args) -> int:
+    ctx = multiprocessing.get_context("spawn")      # fresh process per run → honest peak RSS
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            path = os.path.join(tmp, f"export_{rows}.xlsx")
+            _make_workbook(path, rows, args.cols, args.sheets)
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            modes = ["streaming"] + ([] if args.skip_full else ["full"])
+            for mode in modes:
+                with ctx.Pool(1) as pool:
+                    out = pool.apply(_excel_child, (mode, path))
+                total = rows * args.sheets
+                report.append({
+                    "mode": mode, "rows": total, "file_mb": round(size_mb, 1), **out,
+                    "rows_per_s": round(total / out["seconds"]) if out["seconds"] else None,
+                })
+                print(json.dumps(report[-1]))
+    streaming = [r for r in report if r["mode"] == "streaming"]
+    if len(streaming) > 1 and streaming[-1]["peak_rss_mb"] > max(2 * streaming[0]["peak_rss_mb"], 50):
+        print("FAIL: streaming parser memory grows with workbook size")
+        return 1
+    print("PASS: streaming parser memory is flat across workbook sizes")
+    return 0
+
+
+# ════════════════════════════════════════════════════════════════
+# ENTRY POINT
+# ════════════════════════════════════════════════════════════════
+def main_cli(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="saasmetrics.ai benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("load", help="concurrent /query load test")
+    p.add_argument("--url", help="live backend base URL (default: in-process with fakes)")
+    p.add_argument("--concurrency", type=int, default=48)
+    p.add_argument("--requests", type=int, default=96)
+    p.add_argument("--router-s", type=float, default=0.3)
+    p.add_argument("--sql-s", type=float, default=0.8)
+    p.add_argument("--bq-s", type=float, default=0.5)
+    p.add_argument("--answer-s", type=float, default=1.0)
+    p.add_argument("--health-budget-ms", type=float, default=100.0)
+    p.add_argument("--with-cache", action="store_true", help="leave the BigQuery result cache on (fakes only)")
+    p.add_argument("--backend", choices=["fake", "local"], default="fake",
+                   help="fake: canned rows; local: real SQL on the embedded bq_setup.sql copy")
+    p.set_defaults(fn=cmd_load)
+
+    p = sub.add_parser("excel", help="Excel parser peak RSS + throughput on generated workbooks")
+    p.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000], help="rows per sheet")
+    p.add_argument("--cols", type=int, default=12)
+    p.add_argument("--sheets", type=int, default=1)
+    p.add_argument("--skip-full", action="store_true", help="don't run the full-load baseline")
+    p.set_defaults(fn=cmd_excel)
+
+    args = ap.parse_args(argv)
+    return args.fn(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
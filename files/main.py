@@ -6,39 +6,67 @@ Architecture:
                            generates SQL intent, tags query type.
                            Fast + cheap. Never answers the question.
 
-  Stage 2  Parallel Fetch  BQ dry-run → execute (concurrent with
-                           file source loading). All I/O happens
-                           simultaneously via asyncio.
+  Stage 2  Parallel Fetch  SQL generation speculates during LLM routing.
+                           Every selected source fetched concurrently
+                           with per-source deadlines; a source_done
+                           event streams as each one completes.
 
   Stage 3  Answer Gen      Gemini Pro  — grounded in actual fetched
                            data, cites sources, disambiguates columns,
                            flags conflicts. Streams response tokens.
 
   Upload   GCS-backed      Files stored in GCS (local fallback).
-           index           Parsed + indexed on upload. Re-indexed
+           index           Parsed + chunked into BM25 and local dense
+                           vector (NumPy mmap) indexes on upload;
+                           queries get top-k hybrid passages. Re-indexed
                            from storage on startup. Shared across
                            all demo users (no auth).
 
 Key design decisions:
   - No auth (demo mode — uniform access for all users)
   - No hardcoded values — everything from env vars
-  - Router uses Gemini Flash (fast/cheap) not Pro
-  - SQL is dry-run validated before execution every time
+  - Router uses Gemini Flash (fast/cheap) not Pro; common questions are
+    routed locally by a classifier compiled from the data dictionary
+  - Router decisions cached (LRU + TTL), invalidated on upload changes
+  - Generated SQL is dry-run validated before execution; canonical
+    metrics compile from the data dictionary and skip generation entirely
   - Self-correction: one automated retry on SQL failure
+  - Query results cached by SQL fingerprint until a source table changes
   - Streaming: answer tokens streamed via SSE to frontend
-  - File index is in-memory + GCS-persisted
+  - Event loop never blocks: Gemini via native async, BigQuery on a
+    bounded I/O thread pool
+  - QUERY_BACKEND=local runs the same SQL path on an embedded SQLite copy
+    of bq_setup.sql (offline / CI / benchmarks)
+  - File index is in-memory + GCS-persisted; parsed text is cached by
+    content hash, so restarts and replicas don't re-parse
+  - Bulk ingest downloads on a thread pool and parses on a process pool;
+    /upload returns a job id at once and indexes on a background queue
+  - Spreadsheet / CSV uploads load into typed tables; aggregate questions
+    over them run as local SQLite SQL
 ═══════════════════════════════════════════════════════════════
 """
 
 from __future__ import annotations
 
+import array
 import asyncio
+import functools
+import hashlib
 import json
+import math
+import multiprocessing
 import os
 import re
 import io
+import sys
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import AsyncIterator, List, Optional
+from typing import AsyncIterator, Callable, Iterator, List, Optional
 
 import yaml
 from dotenv import load_dotenv
@@ -50,6 +78,12 @@ from pydantic import BaseModel
 load_dotenv()
 
 # ── Config from env (zero hardcoding) ────────────────────────────────────────
+def _env_flag(name: str, default: bool) -> bool:
+    """Boolean setting: 1 / true / yes / on (any case) are true, anything else false."""
+    value = os.getenv(name)
+    return default if value is None or not value.strip() else value.strip().lower() in ("1", "true", "yes", "on")
+
+
 GEMINI_API_KEY      = os.getenv("GEMINI_API_KEY", "")
 ROUTER_MODEL        = os.getenv("ROUTER_MODEL",  "gemini-1.5-flash")
 ANSWER_MODEL        = os.getenv("ANSWER_MODEL",  "gemini-1.5-pro")
@@ -60,6 +94,62 @@ BACKEND_PORT        = int(os.getenv("BACKEND_PORT", "8000"))
 MAX_UPLOAD_MB       = int(os.getenv("MAX_UPLOAD_MB", "20"))
 HISTORY_WINDOW      = int(os.getenv("HISTORY_WINDOW", "12"))
 ROUTER_HISTORY_WIN  = int(os.getenv("ROUTER_HISTORY_WINDOW", "4"))
+IO_WORKERS          = int(os.getenv("IO_WORKERS", "32"))
+ROUTER_FASTPATH     = _env_flag("ROUTER_FASTPATH", True)
+ROUTER_FASTPATH_MIN_CONF = float(os.getenv("ROUTER_FASTPATH_MIN_CONF", "0.75"))
+METRIC_MIN_SIM      = float(os.getenv("METRIC_MIN_SIM", "0.35"))
+ROUTER_CACHE_SIZE   = int(os.getenv("ROUTER_CACHE_SIZE", "512"))
+ROUTER_CACHE_TTL_S  = float(os.getenv("ROUTER_CACHE_TTL_S", "600"))
+BQ_CACHE_SIZE       = int(os.getenv("BQ_CACHE_SIZE", "256"))
+BQ_CACHE_TTL_S      = float(os.getenv("BQ_CACHE_TTL_S", "3600"))
+BQ_CACHE_DIR        = os.getenv("BQ_CACHE_DIR", "")
+BQ_FRESHNESS_TTL_S  = float(os.getenv("BQ_FRESHNESS_TTL_S", "30"))
+SPECULATIVE_SQL     = _env_flag("SPECULATIVE_SQL", True)
+SPECULATIVE_DRY_RUN = _env_flag("SPECULATIVE_DRY_RUN", False)
+BQ_DEADLINE_S       = float(os.getenv("BQ_DEADLINE_S", "60"))
+BQ_MAX_BYTES_BILLED = int(os.getenv("BQ_MAX_BYTES_BILLED", str(10 << 30)))
+BQ_JOB_TIMEOUT_S    = float(os.getenv("BQ_JOB_TIMEOUT_S", "45"))
+BQ_EXPENSIVE_CONCURRENCY = int(os.getenv("BQ_EXPENSIVE_CONCURRENCY", "2"))
+BQ_ROLLING_DAYS     = int(os.getenv("BQ_ROLLING_DAYS", "365"))
+BQ_SAMPLE_PERCENT   = float(os.getenv("BQ_SAMPLE_PERCENT", "10"))
+BQ_MAX_ROWS         = int(os.getenv("BQ_MAX_ROWS", "500"))
+BQ_PAGE_SIZE        = int(os.getenv("BQ_PAGE_SIZE", "100"))
+BQ_STORAGE_API      = _env_flag("BQ_STORAGE_API", True)
+BQ_PREVIEW_ROWS     = int(os.getenv("BQ_PREVIEW_ROWS", "50"))
+SQL_PLAN_MAX_PARTS  = int(os.getenv("SQL_PLAN_MAX_PARTS", "3"))
+SQL_LOCAL_VALIDATE  = _env_flag("SQL_LOCAL_VALIDATE", True)
+SQL_DRY_RUN_MIN_BYTES = int(os.getenv("SQL_DRY_RUN_MIN_BYTES", str(1 << 30)))
+FOLLOWUP_REUSE      = _env_flag("FOLLOWUP_REUSE", True)
+CONV_RESULTS_MAX    = int(os.getenv("CONV_RESULTS_MAX", "500"))
+CONV_RESULTS_PER_CONV = int(os.getenv("CONV_RESULTS_PER_CONV", "3"))
+CONV_RESULTS_TTL_S  = float(os.getenv("CONV_RESULTS_TTL_S", "1800"))
+UPLOADS_DEADLINE_S  = float(os.getenv("UPLOADS_DEADLINE_S", "10"))
+UPLOAD_TOP_K        = int(os.getenv("UPLOAD_TOP_K", "8"))
+UPLOAD_CHUNK_CHARS  = int(os.getenv("UPLOAD_CHUNK_CHARS", "1500"))
+UPLOAD_VECTOR_DIM   = int(os.getenv("UPLOAD_VECTOR_DIM", "512"))
+UPLOAD_DENSE_WEIGHT = float(os.getenv("UPLOAD_DENSE_WEIGHT", "0.5"))
+PARSE_CACHE_DIR     = os.getenv("PARSE_CACHE_DIR", "")
+INGEST_WORKERS      = int(os.getenv("INGEST_WORKERS") or os.cpu_count() or 1)
+INGEST_DOWNLOAD_WORKERS = int(os.getenv("INGEST_DOWNLOAD_WORKERS", "8"))
+INGEST_PARSE_THREADS = int(os.getenv("INGEST_PARSE_THREADS", "4"))
+UPLOAD_JOB_WORKERS  = int(os.getenv("UPLOAD_JOB_WORKERS", "4"))
+UPLOAD_JOB_HISTORY  = int(os.getenv("UPLOAD_JOB_HISTORY", "200"))
+EXCEL_MAX_ROWS      = int(os.getenv("EXCEL_MAX_ROWS", "500"))
+PDF_MAX_PAGES       = int(os.getenv("PDF_MAX_PAGES", "60"))
+PDF_PAGES_PER_TASK  = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+UPLOAD_TABLE_MAX_ROWS = int(os.getenv("UPLOAD_TABLE_MAX_ROWS", "100000"))
+UPLOAD_SQL_TIMEOUT_S  = float(os.getenv("UPLOAD_SQL_TIMEOUT_S", "5"))
+QUERY_BACKEND       = os.getenv("QUERY_BACKEND", "auto")      # bigquery | local | auto
+LOCAL_BQ_SEED       = os.getenv("LOCAL_BQ_SEED", "")
+LOCAL_BQ_LATENCY_MS = float(os.getenv("LOCAL_BQ_LATENCY_MS", "0"))
+RESULT_TOKEN_BUDGET = int(os.getenv("RESULT_TOKEN_BUDGET", "4000"))
+ANSWER_TOKEN_BUDGET = int(os.getenv("ANSWER_TOKEN_BUDGET", "24000"))
+DICT_PRUNE          = _env_flag("DICT_PRUNE", True)
+DICT_PRUNE_MIN_SIM  = float(os.getenv("DICT_PRUNE_MIN_SIM", "0.12"))
+DICT_PRUNE_MAX_TABLES = int(os.getenv("DICT_PRUNE_MAX_TABLES", "3"))
+PROMPT_CACHE        = _env_flag("PROMPT_CACHE", True)
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "32768"))
+PROMPT_CACHE_TTL_S  = int(os.getenv("PROMPT_CACHE_TTL_S", "3600"))
 
 BASE_DIR   = Path(__file__).parent
 UPLOAD_DIR = BASE_DIR / "uploads_store"
@@ -67,8 +157,15 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {".xlsx", ".xls", ".pdf", ".docx", ".csv"}
 
+# Spawned children (ingest workers, uvicorn's reloader) re-execute the parent's
+# __main__ script as "__mp_main__". When that script is this file (python
+# main.py), they must not build clients or the query backend: they never serve.
+_SPAWNED_CHILD = __name__ == "__mp_main__"
+
 # ── Optional dependency imports ───────────────────────────────────────────────
 try:
+    if _SPAWNED_CHILD:
+        raise ImportError("spawned child process")
     import google.generativeai as genai
     genai.configure(api_key=GEMINI_API_KEY)
     _router_model = genai.GenerativeModel(ROUTER_MODEL)
@@ -79,10 +176,9 @@ except Exception:
 
 try:
     from google.cloud import bigquery as _bq
-    import threading
     _bq_client = None
     BQ_OK = False
-    if GCP_PROJECT:
+    if GCP_PROJECT and QUERY_BACKEND != "local" and not _SPAWNED_CHILD:
         def _init_bq():
             global _bq_client, BQ_OK
             try:
@@ -98,33 +194,294 @@ except Exception:
 
 try:
     from google.cloud import storage as _gcs
-    _gcs_client = _gcs.Client() if GCS_BUCKET else None
-    GCS_OK = bool(GCS_BUCKET)
+    _gcs_client = _gcs.Client() if GCS_BUCKET and not _SPAWNED_CHILD else None
+    GCS_OK = _gcs_client is not None
 except Exception:
     _gcs_client = None
     GCS_OK = False
 
 try:
-    import openpyxl
-    EXCEL_OK = True
-except Exception:
-    EXCEL_OK = False
+    from . import parsers       # as the backend package (uvicorn backend.main:app)
+except ImportError:
+    import parsers              # as a top-level module (python main.py, bench.py)
 
 try:
-    import pdfplumber
-    PDF_OK = True
+    import numpy as np
+    NUMPY_OK = True
 except Exception:
-    PDF_OK = False
+    NUMPY_OK = False
 
 try:
-    from docx import Document as _DocxDoc
-    DOCX_OK = True
+    import pyarrow  # noqa: F401  (BigQuery's to_arrow_iterable needs it)
+    ARROW_OK = True
 except Exception:
-    DOCX_OK = False
+    ARROW_OK = False
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ASYNC EXECUTION LAYER  (no blocking model / BigQuery I/O on the event loop)
+# ══════════════════════════════════════════════════════════════════════════════
+# Gemini calls use the SDK's native async methods. The BigQuery client has no
+# async API, so its round trips run on a bounded thread pool sized by
+# IO_WORKERS. A slow query then only occupies one pool thread instead of
+# stalling every other SSE stream (and /health) on the worker.
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="saasmetrics-io")
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Run a blocking callable on the I/O pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_pool, functools.partial(fn, *args, **kwargs))
+
+
+async def _generate_text(model, prompt: str) -> str:
+    """Single non-streaming Gemini call, awaited natively."""
+    resp = await model.generate_content_async(prompt)
+    return resp.text
+
+
+async def _stream_text(model, prompt: str, usage: Optional[dict] = None) -> AsyncIterator[str]:
+    """Streaming Gemini call — yields text chunks as they arrive.
+
+    `usage`, if given, is filled from the response's usage metadata (last chunk wins).
+    """
+    stream = await model.generate_content_async(prompt, stream=True)
+    async for chunk in stream:
+        meta = getattr(chunk, "usage_metadata", None)
+        if usage is not None and meta is not None:
+            usage["prompt_tokens"] = getattr(meta, "prompt_token_count", 0) or 0
+            usage["cached_tokens"] = getattr(meta, "cached_content_token_count", 0) or 0
+        if chunk.text:
+            yield chunk.text
+
+
+# ── Model handles + prompt-prefix cache ───────────────────────────────────────
+# A model handle is built once per (model, system prefix) and reused for every
+# request. When the prefix is at least PROMPT_CACHE_MIN_TOKENS (Gemini's
+# context-cache minimum) and the SDK supports it, the handle is bound to a
+# server-side cached context so the prefix isn't re-billed or re-processed;
+# the handle is rebuilt before the cache TTL runs out. `factory` and
+# `context_factory` are swappable so the cache runs against local fakes.
+
+class PromptPrefixCache:
+    """Reusable model handles keyed by (model, static prefix), with token counters."""
+
+    def __init__(self, factory: Optional[Callable] = None, context_factory: Optional[Callable] = None,
+                 min_tokens: int = PROMPT_CACHE_MIN_TOKENS, ttl_s: int = PROMPT_CACHE_TTL_S):
+        self.factory = factory or (lambda name, system: genai.GenerativeModel(name, system_instruction=system))
+        self.context_factory = context_factory or self._gemini_context
+        self.min_tokens = min_tokens
+        self.ttl_s = ttl_s
+        self._handles: dict[tuple[str, str], tuple[object, float, bool]] = {}   # key → (model, expires, server-side)
+        self._lock = threading.Lock()
+        self.built = 0
+        self.reused = 0
+        self.context_caches = 0
+        self.prefix_tokens_reused = 0       # prefix tokens served from a reused handle
+        self.server_cached_tokens = 0       # prompt tokens the API reports as read from its context cache
+        self.prompt_tokens = 0
+
+    def _gemini_context(self, name: str, system: str):
+        """Server-side cached context for `system`; None when the SDK can't."""
+        import datetime
+        from google.generativeai import caching
+        cached = caching.CachedContent.create(
+            model=name, system_instruction=system, ttl=datetime.timedelta(seconds=self.ttl_s),
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cached)
+
+    def model(self, name: str, system: str):
+        """Handle for (name, system) — built on first use, then reused until its cache expires."""
+        key = (name, hashlib.sha256(system.encode()).hexdigest())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[1] > now:
+                self.reused += 1
+                self.prefix_tokens_reused += estimate_tokens(system)
+                return entry[0]
+        handle, server_side = None, False
+        if PROMPT_CACHE and estimate_tokens(system) >= self.min_tokens:
+            try:
+                handle = self.context_factory(name, system)
+                server_side = handle is not None
+            except Exception as e:      # SDK without caching, model without support, quota…
+                print(f"Prompt context cache unavailable for {name}: {e}")
+        if handle is None:
+            handle = self.factory(name, system)
+        # Server-side contexts expire; refresh a little before the TTL. Local handles don't.
+        expires = now + self.ttl_s * 0.9 if server_side else float("inf")
+        with self._lock:
+            self._handles[key] = (handle, expires, server_side)
+            self.built += 1
+            self.context_caches += server_side
+        return handle
+
+    def record_usage(self, usage: dict) -> None:
+        with self._lock:
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.server_cached_tokens += usage.get("cached_tokens", 0)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._handles.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": PROMPT_CACHE,
+                "handles": len(self._handles),
+                "built": self.built,
+                "reused": self.reused,
+                "context_caches": self.context_caches,
+                "prefix_tokens_reused": self.prefix_tokens_reused,
+                "server_cached_tokens": self.server_cached_tokens,
+                "prompt_tokens": self.prompt_tokens,
+            }
+
+
+_prompt_cache = PromptPrefixCache()
+
+
+def _query_job_config(dry_run: bool = False, params: Optional[dict[str, str]] = None):
+    """BigQuery QueryJobConfig, or an attribute-compatible stand-in when the library
+    isn't installed (the local backend only reads dry_run / query_parameters).
+
+    Real jobs are capped at BQ_MAX_BYTES_BILLED and BQ_JOB_TIMEOUT_S — BigQuery
+    fails the job rather than scan or run past either.
+    """
+    limits = {} if dry_run else {"maximum_bytes_billed": BQ_MAX_BYTES_BILLED,
+                                 "job_timeout_ms": int(BQ_JOB_TIMEOUT_S * 1000)}
+    try:
+        from google.cloud import bigquery as bq
+    except ImportError:
+        from types import SimpleNamespace
+        return SimpleNamespace(dry_run=dry_run, **limits, query_parameters=[
+            SimpleNamespace(name=name, value=value) for name, value in (params or {}).items()
+        ])
+    return bq.QueryJobConfig(dry_run=dry_run, use_query_cache=not dry_run, **limits, query_parameters=[
+        bq.ScalarQueryParameter(name, "STRING", value) for name, value in (params or {}).items()
+    ])
+
+
+def _bq_dry_run(sql: str):
+    """Dry-run job; its total_bytes_processed is the scan estimate."""
+    return _bq_client.query(sql, job_config=_query_job_config(dry_run=True))
+
+
+def _bq_fetch_rows(sql: str, params: Optional[dict[str, str]] = None) -> list[dict]:
+    """Small metadata lookups only; query results go through _bq_iter_pages."""
+    job = _bq_client.query(sql, job_config=_query_job_config(params=params))
+    return [dict(row) for row in job.result(timeout=BQ_JOB_TIMEOUT_S)]
+
+
+_bqstorage = {"client": None, "tried": False}
+
+
+def _bqstorage_client():
+    """Storage Read API client, created on first use; None when it isn't installed or allowed."""
+    if BQ_STORAGE_API and not _bqstorage["tried"]:
+        _bqstorage["tried"] = True
+        try:
+            from google.cloud import bigquery_storage
+            _bqstorage["client"] = bigquery_storage.BigQueryReadClient()
+        except Exception:
+            _bqstorage["client"] = None
+    return _bqstorage["client"]
+
+
+def _bq_iter_pages(sql: str, params: Optional[dict[str, str]] = None
+                   ) -> Iterator[tuple[list[str], list[tuple], Optional[int]]]:
+    """Yield (columns, rows, total_rows) one page at a time, without a dict per row.
+
+    With pyarrow installed, pages are Arrow record batches — read over the
+    Storage Read API when google-cloud-bigquery-storage is available (the
+    library falls back to REST pages for results too small to benefit).
+    Without it, REST pages of BQ_PAGE_SIZE rows. Clients that return a plain
+    list (local backend, bench fakes) are chunked the same way.
+    """
+    job = _bq_client.query(sql, job_config=_query_job_config(params=params))
+    result = job.result(timeout=BQ_JOB_TIMEOUT_S, page_size=BQ_PAGE_SIZE)
+    total = getattr(result, "total_rows", None)
+    if ARROW_OK and hasattr(result, "to_arrow_iterable"):
+        _stream_totals["arrow"] += 1
+        for batch in result.to_arrow_iterable(bqstorage_client=_bqstorage_client()):
+            yield batch.schema.names, list(zip(*(col.to_pylist() for col in batch.columns))), total
+    elif hasattr(result, "pages"):
+        columns = [field.name for field in result.schema]
+        for page in result.pages:
+            yield columns, [tuple(row.values()) for row in page], total
+    else:
+        rows = list(result)
+        columns = list(dict.fromkeys(c for r in rows for c in r))
+        for i in range(0, len(rows), BQ_PAGE_SIZE):
+            yield columns, [tuple(r.get(c) for c in columns) for r in rows[i:i + BQ_PAGE_SIZE]], len(rows)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
-# DATA DICTIONARY  (loaded once, injected into every prompt)
+# CACHES  (in-process LRU + TTL, shared by the pipeline stages)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class LRUCache:
+    """Thread-safe LRU cache with optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int, ttl_s: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value, or None on miss / expiry."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                stored_at, value = item
+                if self.ttl_s is None or time.monotonic() - stored_at < self.ttl_s:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+_router_cache = LRUCache(ROUTER_CACHE_SIZE, ROUTER_CACHE_TTL_S)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DATA DICTIONARY  (loaded once; prompts get a per-question slice — see DICTIONARY PRUNING)
 # ══════════════════════════════════════════════════════════════════════════════
 
 def _load_data_dict() -> str:
@@ -135,6 +492,11 @@ def _load_data_dict() -> str:
 
 DATA_DICT = _load_data_dict()
 
+try:
+    DATA_DICT_SPEC: dict = yaml.safe_load(DATA_DICT) or {}
+except yaml.YAMLError:
+    DATA_DICT_SPEC = {}
+
 # ══════════════════════════════════════════════════════════════════════════════
 # BQ SCHEMA  (static — used by router + SQL generator)
 # ══════════════════════════════════════════════════════════════════════════════
@@ -184,79 +546,260 @@ TABLE usage_metrics
   logins_per_user FLOAT64, feature_adoption FLOAT64
 """.strip()
 
+
+def _parse_bq_schema(schema: str) -> dict[str, list[tuple[str, str, str]]]:
+    """TABLE blocks of BQ_SCHEMA → {table: [(column, type, comment), ...]}."""
+    tables: dict[str, list[tuple[str, str, str]]] = {}
+    current = None
+    for line in schema.splitlines():
+        m = re.match(r"\s*TABLE (\w+)", line)
+        if m:
+            current = tables.setdefault(m.group(1), [])
+            continue
+        if current is None:
+            continue
+        comment = line.split("--", 1)[1].strip() if "--" in line else ""
+        for col, col_type in re.findall(r"(\w+)\s+(STRING|INT64|FLOAT64|DATE|TIMESTAMP|BOOL)\b", line):
+            current.append((col, col_type, comment))
+    return tables
+
+BQ_TABLES = _parse_bq_schema(BQ_SCHEMA)
+
 # ══════════════════════════════════════════════════════════════════════════════
 # FILE SOURCE LOADERS  (cached, lazy-loaded)
 # ══════════════════════════════════════════════════════════════════════════════
 
 
 
-def _parse_excel_bytes(content: bytes, label: str) -> str:
-    if not EXCEL_OK:
-        return f"[Excel parser not available — pip install openpyxl]"
-    wb = openpyxl.load_workbook(io.BytesIO(content), data_only=True)
-    parts = [f"=== {label} ==="]
-    for name in wb.sheetnames:
-        ws = wb[name]
-        rows = [
-            "\t".join(str(v) if v is not None else "" for v in row)
-            for row in ws.iter_rows(values_only=True)
-            if any(v is not None for v in row)
-        ]
-        if rows:
-            parts.append(f"--- Sheet: {name} ---\n" + "\n".join(rows[:500]))
-    return "\n\n".join(parts)
+# Text and typed-table parsers live in parsers.py so spawned ingest workers can
+# import them without this module's client / backend setup. The page-parallel,
+# page-cached PDF path stays here: it drives the pool rather than running in it.
+_parse_excel_bytes = parsers.parse_excel_bytes
+_extract_pdf_pages = parsers.extract_pdf_pages
+_extract_tables    = parsers.extract_tables
+_sql_ident         = parsers.sql_ident
+_source_type       = parsers.file_source_type
+
+def _pdf_page_cache_path(digest: str) -> Path:
+    return _parse_cache_dir / "pdf_pages" / f"{digest}.json"
 
 def _parse_pdf_bytes(content: bytes, label: str) -> str:
-    if not PDF_OK:
+    """Extract up to PDF_MAX_PAGES pages. Page text is cached per (content
+    hash, page), so re-indexing or raising the cap only extracts missing
+    pages; those are split into PDF_PAGES_PER_TASK ranges across the ingest
+    process pool when there is one."""
+    if not parsers.PDF_OK:
         return f"[PDF parser not available — pip install pdfplumber]"
+    digest = content_digest(content)
+    cache_path = _pdf_page_cache_path(digest)
+    try:
+        cached = {int(k): v for k, v in json.loads(cache_path.read_text()).items()}
+    except (OSError, ValueError):
+        cached = {}
+
+    with parsers.pdfplumber.open(io.BytesIO(content)) as pdf:
+        page_count = min(len(pdf.pages), PDF_MAX_PAGES)
+    missing = [i for i in range(page_count) if i not in cached]
+
+    if missing:
+        ranges = [missing[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(missing), PDF_PAGES_PER_TASK)]
+        pool = _get_ingest_pool() if len(ranges) > 1 else None
+        if pool is not None:
+            try:
+                for fut in [pool.submit(_extract_pdf_pages, content, r) for r in ranges]:
+                    cached.update(fut.result())
+            except BrokenExecutor as e:
+                print(f"Ingest pool broken, extracting pages in-thread: {e}")
+                _drop_broken_ingest_pool(pool)
+        still_missing = [i for i in missing if i not in cached]
+        if still_missing:
+            cached.update(_extract_pdf_pages(content, still_missing))
+        _store_parsed_local(cache_path, json.dumps({str(k): v for k, v in sorted(cached.items())}))
+
     parts = [f"=== {label} ==="]
-    with pdfplumber.open(io.BytesIO(content)) as pdf:
-        for i, page in enumerate(pdf.pages[:60]):
-            t = page.extract_text()
-            if t:
-                parts.append(f"--- Page {i+1} ---\n{t}")
+    for i in range(page_count):
+        if cached.get(i):
+            parts.append(f"--- Page {i+1} ---\n{cached[i]}")
     return "\n\n".join(parts)
 
-def _parse_docx_bytes(content: bytes, label: str) -> str:
-    if not DOCX_OK:
-        return f"[Word parser not available — pip install python-docx]"
-    doc = _DocxDoc(io.BytesIO(content))
-    lines = [f"=== {label} ==="]
-    for p in doc.paragraphs:
-        if p.text.strip():
-            lines.append(p.text)
-    for table in doc.tables:
-        for row in table.rows:
-            cells = [c.text.strip() for c in row.cells if c.text.strip()]
-            if cells:
-                lines.append(" | ".join(cells))
-    return "\n".join(lines)
-
-def _parse_csv_bytes(content: bytes, label: str) -> str:
-    import csv
-    lines = [f"=== {label} ==="]
-    reader = csv.reader(io.StringIO(content.decode("utf-8", errors="replace")))
-    for i, row in enumerate(reader):
-        if i > 1000:
-            lines.append("... (truncated at 1000 rows)")
-            break
-        lines.append("\t".join(row))
-    return "\n".join(lines)
-
 def _parse_any(filename: str, content: bytes, label: str) -> str:
-    ext = Path(filename).suffix.lower()
-    if ext in (".xlsx", ".xls"):
-        return _parse_excel_bytes(content, label)
-    elif ext == ".pdf":
+    if _splits_pages(filename):
         return _parse_pdf_bytes(content, label)
-    elif ext == ".docx":
-        return _parse_docx_bytes(content, label)
-    elif ext == ".csv":
-        return _parse_csv_bytes(content, label)
-    return f"[Unsupported: {ext}]"
+    return parsers.parse_text(filename, content, label)
+
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# PARSE CACHE  (content-addressed: SHA-256 of the file bytes → parsed text)
+# ══════════════════════════════════════════════════════════════════════════════
+# Artifacts are small JSON files under PARSE_CACHE_DIR and, when GCS is on,
+# next to the blobs at parsed/<key>.json so every replica shares them. GCS
+# uploads also carry their digest as blob metadata, which lets a restart find
+# the artifact without downloading the file. Bump PARSE_CACHE_VERSION whenever
+# parser output changes.
+#
+# Typed tables (up to UPLOAD_TABLE_MAX_ROWS rows each) are not inlined in the
+# JSON: their columns go to a <key>.cols file beside it, one zlib-compressed
+# block per column (int64 / float64 array buffers, JSON only for text). The
+# artifact's table specs keep names, types and row counts plus the offset of
+# each block.
+
+PARSE_CACHE_VERSION = "4"
+_parse_cache_dir = Path(PARSE_CACHE_DIR) if PARSE_CACHE_DIR else UPLOAD_DIR / ".parsed"
+_parse_cache_stats = {"hits": 0, "gcs_hits": 0, "misses": 0}
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _parse_cache_key(filename: str, digest: str) -> str:
+    """Keyed on bytes, parser version and the parse limit that shapes the output."""
+    ext = Path(filename).suffix.lower()
+    limit = {".pdf": f"-p{PDF_MAX_PAGES}", ".xlsx": f"-r{EXCEL_MAX_ROWS}", ".xls": f"-r{EXCEL_MAX_ROWS}"}.get(ext, "")
+    return f"v{PARSE_CACHE_VERSION}-{ext.lstrip('.')}{limit}-{digest}"
+
+
+def _relabel(text: str, label: str) -> str:
+    """Same bytes under another filename: swap the parser's "=== label ===" header line."""
+    head, sep, body = text.partition("\n")
+    if head.startswith("=== ") and head.endswith(" ==="):
+        return f"=== {label} ==={sep}{body}"
+    return text
+
+
+def _read_cached(name: str) -> tuple[Optional[bytes], bool]:
+    """(bytes, from_gcs) of a parse-cache file — local first, then GCS (written through)."""
+    local = _parse_cache_dir / name
+    try:
+        return local.read_bytes(), False
+    except OSError:
+        pass
+    if GCS_OK and _gcs_client:
+        try:
+            raw = _gcs_client.bucket(GCS_BUCKET).blob(f"parsed/{name}").download_as_bytes()
+            _store_parsed_local(local, raw)
+            return raw, True
+        except Exception:
+            pass
+    return None, False
+
+
+def load_parsed(filename: str, digest: str) -> Optional[dict]:
+    """Cached artifact {source_type, text, tables, size_bytes, sha256} for these bytes, or None."""
+    key = _parse_cache_key(filename, digest)
+    raw, from_gcs = _read_cached(f"{key}.json")
+    try:
+        artifact = json.loads(raw) if raw is not None else None
+        if artifact and artifact["tables"]:
+            cols, _ = _read_cached(f"{key}.cols")
+            artifact["tables"] = _decode_tables(artifact["tables"], cols) if cols is not None else None
+    except (ValueError, KeyError, zlib.error):
+        artifact = None
+    if artifact is None or artifact["tables"] is None:
+        return None
+    _parse_cache_stats["gcs_hits" if from_gcs else "hits"] += 1
+    artifact["text"] = _relabel(artifact["text"], f"Uploaded {artifact['source_type']}: {filename}")
+    return artifact
+
+
+def _store_parsed_local(path: Path, data: str | bytes):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")   # concurrent writers of one digest
+        tmp.write_bytes(data.encode() if isinstance(data, str) else data)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"Parse cache write error: {e}")
+
+
+def _column_block(col_type: str, values) -> tuple[str, bytes]:
+    """One table column → (kind, raw bytes): int64 / float64 little-endian buffers, else JSON."""
+    if col_type in ("INTEGER", "REAL"):
+        if col_type == "INTEGER" and None not in values:
+            arr = array.array("q", values)
+        else:
+            arr = array.array("d", (math.nan if v is None else float(v) for v in values))
+        if sys.byteorder == "big":
+            arr.byteswap()
+        return arr.typecode, arr.tobytes()
+    return "json", json.dumps(values).encode()
+
+
+def _encode_tables(tables: list[dict]) -> tuple[list[dict], bytes]:
+    """Table specs → (specs with block offsets instead of data, .cols file bytes)."""
+    buf = bytearray()
+    specs = []
+    for table in tables:
+        blocks = []
+        for col, values in zip(table["columns"], table["data"]):
+            kind, raw = _column_block(col["type"], values)
+            packed = zlib.compress(raw, 6)
+            blocks.append({"kind": kind, "offset": len(buf), "length": len(packed)})
+            buf += packed
+        specs.append({**{k: v for k, v in table.items() if k != "data"}, "blocks": blocks})
+    return specs, bytes(buf)
+
+
+def _decode_tables(specs: list[dict], raw: bytes) -> list[dict]:
+    """Inverse of _encode_tables; numeric columns come back as arrays (ColumnarTable adopts them)."""
+    tables = []
+    for spec in specs:
+        data = []
+        for block in spec["blocks"]:
+            chunk = zlib.decompress(raw[block["offset"]:block["offset"] + block["length"]])
+            if block["kind"] == "json":
+                data.append(json.loads(chunk))
+                continue
+            arr = array.array(block["kind"])
+            arr.frombytes(chunk)
+            if sys.byteorder == "big":
+                arr.byteswap()
+            data.append(arr)
+        tables.append({**{k: v for k, v in spec.items() if k != "blocks"}, "data": data})
+    return tables
+
+
+def _parse_artifact(filename: str, content: bytes, digest: str) -> dict:
+    """Parse bytes into a cacheable artifact, in-process. Pool workers run
+    parsers.parse_artifact directly; PDFs get their text from the
+    page-parallel path here."""
+    text = _parse_pdf_bytes(content, f"Uploaded PDF: {filename}") if _splits_pages(filename) else None
+    return parsers.parse_artifact(filename, content, digest, text)
+
+
+def store_parsed(filename: str, artifact: dict):
+    """Write an artifact (JSON + its .cols table file) to the local cache and, with GCS on, next to the blobs."""
+    key = _parse_cache_key(filename, artifact["sha256"])
+    specs, cols = _encode_tables(artifact["tables"])
+    files = [(f"{key}.json", json.dumps({**artifact, "tables": specs}).encode(), "application/json")]
+    if specs:
+        files.insert(0, (f"{key}.cols", cols, "application/octet-stream"))    # before the JSON that points at it
+    for name, data, content_type in files:
+        _store_parsed_local(_parse_cache_dir / name, data)
+        if GCS_OK and _gcs_client:
+            try:
+                _gcs_client.bucket(GCS_BUCKET).blob(f"parsed/{name}").upload_from_string(
+                    data, content_type=content_type
+                )
+            except Exception as e:
+                print(f"GCS parse cache upload error: {e}")
+
 
+def parse_upload(filename: str, content: bytes) -> dict:
+    """Parsed artifact for these bytes — from the cache, or parsed once and cached."""
+    digest = content_digest(content)
+    artifact = load_parsed(filename, digest)
+    if artifact is not None:
+        return artifact
+    _parse_cache_stats["misses"] += 1
+    artifact = _parse_artifact(filename, content, digest)
+    store_parsed(filename, artifact)
+    return artifact
 
 
+def parse_cache_stats() -> dict:
+    return {**_parse_cache_stats, "version": PARSE_CACHE_VERSION}
+
 
 # ══════════════════════════════════════════════════════════════════════════════
 # UPLOAD INDEX  (in-memory + GCS-persisted)
@@ -264,26 +807,32 @@ def _parse_any(filename: str, content: bytes, label: str) -> str:
 
 # index: list of {filename, source_type, text, size_kb, uploaded_at, storage}
 _upload_index: list[dict] = []
+_index_lock = threading.RLock()     # upload jobs, restore and delete index from different threads
 
 def _gcs_upload(filename: str, content: bytes):
     if not GCS_OK or not _gcs_client:
         return False
     try:
         blob = _gcs_client.bucket(GCS_BUCKET).blob(f"uploads/{filename}")
+        blob.metadata = {"sha256": content_digest(content)}
         blob.upload_from_string(content)
         return True
     except Exception as e:
         print(f"GCS upload error: {e}")
         return False
 
-def _gcs_list() -> list[str]:
+def _gcs_list() -> dict[str, Optional[str]]:
+    """Uploaded blob names → their sha256 metadata (None for blobs uploaded before it existed)."""
     if not GCS_OK or not _gcs_client:
-        return []
+        return {}
     try:
         blobs = _gcs_client.bucket(GCS_BUCKET).list_blobs(prefix="uploads/")
-        return [b.name.replace("uploads/", "") for b in blobs if b.name != "uploads/"]
+        return {
+            b.name.replace("uploads/", ""): (b.metadata or {}).get("sha256")
+            for b in blobs if b.name != "uploads/"
+        }
     except Exception:
-        return []
+        return {}
 
 def _gcs_download(filename: str) -> Optional[bytes]:
     if not GCS_OK or not _gcs_client:
@@ -302,65 +851,1520 @@ def _gcs_delete(filename: str):
     except Exception:
         pass
 
+# ── Parallel ingest ──────────────────────────────────────────────────────────
+# Downloads overlap on a thread pool; pdfplumber / openpyxl parsing is CPU-bound
+# and runs on a process pool of INGEST_WORKERS. Workers are spawned, not forked:
+# the gRPC-based Google clients are not fork-safe. Tasks reference parsers.py
+# only, so a spawned worker never imports this module. Indexing stays in-process.
+# File-level parses that run on a thread (PDFs, which wait on their page
+# ranges, and every parse when there is no process pool) get their own
+# INGEST_PARSE_THREADS pool: a burst of uploads must not take the _io_pool
+# threads that Gemini / BigQuery round trips need.
+
+_ingest_threads = ThreadPoolExecutor(max_workers=INGEST_PARSE_THREADS, thread_name_prefix="ingest-parse")
+
+_ingest_pool: Optional[ProcessPoolExecutor] = None
+_ingest_pool_lock = threading.Lock()
+
+def _get_ingest_pool() -> Optional[ProcessPoolExecutor]:
+    """Shared parse process pool, created on first use. None → parse in-thread."""
+    global _ingest_pool
+    if INGEST_WORKERS <= 1 or multiprocessing.parent_process() is not None:
+        return None     # no pool, or we already are a worker
+    with _ingest_pool_lock:
+        if _ingest_pool is None:
+            try:
+                _ingest_pool = ProcessPoolExecutor(
+                    max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+            except (OSError, ValueError) as e:
+                print(f"Ingest process pool unavailable, parsing in-thread: {e}")
+                return None
+        return _ingest_pool
+
+def _drop_broken_ingest_pool(pool: ProcessPoolExecutor):
+    """A crashed worker breaks the whole pool; discard it so the next parse starts a fresh one."""
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is pool:
+            _ingest_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _splits_pages(filename: str) -> bool:
+    """PDFs fan their own page ranges out to the pool, so the file-level parse runs on _ingest_threads."""
+    return Path(filename).suffix.lower() == ".pdf"
+
+def submit_parse(filename: str, content: bytes, digest: str) -> Future:
+    """Parse on the process pool when there is one; otherwise now, on this thread."""
+    pool = _get_ingest_pool()
+    if pool is not None and _splits_pages(filename):
+        return _ingest_threads.submit(_parse_artifact, filename, content, digest)
+    if pool is not None:
+        try:
+            return pool.submit(parsers.parse_artifact, filename, content, digest)
+        except RuntimeError as e:       # broken / shut-down pool
+            print(f"Ingest pool submit failed, parsing in-thread: {e}")
+            _drop_broken_ingest_pool(pool)
+    fut: Future = Future()
+    try:
+        fut.set_result(_parse_artifact(filename, content, digest))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+_restore_state = {
+    "state": "pending", "ready": False, "total": 0, "files": 0,
+    "cached": 0, "parsed": 0, "failed": 0, "ms": None,
+}
+
 def restore_uploads_from_storage():
-    """Re-build upload index from GCS (or local) on startup."""
+    """Re-build upload index from GCS (or local) on startup.
+
+    Files whose parsed artifact is cached are indexed without re-parsing; GCS
+    blobs with a digest in their metadata aren't even downloaded. The rest are
+    downloaded in parallel and parsed on the ingest process pool.
+    """
+    t0 = time.perf_counter()
+    _restore_state.update(state="running", ready=False, total=0, files=0, cached=0, parsed=0, failed=0, ms=None)
     indexed = {f["filename"] for f in _upload_index}
 
-    # GCS first
-    for fname in _gcs_list():
-        if fname not in indexed:
-            content = _gcs_download(fname)
-            if content:
-                _index_upload(fname, content, storage="gcs")
+    gcs = {n: d for n, d in _gcs_list().items() if n not in indexed}
+    local = [
+        p for p in UPLOAD_DIR.iterdir()
+        if p.suffix.lower() in ALLOWED_EXTENSIONS and p.name not in indexed and p.name not in gcs
+    ]
+    _restore_state["total"] = len(gcs) + len(local)
 
-    # Local fallback
-    for p in UPLOAD_DIR.iterdir():
-        if p.suffix.lower() in ALLOWED_EXTENSIONS and p.name not in indexed:
-            _index_upload(p.name, p.read_bytes(), storage="local")
+    def _add(fname: str, artifact: dict, storage: str, counter: str):
+        try:
+            _index_parsed(fname, artifact, storage)
+            _restore_state["files"] += 1
+            _restore_state[counter] += 1
+        except Exception as e:
+            _restore_state["failed"] += 1
+            print(f"Restore error for {fname}: {e}")
+
+    with ThreadPoolExecutor(INGEST_DOWNLOAD_WORKERS, thread_name_prefix="ingest-dl") as dl:
+        fetches: dict[Future, tuple[str, str]] = {}
+        for fname, digest in gcs.items():
+            artifact = load_parsed(fname, digest) if digest else None
+            if artifact is not None:
+                _add(fname, artifact, "gcs", "cached")
+            else:
+                fetches[dl.submit(_gcs_download, fname)] = (fname, "gcs")
+        for p in local:
+            fetches[dl.submit(p.read_bytes)] = (p.name, "local")
+
+        parses: dict[Future, tuple[str, str, bytes, str]] = {}
+        for fut in as_completed(fetches):
+            fname, storage = fetches[fut]
+            try:
+                content = fut.result()
+            except OSError:
+                content = None
+            if not content:
+                _restore_state["failed"] += 1
+                continue
+            digest = content_digest(content)
+            artifact = load_parsed(fname, digest)
+            if artifact is not None:
+                _add(fname, artifact, storage, "cached")
+            else:
+                _parse_cache_stats["misses"] += 1
+                parses[submit_parse(fname, content, digest)] = (fname, storage, content, digest)
+
+        for fut in as_completed(parses):
+            fname, storage, content, digest = parses.pop(fut)
+            try:
+                try:
+                    artifact = fut.result()
+                except BrokenExecutor:      # a worker died — finish this file in-thread
+                    artifact = _parse_artifact(fname, content, digest)
+            except Exception as e:
+                _restore_state["failed"] += 1
+                print(f"Parse error for {fname}: {e}")
+                continue
+            store_parsed(fname, artifact)
+            _add(fname, artifact, storage, "parsed")
+
+    if _vector_index is not None and not _restore_state["failed"]:
+        with _index_lock:
+            _vector_index.prune({f["filename"] for f in _upload_index})
+
+    _restore_state.update(state="done", ready=True, ms=round((time.perf_counter() - t0) * 1000, 1))
 
 def _index_upload(filename: str, content: bytes, storage: str = "local") -> dict:
-    """Parse file and add to index. Returns entry dict."""
-    from datetime import datetime, timezone
-    ext = Path(filename).suffix.lower()
-    source_type = {
-        ".xlsx": "Excel", ".xls": "Excel",
-        ".pdf":  "PDF",
-        ".docx": "Word",
-        ".csv":  "CSV",
-    }.get(ext, "Unknown")
-
-    text = _parse_any(filename, content, f"Uploaded {source_type}: {filename}")
+    """Parse file (or reuse its cached parse) and add to index. Returns entry dict."""
+    return _index_parsed(filename, parse_upload(filename, content), storage)
 
-    # Remove existing entry if re-uploading same filename
-    global _upload_index
-    _upload_index = [f for f in _upload_index if f["filename"] != filename]
+def _index_parsed(filename: str, artifact: dict, storage: str, job: Optional[dict] = None) -> Optional[dict]:
+    """Add a parsed artifact to the index. Returns entry dict, or None if `job` was cancelled."""
+    from datetime import datetime, timezone
+    source_type = artifact["source_type"]
+    text = artifact["text"]
 
     entry = {
         "filename":    filename,
         "source_type": source_type,
         "text":        text,
-        "size_kb":     round(len(content) / 1024, 1),
+        "size_kb":     round(artifact["size_bytes"] / 1024, 1),
+        "sha256":      artifact["sha256"],
         "uploaded_at": datetime.now(timezone.utc).isoformat(),
         "storage":     storage,
         "preview":     text[:200] + "..." if len(text) > 200 else text,
     }
-    _upload_index.append(entry)
+    chunks = chunk_upload_text(filename, source_type, text)
+
+    # Remove existing entry if re-uploading same filename
+    global _upload_index
+    with _index_lock:
+        if job is not None and job.get("_cancelled"):
+            return None
+        _upload_index = [f for f in _upload_index if f["filename"] != filename] + [entry]
+        _chunk_index.add(filename, chunks)
+        if _vector_index is not None:
+            _vector_index.add(filename, chunks)
+        _upload_tables.register(filename, artifact.get("tables") or [])
+        _on_uploads_changed()
     return entry
 
-def get_uploads_text() -> str:
-    """Combined text of all indexed uploads for prompt injection."""
+def _uploads_fingerprint() -> str:
+    """Stable hash of the indexed filenames — changes whenever the manifest does."""
+    names = "\n".join(sorted(f["filename"] for f in _upload_index))
+    return hashlib.sha1(names.encode()).hexdigest()[:16]
+
+def _on_uploads_changed():
+    """Drop cached state that depends on the upload manifest."""
+    _router_cache.clear()
+
+def get_uploads_text(question: Optional[str] = None) -> str:
+    """Upload text for prompt injection.
+
+    With a question: only the top UPLOAD_TOP_K passages from hybrid
+    BM25 + dense retrieval, each labelled with its file and sheet / page / section, plus a
+    one-line manifest of every indexed file. Without one: full text.
+    """
     if not _upload_index:
         return ""
-    return "\n\n".join(
-        f"{'='*50}\nSOURCE: Uploaded {f['source_type']} — {f['filename']}\n{'='*50}\n{f['text']}"
-        for f in _upload_index
-    )
+    if question is None:
+        return "\n\n".join(
+            f"{'='*50}\nSOURCE: Uploaded {f['source_type']} — {f['filename']}\n{'='*50}\n{f['text']}"
+            for f in _upload_index
+        )
+
+    header, passages = upload_passages(question)
+    return f"{header}\nShowing {len(passages)} most relevant passage(s).\n\n" + "\n\n".join(passages)
+
+
+def upload_passages(question: str) -> tuple[str, list[str]]:
+    """(manifest line, ranked passage texts) for a question — best passage first."""
+    if not _upload_index:
+        return "", []
+    hits = search_upload_chunks(question, UPLOAD_TOP_K)
+    if not hits:        # nothing matched lexically ("summarize my files") → lead chunk of each file
+        hits = [(0.0, c) for c in _chunk_index.leading_chunks(UPLOAD_TOP_K)]
+    manifest = ", ".join(f"{f['filename']} ({f['source_type']})" for f in _upload_index)
+    passages = [
+        f"{'='*50}\nSOURCE: Uploaded {c['source_type']} — {c['filename']}  [{c['section']}]\n{'='*50}\n{c['text']}"
+        for _, c in hits
+    ]
+    return f"Indexed uploads: {manifest}", passages
 
 def get_uploads_manifest() -> list[dict]:
     """Metadata only (no text) for UI listing."""
     return [{k: v for k, v in f.items() if k != "text"} for f in _upload_index]
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# UPLOAD JOBS  (background ingest queue — /upload returns before parsing)
+# ══════════════════════════════════════════════════════════════════════════════
+# /upload persists the bytes and enqueues a job. UPLOAD_JOB_WORKERS coroutines
+# drain the queue: cache lookup and indexing run on the I/O pool, parsing on
+# the ingest process pool, so several uploads proceed at once and /query
+# streams never wait on a parse. Job state is polled via
+# GET /upload/jobs/{id} or streamed via GET /upload/jobs/{id}/events.
+# DELETE /upload/{filename} cancels that file's unfinished jobs: the flag is
+# set under _index_lock and checked under it before a job commits to the
+# index, so a deleted file can never be indexed after the delete returns.
+# The delete handler runs on the threadpool while the loop adds and evicts
+# jobs, so the job table is only changed or walked under _upload_jobs_lock.
+
+JOB_STATES_FINAL = ("done", "failed", "cancelled")
+
+_upload_jobs: "OrderedDict[str, dict]" = OrderedDict()
+_upload_jobs_lock = threading.Lock()
+_upload_queue: Optional[asyncio.Queue] = None
+_upload_workers: list[asyncio.Task] = []
+
+
+def _job_view(job: dict) -> dict:
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+
+def _job_update(job: dict, **fields):
+    """Apply fields and wake every SSE listener on this job."""
+    from datetime import datetime, timezone
+    job.update(fields, updated_at=datetime.now(timezone.utc).isoformat())
+    changed, job["_changed"] = job["_changed"], asyncio.Event()
+    changed.set()
+
+
+def _ensure_upload_workers():
+    global _upload_queue
+    if _upload_queue is None:
+        _upload_queue = asyncio.Queue()
+    _upload_workers[:] = [t for t in _upload_workers if not t.done()]
+    while len(_upload_workers) < UPLOAD_JOB_WORKERS:
+        _upload_workers.append(asyncio.create_task(_upload_worker()))
+
+
+def enqueue_upload(filename: str, content: bytes, storage: str) -> dict:
+    """Register a job for persisted bytes and queue it. Returns the job."""
+    import uuid
+    from datetime import datetime, timezone
+    _ensure_upload_workers()
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "job_id": uuid.uuid4().hex[:12], "filename": filename, "storage": storage,
+        "size_kb": round(len(content) / 1024, 1), "state": "queued", "error": None,
+        "entry": None, "created_at": now, "updated_at": now, "ms": None,
+        "_content": content, "_changed": asyncio.Event(),
+    }
+    with _upload_jobs_lock:
+        _upload_jobs[job["job_id"]] = job
+        while len(_upload_jobs) > UPLOAD_JOB_HISTORY:
+            oldest = next(iter(_upload_jobs.values()))
+            if oldest["state"] not in JOB_STATES_FINAL:
+                break
+            _upload_jobs.popitem(last=False)
+    _upload_queue.put_nowait(job)
+    return job
+
+
+async def _parse_async(filename: str, content: bytes) -> dict:
+    """parse_upload without holding the event loop: cache check on the I/O pool, parse on the ingest pools."""
+    digest = await _run_blocking(content_digest, content)
+    artifact = await _run_blocking(load_parsed, filename, digest)
+    if artifact is not None:
+        return artifact
+    _parse_cache_stats["misses"] += 1
+    artifact = None
+    pool = _get_ingest_pool() if not _splits_pages(filename) else None
+    if pool is not None:
+        try:
+            artifact = await asyncio.wrap_future(pool.submit(parsers.parse_artifact, filename, content, digest))
+        except BrokenExecutor as e:
+            print(f"Ingest pool broken, parsing in-thread: {e}")
+            _drop_broken_ingest_pool(pool)
+    if artifact is None:
+        loop = asyncio.get_running_loop()
+        artifact = await loop.run_in_executor(_ingest_threads, _parse_artifact, filename, content, digest)
+    await _run_blocking(store_parsed, filename, artifact)
+    return artifact
+
+
+def cancel_upload_jobs(filename: str) -> int:
+    """Cancel every unfinished job for filename. Call with _index_lock held. Returns the count."""
+    cancelled = 0
+    with _upload_jobs_lock:
+        jobs = list(_upload_jobs.values())
+    for job in jobs:
+        if job["filename"] != filename or job["state"] in JOB_STATES_FINAL or job.get("_cancelled"):
+            continue
+        job["_cancelled"] = True
+        cancelled += 1
+    return cancelled
+
+
+def _job_cancelled(job: dict, t0: float) -> bool:
+    """Finish a cancelled job (its file was deleted). True if it was."""
+    if not job.get("_cancelled"):
+        return False
+    job.pop("_content", None)
+    _job_update(job, state="cancelled", error="file deleted before indexing finished",
+                ms=round((time.perf_counter() - t0) * 1000, 1))
+    return True
+
+
+async def _upload_worker():
+    while True:
+        job = await _upload_queue.get()
+        t0 = time.perf_counter()
+        try:
+            if _job_cancelled(job, t0):
+                continue
+            _job_update(job, state="parsing")
+            artifact = await _parse_async(job["filename"], job.pop("_content"))
+            if _job_cancelled(job, t0):
+                continue
+            _job_update(job, state="indexing")
+            entry = await _run_blocking(_index_parsed, job["filename"], artifact, job["storage"], job)
+            if entry is None:
+                _job_cancelled(job, t0)
+                continue
+            _job_update(
+                job, state="done", ms=round((time.perf_counter() - t0) * 1000, 1),
+                entry={k: entry[k] for k in ("filename", "source_type", "size_kb", "storage", "preview")},
+            )
+        except Exception as e:
+            job.pop("_content", None)
+            _job_update(job, state="failed", error=str(e), ms=round((time.perf_counter() - t0) * 1000, 1))
+        finally:
+            _upload_queue.task_done()
+
+
+async def upload_job_events(job: dict) -> AsyncIterator[str]:
+    """SSE: one `job` event per state change until done / failed; comment heartbeats while idle."""
+    while True:
+        changed = job["_changed"]
+        yield "data: " + json.dumps({"event": "job", **_job_view(job)}) + "\n\n"
+        if job["state"] in JOB_STATES_FINAL:
+            return
+        while True:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+                break
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+
+
+def upload_job_stats() -> dict:
+    counts: dict[str, int] = {}
+    with _upload_jobs_lock:
+        jobs = list(_upload_jobs.values())
+    for job in jobs:
+        counts[job["state"]] = counts.get(job["state"], 0) + 1
+    return {"workers": UPLOAD_JOB_WORKERS, "queued": _upload_queue.qsize() if _upload_queue else 0, **counts}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# UPLOAD RETRIEVAL  (chunked BM25 inverted index, built at index time)
+# ══════════════════════════════════════════════════════════════════════════════
+# Parsed text is split on the parsers' own markers (sheet / page) or numbered
+# headings (Word), then into ~UPLOAD_CHUNK_CHARS pieces. Tabular chunks repeat
+# their header row so each stands alone. Queries pull only the top-k chunks,
+# so the answer prompt stays bounded however many files are uploaded.
+
+_SECTION_MARKER = re.compile(r"^--- (Sheet: .+|Page \d+) ---$")
+_NUMBERED_HEADING = re.compile(r"^(\d+(?:\.\d+)*)\s+[A-Z]")
+
+
+def chunk_upload_text(filename: str, source_type: str, text: str, max_chars: int = UPLOAD_CHUNK_CHARS) -> list[dict]:
+    """Split parsed upload text into citation-labelled chunks."""
+    tabular = source_type in ("Excel", "CSV")
+    sections: list[tuple[str, list[str]]] = []
+    label = "rows" if tabular else "§intro"
+    lines: list[str] = []
+    for line in text.splitlines():
+        if line.startswith("=== ") and line.endswith(" ==="):
+            continue
+        marker = _SECTION_MARKER.match(line.strip())
+        heading = None if tabular else _NUMBERED_HEADING.match(line.strip())
+        if marker or heading:
+            if any(l.strip() for l in lines):
+                sections.append((label, lines))
+            label = marker.group(1) if marker else f"§{heading.group(1)}"
+            lines = [] if marker else [line]
+            continue
+        lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append((label, lines))
+
+    chunks = []
+    for label, lines in sections:
+        lines = [l for l in lines if l.strip()]
+        header = lines[0] if tabular and lines else None
+        buf: list[str] = []
+        size = 0
+        part = 1
+        for line in lines:
+            if buf and size + len(line) > max_chars:
+                chunks.append({"filename": filename, "source_type": source_type,
+                               "section": label if part == 1 else f"{label} (part {part})",
+                               "text": "\n".join(buf)})
+                part += 1
+                buf = [header] if header and line is not header else []
+                size = sum(len(b) for b in buf)
+            buf.append(line)
+            size += len(line) + 1
+        if buf:
+            chunks.append({"filename": filename, "source_type": source_type,
+                           "section": label if part == 1 else f"{label} (part {part})",
+                           "text": "\n".join(buf)})
+    return chunks
+
+
+class Bm25Index:
+    """Thread-safe BM25 inverted index over upload chunks."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks: dict[int, dict] = {}
+        self.lengths: dict[int, int] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.by_file: dict[str, list[int]] = {}
+        self.total_len = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def terms(text: str) -> list[str]:
+        return [w for w in _route_tokens(text) if w not in _STOPWORDS]
+
+    def add(self, filename: str, chunks: list[dict]) -> None:
+        with self._lock:
+            self._remove(filename)
+            ids = []
+            for chunk in chunks:
+                cid = self._next_id
+                self._next_id += 1
+                terms = self.terms(f"{chunk['section']} {chunk['text']}")
+                self.chunks[cid] = chunk
+                self.lengths[cid] = len(terms)
+                self.total_len += len(terms)
+                for t in terms:
+                    posting = self.postings.setdefault(t, {})
+                    posting[cid] = posting.get(cid, 0) + 1
+                ids.append(cid)
+            self.by_file[filename] = ids
+
+    def remove(self, filename: str) -> None:
+        with self._lock:
+            self._remove(filename)
+
+    def _remove(self, filename: str) -> None:
+        for cid in self.by_file.pop(filename, []):
+            chunk = self.chunks.pop(cid)
+            self.total_len -= self.lengths.pop(cid)
+            for t in set(self.terms(f"{chunk['section']} {chunk['text']}")):
+                posting = self.postings.get(t)
+                if posting is not None:
+                    posting.pop(cid, None)
+                    if not posting:
+                        del self.postings[t]
+
+    def search(self, query: str, k: int) -> list[tuple[float, dict]]:
+        """Top-k (score, chunk) pairs, best first; only chunks sharing a term with the query."""
+        with self._lock:
+            n = len(self.chunks)
+            if not n:
+                return []
+            avg_len = self.total_len / n or 1.0
+            scores: dict[int, float] = {}
+            for t in set(self.terms(query)):
+                posting = self.postings.get(t)
+                if not posting:
+                    continue
+                idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for cid, tf in posting.items():
+                    norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[cid] / avg_len)
+                    scores[cid] = scores.get(cid, 0.0) + idf * tf * (self.k1 + 1) / norm
+            best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:k]
+            return [(round(score, 3), self.chunks[cid]) for cid, score in best]
+
+    def leading_chunks(self, k: int) -> list[dict]:
+        """First chunk of each file, up to k — overview when nothing matches."""
+        with self._lock:
+            return [self.chunks[ids[0]] for ids in self.by_file.values() if ids][:k]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self.by_file), "chunks": len(self.chunks), "terms": len(self.postings)}
+
+
+_chunk_index = Bm25Index()
+
+
+def embed_text(text: str, dim: int = UPLOAD_VECTOR_DIM) -> "np.ndarray":
+    """Local hashed embedding: stems + in-word character trigrams, signed, L2-normalised.
+
+    Trigrams make "renewal" / "renewing" / "renewals" share most features, so
+    paraphrases still land near each other without a remote embedding call.
+    """
+    vec = np.zeros(dim, dtype=np.float32)
+    counts: dict[str, float] = {}
+    for w in _content_tokens(text):
+        counts[w] = counts.get(w, 0.0) + 1.0
+        padded = f"#{w}#"
+        for i in range(len(padded) - 2):
+            gram = "3:" + padded[i:i + 3]
+            counts[gram] = counts.get(gram, 0.0) + 0.5
+    for feature, tf in counts.items():
+        h = zlib.crc32(feature.encode())
+        vec[h % dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(tf))
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class VectorIndex:
+    """Dense chunk vectors as one append-only float32 matrix, memory-mapped from disk.
+
+    <name>.<gen>.f32 holds raw rows; <name>.jsonl is an append-only log of
+    {"file", "digest", "start", "chunks"} and {"drop"} records that says which
+    rows belong to which upload. An add appends its rows and one log line and
+    re-maps the grown file — nothing on disk is rewritten. Replaced or removed
+    rows just go dead; once they outnumber live rows, compact() writes the
+    live rows to the next generation's file. At startup the log is replayed,
+    so restore re-adding an unchanged file (same chunk digest) costs nothing.
+    """
+
+    VERSION = 1         # bump when embed_text changes: old vectors are discarded on load
+    MIN_COMPACT_ROWS = 1024
+
+    def __init__(self, path: Path, dim: int):
+        self.path = path            # <dir>/<name>; the log is <name>.jsonl
+        self.dim = dim
+        self.gen = 0
+        self.rows = 0               # rows in the data file (live + dead)
+        self.row_chunks: list[Optional[dict]] = []      # chunk per row, None = dead
+        self.live = bytearray()     # 1 per live row; viewed as a bool mask at search time
+        self.files: dict[str, tuple[str, int, int]] = {}    # filename → (digest, start, count)
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.persist = True
+        self.loaded = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def _log(self) -> Path:
+        return self.path.with_suffix(".jsonl")
+
+    def _data(self, gen: int) -> Path:
+        return self.path.with_suffix(f".{gen}.f32")
+
+    @staticmethod
+    def _digest(chunks: list[dict]) -> str:
+        return hashlib.sha1(json.dumps([[c["section"], c["text"]] for c in chunks]).encode()).hexdigest()
+
+    def add(self, filename: str, chunks: list[dict]) -> None:
+        digest = self._digest(chunks)
+        with self._lock:
+            if self.files.get(filename, ("",))[0] == digest:
+                return      # unchanged since it was persisted
+        vectors = np.stack([embed_text(f"{c['section']} {c['text']}", self.dim) for c in chunks]) \
+            if chunks else np.zeros((0, self.dim), dtype=np.float32)
+        with self._lock:
+            self._kill(filename)
+            start = self._append_rows(vectors)
+            self.files[filename] = (digest, start, len(chunks))
+            self.row_chunks.extend(chunks)
+            self.live.extend(b"\x01" * len(chunks))
+            self._log_record({"file": filename, "digest": digest, "start": start, "chunks": chunks})
+            self._maybe_compact()
+
+    def remove(self, filename: str) -> None:
+        with self._lock:
+            if self._kill(filename):
+                self._log_record({"drop": filename})
+                self._maybe_compact()
+
+    def prune(self, keep: set[str]) -> None:
+        """Drop persisted files that are no longer uploads (deleted while this process was down)."""
+        for filename in [f for f in list(self.files) if f not in keep]:
+            self.remove(filename)
+
+    def _kill(self, filename: str) -> bool:
+        entry = self.files.pop(filename, None)
+        if entry is None:
+            return False
+        _, start, count = entry
+        self.row_chunks[start:start + count] = [None] * count
+        self.live[start:start + count] = bytes(count)
+        return True
+
+    def _append_rows(self, vectors: "np.ndarray") -> int:
+        start = self.rows
+        if self.persist:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self._data(self.gen), "ab") as f:
+                    f.write(np.ascontiguousarray(vectors, dtype="<f4").tobytes())
+                self.rows += len(vectors)
+                self._map()
+                return start
+            except OSError as e:
+                print(f"Vector index persist error (kept in memory): {e}")
+                self.persist = False
+                self.matrix = np.array(self.matrix)
+        self.matrix = np.concatenate([self.matrix, vectors.astype(np.float32)])
+        self.rows += len(vectors)
+        return start
+
+    def _map(self) -> None:
+        self.matrix = np.memmap(self._data(self.gen), dtype="<f4", mode="r", shape=(self.rows, self.dim)) \
+            if self.rows else np.zeros((0, self.dim), dtype=np.float32)
+
+    def _log_record(self, record: dict) -> None:
+        if not self.persist:
+            return
+        try:
+            with open(self._log, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Vector index log error (kept in memory): {e}")
+            self.persist = False
+            self.matrix = np.array(self.matrix)
+
+    def _maybe_compact(self) -> None:
+        dead = self.rows - self.live.count(1)
+        if dead > max(self.MIN_COMPACT_ROWS, self.rows - dead):
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite live rows into the next generation; the log swap is the commit point."""
+        order = sorted(self.files.items(), key=lambda kv: kv[1][1])
+        keep = np.concatenate([np.arange(s, s + n) for _, (_, s, n) in order]) if order else np.zeros(0, int)
+        matrix = np.ascontiguousarray(self.matrix[keep], dtype="<f4")
+        files, row_chunks, start = {}, [], 0
+        for filename, (digest, s, n) in order:
+            files[filename] = (digest, start, n)
+            row_chunks.extend(self.row_chunks[s:s + n])
+            start += n
+        old_gen = self.gen
+        if self.persist:
+            try:
+                self._data(old_gen + 1).write_bytes(matrix.tobytes())
+                tmp = self._log.with_name(self._log.name + ".tmp")
+                with open(tmp, "w") as f:
+                    f.write(json.dumps({"version": self.VERSION, "dim": self.dim, "gen": old_gen + 1}) + "\n")
+                    for filename, (digest, s, n) in files.items():
+                        f.write(json.dumps({"file": filename, "digest": digest, "start": s,
+                                            "chunks": row_chunks[s:s + n]}) + "\n")
+                os.replace(tmp, self._log)
+                self.gen = old_gen + 1
+                self._data(old_gen).unlink(missing_ok=True)
+            except OSError as e:
+                print(f"Vector index compaction error (kept in memory): {e}")
+                self.persist = False
+        self.files, self.row_chunks, self.rows = files, row_chunks, len(row_chunks)
+        self.live = bytearray(b"\x01" * self.rows)
+        if self.persist:
+            self._map()
+        else:
+            self.matrix = np.array(matrix, dtype=np.float32)
+
+    def _load(self) -> None:
+        """Replay the log and map the data file; anything inconsistent starts a fresh index."""
+        try:
+            lines = self._log.read_text().splitlines()
+        except OSError:
+            lines = []
+        try:
+            header = json.loads(lines[0]) if lines else {}
+            if header.get("version") != self.VERSION or header.get("dim") != self.dim:
+                raise ValueError("no index or stale format")
+            self.gen = header["gen"]
+            data = self._data(self.gen)
+            row_bytes = 4 * self.dim
+            size = data.stat().st_size
+            if size % row_bytes:        # torn final append
+                os.truncate(data, size - size % row_bytes)
+            self.rows = size // row_bytes
+            self.row_chunks = [None] * self.rows
+            self.live = bytearray(self.rows)
+            for line in lines[1:]:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break               # torn final log line
+                if "drop" in rec:
+                    self._kill(rec["drop"])
+                    continue
+                start, chunks = rec["start"], rec["chunks"]
+                if start + len(chunks) > self.rows:
+                    break
+                self._kill(rec["file"])
+                self.files[rec["file"]] = (rec["digest"], start, len(chunks))
+                self.row_chunks[start:start + len(chunks)] = chunks
+                self.live[start:start + len(chunks)] = b"\x01" * len(chunks)
+            self._map()
+            self.loaded = len(self.files)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if lines:
+                print(f"Vector index not loaded, starting fresh: {e}")
+            self._reset()
+
+    def _reset(self) -> None:
+        self.files, self.row_chunks, self.live, self.rows = {}, [], bytearray(), 0
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.gen += 1
+            self._data(self.gen).write_bytes(b"")
+            self._log.write_text(json.dumps({"version": self.VERSION, "dim": self.dim, "gen": self.gen}) + "\n")
+            for stale in [*self.path.parent.glob(f"{self.path.name}.*.f32"), self.path.with_suffix(".npy")]:
+                if stale != self._data(self.gen):
+                    stale.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"Vector index persist error (kept in memory): {e}")
+            self.persist = False
+
+    def search(self, query: str, k: int) -> list[tuple[float, dict]]:
+        """Top-k (cosine, chunk) pairs, best first."""
+        q = embed_text(query, self.dim)
+        with self._lock:
+            n = len(self.files) and self.rows
+            if not n or not q.any():
+                return []
+            sims = np.asarray(self.matrix @ q)
+            sims[~np.frombuffer(self.live, dtype=bool)] = -np.inf
+            top = np.argpartition(-sims, k - 1)[:k] if k < n else np.arange(n)
+            top = top[np.argsort(-sims[top])]
+            return [(round(float(sims[i]), 3), self.row_chunks[i]) for i in top if sims[i] > 0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            live = self.live.count(1)
+            return {"chunks": live, "dead_rows": self.rows - live, "files": len(self.files),
+                    "loaded_files": self.loaded, "dim": self.dim, "generation": self.gen,
+                    "mmap": isinstance(self.matrix, np.memmap), "bytes": int(self.matrix.nbytes)}
+
+
+_vector_index = VectorIndex(UPLOAD_DIR / ".vectors" / "chunks", UPLOAD_VECTOR_DIM) \
+    if NUMPY_OK and not _SPAWNED_CHILD else None
+
+
+def search_upload_chunks(question: str, k: int) -> list[tuple[float, dict]]:
+    """Hybrid retrieval: max-normalised BM25 and cosine scores blended by UPLOAD_DENSE_WEIGHT.
+
+    Weight 0 is BM25 only, 1 is dense only; without NumPy it is always BM25.
+    """
+    weight = UPLOAD_DENSE_WEIGHT if _vector_index is not None else 0.0
+    pool = max(k * 3, k)
+    ranked: dict[tuple[str, str], list] = {}
+    for source_weight, hits in (
+        (1.0 - weight, _chunk_index.search(question, pool) if weight < 1.0 else []),
+        (weight, _vector_index.search(question, pool) if weight > 0.0 else []),
+    ):
+        top = hits[0][0] if hits else 0.0
+        for score, chunk in hits:
+            slot = ranked.setdefault((chunk["filename"], chunk["section"]), [0.0, chunk])
+            slot[0] += source_weight * (score / top if top else 0.0)
+    best = sorted(ranked.values(), key=lambda sc: sc[0], reverse=True)[:k]
+    return [(round(score, 3), chunk) for score, chunk in best if score > 0]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# UPLOAD TABLES  (typed columnar tables from sheets / CSVs, local SQLite SQL)
+# ══════════════════════════════════════════════════════════════════════════════
+# Each Excel sheet / CSV becomes a ColumnarTable: one typed array per column
+# (INTEGER → array('q'), REAL → array('d') with NaN for blanks, TEXT → list).
+# Tables are registered in an in-memory SQLite database, so aggregate questions
+# over uploads ("total ACV by competitor") run as local SQL and only the result
+# rows reach the answer model.
+
+class ColumnarTable:
+    """One upload table, stored column-major with array-backed typed columns."""
+
+    def __init__(self, spec: dict, filename: str):
+        self.name = spec["name"]
+        self.filename = filename
+        self.sheet = spec.get("sheet", "")
+        self.columns: list[dict] = spec["columns"]
+        self.rows = spec["rows"]
+        self.truncated = spec.get("truncated", False)
+        self.data: list = []
+        for col, values in zip(self.columns, spec["data"]):
+            if isinstance(values, array.array):     # decoded from the parse cache's .cols file
+                if values.typecode == "d":
+                    col["type"] = "REAL"
+                self.data.append(values)
+            elif col["type"] == "INTEGER" and None not in values:
+                self.data.append(array.array("q", values))
+            elif col["type"] in ("INTEGER", "REAL"):
+                col["type"] = "REAL"
+                self.data.append(array.array("d", (math.nan if v is None else float(v) for v in values)))
+            else:
+                self.data.append(values)
+
+    def iter_rows(self):
+        for row in zip(*self.data):
+            yield tuple(None if isinstance(v, float) and math.isnan(v) else v for v in row)
+
+    def describe(self, sample_rows: int = 3) -> str:
+        cols = ", ".join(f"{c['name']} {c['type']}" for c in self.columns)
+        where = f"{self.filename}" + (f" [Sheet: {self.sheet}]" if self.sheet else "")
+        lines = [f"TABLE {self.name}  -- {where}, {self.rows} rows{' (truncated)' if self.truncated else ''}",
+                 f"  {cols}"]
+        for _, row in zip(range(sample_rows), self.iter_rows()):
+            lines.append("  e.g. " + json.dumps(dict(zip((c["name"] for c in self.columns), row)), default=str))
+        return "\n".join(lines)
+
+
+class UploadTableStore:
+    """In-memory SQLite engine over every registered upload table (read-only to queries)."""
+
+    def __init__(self, timeout_s: float):
+        self.timeout_s = timeout_s
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.tables: dict[str, ColumnarTable] = {}
+        self.queries = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def register(self, filename: str, specs: list[dict]) -> None:
+        with self._lock:
+            self._drop(filename)
+            for spec in specs:
+                table = ColumnarTable(spec, filename)
+                table.name = self._unique_name(table.name, filename, table.sheet)
+                cols = ", ".join(f'"{c["name"]}" {c["type"]}' for c in table.columns)
+                self.conn.execute(f'DROP TABLE IF EXISTS "{table.name}"')
+                self.conn.execute(f'CREATE TABLE "{table.name}" ({cols})')
+                marks = ", ".join("?" for _ in table.columns)
+                self.conn.executemany(f'INSERT INTO "{table.name}" VALUES ({marks})', table.iter_rows())
+                self.tables[table.name] = table
+            self.conn.commit()
+
+    def drop(self, filename: str) -> None:
+        with self._lock:
+            self._drop(filename)
+            self.conn.commit()
+
+    def _unique_name(self, name: str, filename: str, sheet: str) -> str:
+        """Names come from the file stem, so q3.csv / Q3.csv (or same-bytes copies) collide;
+        a later file gets a short digest of its own name rather than replacing the first."""
+        if name not in self.tables:
+            return name
+        tag = hashlib.sha256(f"{filename}\0{sheet}".encode()).hexdigest()
+        return f"{name}_{tag[:8]}" if f"{name}_{tag[:8]}" not in self.tables else f"{name}_{tag}"
+
+    def _drop(self, filename: str) -> None:
+        for name in [n for n, t in self.tables.items() if t.filename == filename]:
+            self.conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+            del self.tables[name]
+
+    def has_tables(self) -> bool:
+        return bool(self.tables)
+
+    def schema_text(self) -> str:
+        with self._lock:
+            return "\n".join(t.describe() for t in self.tables.values()) or "(none)"
+
+    def query(self, sql: str, max_rows: int = 500) -> tuple[list[str], list[tuple]]:
+        """Run one read-only SELECT; aborts after timeout_s. Returns (columns, rows)."""
+        sql = sql.strip().rstrip(";").strip()
+        if not re.match(r"(?is)^(select|with)\b", sql) or ";" in sql:
+            raise ValueError("only a single SELECT statement is allowed")
+        deadline = time.monotonic() + self.timeout_s
+        with self._lock:
+            self.queries += 1
+            self.conn.execute("PRAGMA query_only = ON")
+            self.conn.set_progress_handler(lambda: time.monotonic() > deadline, 10_000)
+            try:
+                cur = self.conn.execute(sql)
+                rows = cur.fetchmany(max_rows)
+                return [d[0] for d in cur.description or []], rows
+            except sqlite3.Error:
+                self.errors += 1
+                raise
+            finally:
+                self.conn.set_progress_handler(None, 0)
+                self.conn.execute("PRAGMA query_only = OFF")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"tables": len(self.tables), "rows": sum(t.rows for t in self.tables.values()),
+                    "queries": self.queries, "errors": self.errors}
+
+
+_upload_tables = UploadTableStore(UPLOAD_SQL_TIMEOUT_S)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# STAGE 1a: FAST-PATH ROUTER  (local classifier — no LLM round trip)
+# ══════════════════════════════════════════════════════════════════════════════
+# Compiled once from data_dictionary.yaml (use_when, example_questions,
+# disambiguation phrases, intent_tag) plus the BQ_SCHEMA column names.
+# A question is routed locally only when nearly all of its content words are
+# known warehouse vocabulary and it matches a dictionary entry; anything that
+# looks like a follow-up or could touch the uploads goes to Gemini Flash.
+# Tables are ranked first (table entry + its best column), so a column shared
+# by several tables ("status", "arr_usd") takes the intent of the table the
+# rest of the question points at; two close tables that disagree on the
+# intent go to Gemini.
+
+_TABLE_TIE = 0.9        # runner-up table within this fraction of the best → ambiguous
+
+_STOPWORDS = frozenset("""
+a an the is are was were be been do does did have has had what whats which who whom whose
+how many much our we us you your i me my show list give tell and or of in on for to by per
+with from at as than vs versus all any each every latest total top most least
+more less this these there their they them it its that those about across between can could
+would should get
+""".split())
+
+# Aggregation / ordering words — neutral for routing, never count as unknown.
+_ANALYTIC_WORDS = frozenset("""
+average avg sum count number mean median trend month monthly year yearly quarter breakdown over
+time below above under greater highest lowest max min maximum minimum sort rank detail info
+""".split())
+
+_FOLLOWUP_REFS = frozenset("they them their theirs it its that those these he she his her same".split())
+
+_UPLOAD_CUES = frozenset("""
+upload uploaded file document doc pdf excel spreadsheet sheet word csv deck report board policy
+playbook memo slide
+""".split())
+
+
+def _stem(word: str) -> str:
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) > len(suffix) + 3 and word.endswith(suffix):
+            return word[: -len(suffix)]
+    return word
+
+
+def _route_tokens(text: str) -> list[str]:
+    return [_stem(w) for w in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+def _strip_proper_nouns(text: str) -> str:
+    """Drop mid-sentence Capitalized words (customer names in example questions); keep ACRONYMS."""
+    words = text.split()
+    return " ".join(words[:1] + [w for w in words[1:] if not (w[:1].isupper() and not w.isupper())])
+
+
+def _content_tokens(text: str) -> list[str]:
+    return [w for w in _route_tokens(text) if w not in _STOPWORDS]
+
+
+class TfidfIndex:
+    """Tiny in-memory TF-IDF index: cosine nearest neighbour over token lists."""
+
+    def __init__(self, docs: list[list[str]]):
+        df: dict[str, int] = {}
+        for doc in docs:
+            for w in set(doc):
+                df[w] = df.get(w, 0) + 1
+        n = len(docs)
+        self.idf = {w: math.log(1 + n / c) for w, c in df.items()}
+        self.vocab = frozenset(df)
+        self.doc_vecs = [self.vector(doc) for doc in docs]
+
+    def vector(self, words: list[str]) -> dict[str, float]:
+        counts: dict[str, int] = {}
+        for w in words:
+            counts[w] = counts.get(w, 0) + 1
+        vec = {w: (1 + math.log(c)) * self.idf.get(w, 0.0) for w, c in counts.items()}
+        norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+        return {w: v / norm for w, v in vec.items()}
+
+    def scores(self, words: list[str]) -> list[float]:
+        """Cosine similarity of every document to the query."""
+        qvec = self.vector(words)
+        return [sum(v * dvec.get(w, 0.0) for w, v in qvec.items()) for dvec in self.doc_vecs]
+
+    def best(self, words: list[str]) -> tuple[int, float]:
+        """(doc index, cosine similarity) of the closest document."""
+        best_i, best_sim = 0, 0.0
+        for i, sim in enumerate(self.scores(words)):
+            if sim > best_sim:
+                best_i, best_sim = i, sim
+        return best_i, best_sim
+
+
+class FastRouter:
+    """TF-IDF nearest-entry classifier over the data dictionary."""
+
+    def __init__(self, spec: dict, tables: dict[str, list[tuple[str, str, str]]], semantic: "SemanticLayer"):
+        self.entries: list[tuple[str, Optional[str], str]] = []   # (table, column, intent_tag)
+        docs: list[list[str]] = []
+        spec_tables = spec.get("tables") or {}
+        rules = spec.get("disambiguation_rules") or []
+
+        for table, columns in tables.items():
+            tspec = spec_tables.get(table) or {}
+            t_intent = tspec.get("intent_tag", "other")
+            self.entries.append((table, None, t_intent))
+            docs.append(self._content(f"{table.replace('_', ' ')} {tspec.get('description', '')}"))
+            for col, _, comment in columns:
+                # Columns repeated across tables (seats_contracted, arr_usd…) borrow
+                # the dictionary entry of their first documented namesake.
+                cspec = (tspec.get("columns") or {}).get(col) or next(
+                    (t["columns"][col] for t in spec_tables.values() if col in (t.get("columns") or {})), {}
+                )
+                parts = [col.replace("_", " "), comment, cspec.get("definition", ""), cspec.get("use_when", "")]
+                parts += [_strip_proper_nouns(q) for q in cspec.get("example_questions") or []]
+                parts += [r["phrase"] for r in rules if str(r.get("interpret_as", "")).split()[:1] == [col]]
+                self.entries.append((table, col, cspec.get("intent_tag", t_intent)))
+                docs.append(self._content(" ".join(parts)))
+
+        self.index = TfidfIndex(docs)
+        self.vocab = self.index.vocab
+        self.semantic = semantic
+        self.table_entries = {t: i for i, (t, c, _) in enumerate(self.entries) if c is None}
+        self.routed = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def _content(text: str) -> list[str]:
+        return _content_tokens(text)
+
+    def _entity_words(self, question: str) -> set[str]:
+        """Proper nouns (customer names, promo codes) and numbers — excluded from coverage."""
+        out = set()
+        for i, word in enumerate(re.findall(r"[A-Za-z0-9][A-Za-z0-9'-]*", question)):
+            for part in re.findall(r"[a-z0-9]+", word.lower()):
+                stem = _stem(part)
+                if any(ch.isdigit() for ch in stem) or (i > 0 and word[0].isupper() and stem not in self.vocab):
+                    out.add(stem)
+        return out
+
+    def classify(self, question: str, history: list[dict], upload_names: list[str]) -> tuple[Optional[dict], float]:
+        """Return (decision, confidence); decision is None when Gemini should route."""
+        words = _route_tokens(question)
+        if history and _FOLLOWUP_REFS.intersection(words):
+            return None, 0.0
+        if upload_names:
+            upload_vocab = _UPLOAD_CUES.union(*(_route_tokens(Path(n).stem) for n in upload_names))
+            if upload_vocab.intersection(words):
+                return None, 0.0
+
+        entities = self._entity_words(question)
+        content = [w for w in words if w not in _STOPWORDS and w not in _ANALYTIC_WORDS and w not in entities]
+        if not content:
+            return None, 0.0
+        coverage = sum(w in self.vocab for w in content) / len(content)
+
+        scores = self.index.scores(content)
+        best_sim = max(scores, default=0.0)
+        confidence = round(0.6 * coverage + 0.4 * min(1.0, best_sim / 0.3), 3)
+        if confidence < ROUTER_FASTPATH_MIN_CONF or best_sim == 0.0:
+            return None, confidence
+
+        best_i = self._best_entry(scores)
+        if best_i is None:
+            return None, confidence
+        table, column, intent_tag = self.entries[best_i]
+        matched = f"{table}.{column}" if column else table
+        metric = self.semantic.match(question, entities)
+        return {
+            "sources": ["bigquery"],
+            "needs_sql": True,
+            "sql_intent": question,
+            "query_type": "single_source",
+            "intent_tag": intent_tag,
+            "metric": metric,
+            "reasoning": f"fast-path: matched {metric or matched} in the data dictionary (confidence {confidence:.2f})",
+            "router": "fast_path",
+        }, confidence
+
+    def _best_entry(self, scores: list[float]) -> Optional[int]:
+        """Best entry of the best table; None when the top two tables are close and
+        their best entries carry different intents."""
+        best: dict[str, int] = {}                 # table → its best entry
+        for i, (table, _, _) in enumerate(self.entries):
+            if table not in best or scores[i] > scores[best[table]]:
+                best[table] = i
+        ranked = sorted(best, key=lambda t: -self._table_score(t, scores))
+        top = ranked[0]
+        if len(ranked) > 1:
+            runner_up = ranked[1]
+            close = self._table_score(runner_up, scores) >= _TABLE_TIE * self._table_score(top, scores)
+            if close and self.entries[best[runner_up]][2] != self.entries[best[top]][2]:
+                return None
+        return best[top]
+
+    def _table_score(self, table: str, scores: list[float]) -> float:
+        """Similarity to the table entry plus its best column."""
+        columns = [s for s, (t, c, _) in zip(scores, self.entries) if t == table and c is not None]
+        return scores[self.table_entries[table]] + max(columns, default=0.0)
+
+    def stats(self) -> dict:
+        return {"enabled": ROUTER_FASTPATH, "min_confidence": ROUTER_FASTPATH_MIN_CONF,
+                "routed": self.routed, "fallbacks": self.fallbacks}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# SEMANTIC METRIC LAYER  (dictionary metrics → parameterized SQL, no LLM)
+# ══════════════════════════════════════════════════════════════════════════════
+# The `metrics:` / `dimensions:` sections of data_dictionary.yaml encode the
+# canonical definitions (arr_usd vs arr_bookings_usd, Active + At-Risk as
+# "current", …). A question mapped to one of them compiles to a fixed SQL
+# template: dimension values become @query parameters, "by <dimension>"
+# becomes GROUP BY. Template SQL is trusted — no generation call, no dry-run —
+# so a question scoped to a period the template can't express, missing all
+# of a metric's metric_words, asking for a different aggregate ("average
+# resolution time" of a COUNT metric) or naming a value that contradicts a
+# fixed filter ("resolved" tickets of open_tickets), is never matched.
+
+# Aggregate a question asks for → which metric kinds may answer it. "total number
+# of" is a count, so a count word overrides "total".
+_MEASURE_WORDS = {
+    "count":    re.compile(r"\b(?:how many|number of|count)\b", re.IGNORECASE),
+    "average":  re.compile(r"\b(?:average|avg|mean|median|typical)\b", re.IGNORECASE),
+    "duration": re.compile(r"\b(?:how long|duration|hours|(?:resolution|response|handling) times?)\b", re.IGNORECASE),
+    "sum":      re.compile(r"\b(?:total|sum|how much)\b", re.IGNORECASE),
+}
+_MEASURES_ALLOWED = {"count": {"count"}, "sum": {"sum"}, "list": {"count"}}
+
+_MONTHS = "january february march april june july august september october november december".split()
+_PERIOD_RE = re.compile(
+    r"\b(?:(?:last|previous|prior|this|past|next)\s+(?:\d+\s+)?(?:day|week|month|quarter|year|fy|fiscal year)s?"
+    r"|(?:19|20)\d{2}|q[1-4]|h[12]|[ymq]td|since|ago"
+    r"|in\s+(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*"
+    r"|" + "|".join(_MONTHS) + r")\b",
+    re.IGNORECASE,
+)
+
+
+class SemanticLayer:
+    """Compiles dictionary-defined metrics into parameterized BigQuery SQL."""
+
+    def __init__(self, spec: dict):
+        self.metrics: dict[str, dict] = spec.get("metrics") or {}
+        self.dimensions: dict[str, dict] = spec.get("dimensions") or {}
+        self.names = list(self.metrics)
+        self.index = TfidfIndex([
+            self._tokens(" ".join(
+                [name.replace("_", " "), m.get("description", "")]
+                + [d.replace("_", " ") for d in m.get("dimensions") or []]
+                + [_strip_proper_nouns(q) for q in m.get("example_questions") or []]
+            ))
+            for name, m in self.metrics.items()
+        ])
+        self.compiled = 0
+
+    @staticmethod
+    def _tokens(text: str) -> list[str]:
+        """Content tokens, with "how many" / "number of" folded into a `count` token."""
+        words = _content_tokens(text)
+        if re.search(r"\bhow many\b|\bnumber of\b", text.lower()):
+            words.append("count")
+        return words
+
+    def catalog(self) -> str:
+        """One line per metric — for the LLM router prompt."""
+        return "\n".join(f"  {n}: {m.get('description', '').strip()}" for n, m in self.metrics.items()) or "  (none)"
+
+    def _dimension_values(self, metric: dict) -> dict[str, list[str]]:
+        return {d: self.dimensions.get(d, {}).get("values") or [] for d in metric.get("dimensions") or []}
+
+    def match(self, question: str, entities: set[str]) -> Optional[str]:
+        """Best metric for the question, or None if nothing is close enough or it names entities we can't bind."""
+        if not self.metrics:
+            return None
+        if _PERIOD_RE.search(question):
+            return None         # time-scoped — the templates have no date filter
+        i, sim = self.index.best(self._tokens(question))
+        if sim < METRIC_MIN_SIM:
+            return None
+        name = self.names[i]
+        metric = self.metrics[name]
+        words = set(_route_tokens(question))
+        required = metric.get("metric_words") or []
+        if required and not any(set(_route_tokens(w)) <= words for w in required):
+            return None
+        asked = {kind for kind, rx in _MEASURE_WORDS.items() if rx.search(question)}
+        if "count" in asked:
+            asked.discard("sum")
+        if asked - _MEASURES_ALLOWED[self._kind(metric)]:
+            return None         # a different aggregate than the template computes
+        counted = metric.get("counts")
+        if counted and "count" in asked:
+            # "how many customers have open tickets" counts customers, not tickets
+            m = _MEASURE_WORDS["count"].search(question)
+            following = set(_route_tokens(question[m.end():])[:3])
+            if not any(set(_route_tokens(w)) <= following for w in counted):
+                return None
+        bound = {
+            w for values in self._dimension_values(metric).values()
+            for v in values for w in _route_tokens(v)
+        }
+        if not entities <= bound:
+            return None
+        # A dimension value the metric can neither filter on nor already fixes
+        # ("how many *churned* customers" vs current_customer_count) → not this metric.
+        # A value of a column the metric's filters already fix must be one the filter keeps
+        # ("resolved tickets" vs status IN ('Open', 'Escalated')).
+        fixed = " ".join(metric.get("filters") or [])
+        for dim, dspec in self.dimensions.items():
+            pinned = re.search(rf"\b{re.escape(dspec.get('column', dim))}\b", fixed)
+            if dim in (metric.get("dimensions") or []) and not pinned:
+                continue
+            for value in dspec.get("values") or []:
+                if self._mentions(question, value) and not self._mentions(fixed, value):
+                    return None
+        return name
+
+    @staticmethod
+    def _kind(metric: dict) -> str:
+        """count | sum (any other aggregate measure) | list (row-listing metric)."""
+        if "measure" not in metric:
+            return "list"
+        return "count" if metric["measure"].strip().upper().startswith("COUNT(") else "sum"
+
+    @staticmethod
+    def _mentions(text: str, value: str) -> bool:
+        norm = lambda t: " " + re.sub(r"[-_]", " ", t.lower()) + " "
+        return re.search(rf"(?<!\w){re.escape(norm(value).strip())}s?(?!\w)", norm(text)) is not None
+
+    def can_compile(self, name: str, question: str, entities: set[str]) -> bool:
+        """Whether the metric path will answer this question: match() agrees on `name` and the
+        template can express it. No side effects — speculation asks this on every routed request."""
+        return self.match(question, entities) == name and self._build(name, question) is not None
+
+    def compile(self, name: str, question: str) -> Optional[tuple[str, dict[str, str]]]:
+        """(sql, params) for the metric, or None if the question needs more than the template can express."""
+        compiled = self._build(name, question)
+        if compiled:
+            self.compiled += 1
+        return compiled
+
+    def _build(self, name: str, question: str) -> Optional[tuple[str, dict[str, str]]]:
+        metric = self.metrics.get(name)
+        if not metric:
+            return None
+        q = f" {question.lower()} "
+        table = f"`{GCP_PROJECT}.{BQ_DATASET}.{metric['table']}`"
+        where = list(metric.get("filters") or [])
+        params: dict[str, str] = {}
+        group_by: list[str] = []
+
+        for dim in metric.get("dimensions") or []:
+            dspec = self.dimensions.get(dim) or {}
+            col = dspec.get("column", dim)
+            for value in dspec.get("values") or []:
+                if self._mentions(question, value):
+                    params[col] = value
+                    where.append(f"{col} = @{col}")
+                    break
+            names = [dim.replace("_", " "), col.replace("_", " ")] + list(dspec.get("aliases") or [])
+            if any(re.search(rf"\b(by|per|for each|across) {re.escape(n)}s?\b", q) for n in names):
+                group_by.append(col)
+
+        if "measure" in metric:
+            select = group_by + [f"{metric['measure']} AS {metric.get('alias', name)}"]
+            order_by = f"{metric.get('alias', name)} DESC" if group_by else None
+        else:
+            if group_by:
+                return None     # listing metrics have no aggregate to group
+            select = list(metric.get("select") or ["*"])
+            order_by = metric.get("order_by")
+
+        sql = f"SELECT {', '.join(select)}\nFROM {table}"
+        if where:
+            sql += "\nWHERE " + "\n  AND ".join(where)
+        if group_by:
+            sql += "\nGROUP BY " + ", ".join(group_by)
+        if order_by:
+            sql += f"\nORDER BY {order_by}"
+        if metric.get("limit"):
+            sql += f"\nLIMIT {int(metric['limit'])}"
+        return sql, params
+
+    def stats(self) -> dict:
+        return {"metrics": len(self.metrics), "compiled": self.compiled}
+
+
+_semantic = SemanticLayer(DATA_DICT_SPEC)
+_fast_router = FastRouter(DATA_DICT_SPEC, BQ_TABLES, _semantic)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# DICTIONARY PRUNING  (per-question schema + data dictionary for prompts)
+# ══════════════════════════════════════════════════════════════════════════════
+# data_dictionary.yaml is indexed once into tables, columns, do_not_confuse_with
+# pairs and disambiguation rules. Each prompt gets only the tables and columns
+# the question (plus recent user turns) points at — scored with the fast
+# router's TF-IDF entries — together with every column they are confused
+# with and the rules that mention them. Schema is pruned to whole TABLE
+# blocks. A question that matches nothing gets the full dictionary.
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 chars per token for English + numbers)."""
+    return (len(text) + 3) // 4
+
+
+class DictionaryIndex:
+    """Indexed data dictionary; `select()` picks what a question needs, `render_*` formats it."""
+
+    def __init__(self, spec: dict, schema: str, router: FastRouter, semantic: SemanticLayer):
+        self.spec = spec
+        self.tables: dict[str, dict] = spec.get("tables") or {}
+        self.rules: list[dict] = spec.get("disambiguation_rules") or []
+        self.metrics: dict[str, dict] = spec.get("metrics") or {}
+        self.entries = router.entries
+        self.index = router.index
+        self.semantic = semantic
+        header, *blocks = re.split(r"\n\s*\n(?=TABLE )", schema)
+        self.schema_header = header.strip()
+        self.schema_blocks = {re.match(r"TABLE (\w+)", b).group(1): b.strip() for b in blocks}
+        self.join_key = {t: any(c == "customer_id" for c, _, _ in cols) for t, cols in BQ_TABLES.items()}
+        # column → every (table, partner) it must not be confused with
+        self.confusable: dict[str, set[str]] = {}
+        for t in self.tables.values():
+            for col, cspec in (t.get("columns") or {}).items():
+                partner = (cspec or {}).get("do_not_confuse_with")
+                if partner:
+                    self.confusable.setdefault(col, set()).add(partner)
+                    self.confusable.setdefault(partner, set()).add(col)
+        self.full_tokens = estimate_tokens(DATA_DICT)
+        self._rendered = LRUCache(256)
+        self.pruned = 0
+        self.full = 0
+        self.tokens_saved = 0
+
+    def select(self, text: str) -> Optional[dict[str, set[str]]]:
+        """{table: columns} relevant to `text`, or None → use everything."""
+        if not DICT_PRUNE or not self.tables:
+            return None
+        words = [w for w in _content_tokens(text) if w not in _ANALYTIC_WORDS]
+        sims = self.index.scores(words) if words else []
+        top = max(sims, default=0.0)
+        rules = self._matched_rules(text)
+        if top < DICT_PRUNE_MIN_SIM and not rules:
+            return None
+
+        table_score: dict[str, float] = {}
+        hits: list[tuple[str, Optional[str]]] = []
+        for (table, column, _), sim in zip(self.entries, sims):
+            if sim >= top * 0.5:
+                hits.append((table, column))
+                table_score[table] = max(table_score.get(table, 0.0), sim)
+        # A matched disambiguation rule pins the column (and table) it resolves to
+        for rule in rules:
+            target = str(rule.get("interpret_as", ""))
+            on_table = re.search(r"\bon (\w+) table", target)
+            for col in re.findall(r"\w+", target):
+                owners = [t for t, cols in BQ_TABLES.items() if any(c == col for c, _, _ in cols)]
+                if on_table and on_table.group(1) in owners:
+                    owners = [on_table.group(1)]
+                for table in owners[:1]:
+                    hits.append((table, col))
+                    table_score[table] = max(table_score.get(table, 0.0), top + 1.0)
+        keep = sorted(table_score, key=lambda t: -table_score[t])[:DICT_PRUNE_MAX_TABLES]
+
+        selection: dict[str, set[str]] = {t: set() for t in keep}
+        for table, column in hits:
+            if table not in selection:
+                continue
+            if column is None:              # the table itself matched → all its documented columns
+                selection[table].update((self.tables.get(table) or {}).get("columns") or {})
+            else:
+                selection[table].add(column)
+        # Confusable partners ride along, in the same table when it has them
+        for table, cols in selection.items():
+            documented = (self.tables.get(table) or {}).get("columns") or {}
+            for col in list(cols):
+                for partner in self.confusable.get(col, ()):
+                    if partner in documented or any(partner == c for c, _, _ in BQ_TABLES.get(table, [])):
+                        cols.add(partner)
+        return selection
+
+    def _matched_rules(self, text: str) -> list[dict]:
+        """Rules with a phrase alternative ("a / b / c") whose words all appear in `text`."""
+        words = set(_route_tokens(text))
+        out = []
+        for rule in self.rules:
+            for alt in str(rule.get("phrase", "")).split("/"):
+                alt_words = set(_route_tokens(alt))
+                if alt_words and alt_words <= words:
+                    out.append(rule)
+                    break
+        return out
+
+    def _rules_for(self, selection: dict[str, set[str]], text: str) -> list[dict]:
+        cols = set().union(*selection.values()) if selection else set()
+        matched = self._matched_rules(text)
+        return [r for r in self.rules
+                if r in matched or str(r.get("interpret_as", "")).split()[:1] in ([c] for c in cols)]
+
+    def render_dictionary(self, selection: Optional[dict[str, set[str]]], text: str = "",
+                          examples: bool = True) -> str:
+        """Pruned dictionary as YAML; `examples=False` also drops example questions."""
+        if selection is None and examples:
+            return DATA_DICT
+        drop = {"intent_tag"} if examples else {"intent_tag", "example_questions"}
+
+        def clean(node):
+            if isinstance(node, dict):
+                return {k: clean(v) for k, v in node.items() if k not in drop}
+            if isinstance(node, list):
+                return [clean(v) for v in node]
+            return " ".join(node.split()) if isinstance(node, str) else node
+
+        if selection is None:
+            key = ("full", examples)
+        else:
+            rules = self._rules_for(selection, text)
+            metric_names = []
+            if self.metrics:
+                sims = self.semantic.index.scores(self.semantic._tokens(text))
+                metric_names = [n for n, sim in zip(self.semantic.names, sims)
+                                if sim >= METRIC_MIN_SIM and self.metrics[n].get("table") in selection]
+            key = (tuple(sorted((t, tuple(sorted(c))) for t, c in selection.items())),
+                   tuple(self.rules.index(r) for r in rules), tuple(metric_names), examples)
+        # YAML dumping costs milliseconds on the event loop; selections repeat, so renders are memoized
+        cached = self._rendered.get(key)
+        if cached is not None:
+            return cached
+        if selection is None:
+            text_out = yaml.safe_dump(clean(self.spec), sort_keys=False, width=1000, allow_unicode=True)
+            self._rendered.put(key, text_out)
+            return text_out
+        tables = {}
+        for table, cols in selection.items():
+            tspec = self.tables.get(table) or {}
+            documented = tspec.get("columns") or {}
+            tables[table] = {"description": tspec.get("description", "")}
+            picked = {c: documented[c] for c in documented if c in cols}
+            if picked:
+                tables[table]["columns"] = picked
+        out = {"schema_description": self.spec.get("schema_description", ""), "tables": tables}
+        if rules:
+            out["disambiguation_rules"] = rules
+        if metric_names:
+            out["metrics"] = {
+                n: {k: v for k, v in (("description", self.metrics[n].get("description", "")),
+                                      ("filters", self.metrics[n].get("filters"))) if v}
+                for n in metric_names
+            }
+        if self.spec.get("grounding_rules"):
+            out["grounding_rules"] = self.spec["grounding_rules"]
+        text_out = yaml.safe_dump(clean(out), sort_keys=False, width=1000, allow_unicode=True)
+        self._rendered.put(key, text_out)
+        return text_out
+
+    def render_schema(self, selection: Optional[dict[str, set[str]]]) -> str:
+        """BQ_SCHEMA restricted to the selected tables (customers added as the join hub for names)."""
+        if selection is None:
+            return BQ_SCHEMA
+        tables = [t for t in self.schema_blocks if t in selection
+                  or (t == "customers" and any(self.join_key.get(s) for s in selection))]
+        return "\n\n".join([self.schema_header] + [self.schema_blocks[t] for t in tables])
+
+    def for_question(self, text: str) -> tuple[str, str]:
+        """(schema, dictionary) for a prompt about `text`; counts savings."""
+        selection = self.select(text)
+        dictionary = self.render_dictionary(selection, text)
+        self.record(selection, dictionary)
+        return self.render_schema(selection), dictionary
+
+    def record(self, selection: Optional[dict[str, set[str]]], dictionary: str) -> None:
+        if selection is None:
+            self.full += 1
+        else:
+            self.pruned += 1
+            self.tokens_saved += max(0, self.full_tokens - estimate_tokens(dictionary))
+
+    def stats(self) -> dict:
+        return {"enabled": DICT_PRUNE, "pruned": self.pruned, "full": self.full,
+                "full_tokens": self.full_tokens, "tokens_saved": self.tokens_saved}
+
+
+def _prune_text(question: str, history: list[dict]) -> str:
+    """Question plus recent user turns — follow-ups ("what about them?") keep their tables."""
+    recent = [m["content"] for m in history[-ROUTER_HISTORY_WIN:] if m.get("role") == "user"]
+    return " ".join(recent + [question])
+
+
+_dictionary = DictionaryIndex(DATA_DICT_SPEC, BQ_SCHEMA, _fast_router, _semantic)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # STAGE 1: AI ROUTER
 # ══════════════════════════════════════════════════════════════════════════════
@@ -376,6 +2380,9 @@ BigQuery schema summary:
 
 Uploads currently indexed: {uploads_manifest}
 
+Upload tables (spreadsheet / CSV rows, queryable with local SQL):
+{upload_tables}
+
 Conversation history (last {history_window} turns):
 {history}
 
@@ -388,20 +2395,49 @@ Respond ONLY with valid JSON, no markdown, no explanation:
   "sql_intent": "one sentence describing what SQL should retrieve, or null if needs_sql is false",
   "query_type": "single_source | multi_source | followup | upload_only",
   "intent_tag": "revenue | pipeline | churn | policy | pricing | account_health | usage | save_playbook | comparison | other",
+  "metric": "name of a canonical metric below if the question asks exactly for it, else null",
+  "upload_sql": "one sentence describing the aggregate / filter to run over the upload tables, or null",
   "reasoning": "one sentence why these sources were selected"
 }}
 
+Canonical metrics (optionally filtered or grouped by tier, region, owner, severity…):
+{metric_catalog}
+
 Rules:
 - Include only the sources actually needed. Do not include all sources by default.
 - needs_sql is true only if bigquery is in sources.
 - uploaded should be included if any uploaded files exist AND the question could be answered by them.
 - For followup questions, look at history to determine correct sources.
 - bigquery is the default for any question about customers, revenue, ARR, seats, health scores, support.
-- uploaded covers any question that could be answered by the user's uploaded files."""
-
+- uploaded covers any question that could be answered by the user's uploaded files.
+- Set upload_sql (and include uploaded) only when the question counts, sums, averages, ranks or filters
+  rows of an upload table listed above; leave it null for questions about document prose."""
+
+
+def _router_cache_key(question: str, history: list[dict]) -> tuple:
+    """Normalized question + router history window + upload manifest fingerprint."""
+    norm_q = " ".join(question.lower().split()).rstrip("?!. ")
+    window = tuple((m["role"], m["content"]) for m in history[-ROUTER_HISTORY_WIN:])
+    return (norm_q, window, _uploads_fingerprint())
+
+
+async def run_router(
+    question: str, history: list[dict], on_llm_route: Optional[Callable[[], None]] = None
+) -> dict:
+    """Stage 1: AI router using Gemini Flash. Fast and cheap.
+
+    High-confidence questions are routed locally by the fast-path classifier.
+    LLM decisions are cached per (question, history window, upload manifest);
+    fallback decisions are never cached. `on_llm_route` fires just before a
+    real Gemini round trip — the hook speculative SQL generation starts from.
+    """
+    if ROUTER_FASTPATH:
+        decision, _ = _fast_router.classify(question, history, [f["filename"] for f in _upload_index])
+        if decision is not None:
+            _fast_router.routed += 1
+            return decision
+        _fast_router.fallbacks += 1
 
-async def run_router(question: str, history: list[dict]) -> dict:
-    """Stage 1: AI router using Gemini Flash. Fast and cheap."""
     if not GENAI_OK:
         return {
             "sources": ["bigquery"],
@@ -412,6 +2448,13 @@ async def run_router(question: str, history: list[dict]) -> dict:
             "reasoning": "fallback routing — Gemini not available",
         }
 
+    cache_key = _router_cache_key(question, history)
+    cached = _router_cache.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+    if on_llm_route is not None:
+        on_llm_route()
+
     history_text = "\n".join(
         f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}"
         for m in history[-ROUTER_HISTORY_WIN:]
@@ -422,18 +2465,22 @@ async def run_router(question: str, history: list[dict]) -> dict:
         if _upload_index else "[]"
     )
 
+    schema, _ = _dictionary.for_question(_prune_text(question, history))
     prompt = ROUTER_PROMPT.format(
-        schema=BQ_SCHEMA,
+        schema=schema,
         uploads_manifest=uploads_manifest_str,
         history_window=ROUTER_HISTORY_WIN,
         history=history_text,
         question=question,
+        metric_catalog=_semantic.catalog(),
+        upload_tables=_upload_tables.schema_text(),
     )
 
     try:
-        resp = _router_model.generate_content(prompt)
-        raw = resp.text.strip().replace("```json", "").replace("```", "").strip()
+        text = await _generate_text(_router_model, prompt)
+        raw = text.strip().replace("```json", "").replace("```", "").strip()
         decision = json.loads(raw)
+        _router_cache.put(cache_key, dict(decision))
         return decision
     except Exception as e:
         # Graceful fallback if router fails
@@ -447,6 +2494,772 @@ async def run_router(question: str, history: list[dict]) -> dict:
         }
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# BIGQUERY RESULT CACHE  (normalized-SQL fingerprint, table-freshness checked)
+# ══════════════════════════════════════════════════════════════════════════════
+# Results are keyed by a canonical SQL fingerprint (comments stripped,
+# whitespace collapsed, keywords lower-cased, literals untouched) plus query
+# parameters. Each entry records the last_modified_time of every table it
+# read; a hit is only served while those versions are unchanged. Versions come
+# from one __TABLES__ query for the whole dataset, shared by all concurrent
+# callers and refreshed at most every BQ_FRESHNESS_TTL_S seconds.
+# BQ_CACHE_DIR adds a SQLite-backed store shared by every worker on the host.
+
+_SQL_SEGMENTS = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+
+
+def canonical_sql(sql: str) -> str:
+    """Comment-free, whitespace-normalized SQL with non-literal text lower-cased."""
+    parts = []
+    for i, seg in enumerate(_SQL_SEGMENTS.split(sql)):
+        if i % 2:                       # quoted literal / identifier — keep verbatim
+            parts.append(seg)
+            continue
+        seg = re.sub(r"--[^\n]*|/\*.*?\*/", " ", seg, flags=re.DOTALL)
+        seg = re.sub(r"\s*([,()=<>!+*/])\s*", r"\1", " ".join(seg.lower().split()))
+        parts.append(seg.strip())
+    return " ".join(p for p in parts if p).strip().rstrip(";").strip()
+
+
+def sql_fingerprint(sql: str, params: Optional[dict] = None) -> str:
+    payload = canonical_sql(sql) + "\x00" + json.dumps(params or {}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def sql_tables(sql: str) -> list[str]:
+    """Dataset tables referenced by the SQL (by bare table name)."""
+    found = {
+        name for name in re.findall(r"`?(?:[\w-]+\.)?(?:\w+)\.(\w+)`?", sql)
+        if name in BQ_TABLES
+    }
+    found |= {t for t in BQ_TABLES if re.search(rf"\b(?:FROM|JOIN)\s+`?{t}\b", sql, re.IGNORECASE)}
+    return sorted(found)
+
+
+class ResultCache:
+    """LRU result cache with an optional SQLite store shared across workers.
+
+    Each process keeps one connection to the store, used only under _disk_lock.
+    """
+
+    def __init__(self, maxsize: int, ttl_s: float, disk_dir: str = ""):
+        self.mem = LRUCache(maxsize, ttl_s)
+        self.ttl_s = ttl_s
+        self.maxsize = maxsize
+        self.disk_path: Optional[Path] = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.disk_hits = 0
+        self._disk_lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        if disk_dir:
+            try:
+                Path(disk_dir).mkdir(parents=True, exist_ok=True)
+                self.disk_path = Path(disk_dir) / "bq_results.sqlite"
+                with self._disk_lock, self._disk() as db:
+                    db.execute(
+                        "CREATE TABLE IF NOT EXISTS results "
+                        "(key TEXT PRIMARY KEY, payload TEXT NOT NULL, stored_at REAL NOT NULL)"
+                    )
+            except Exception as e:
+                print(f"BQ cache disk store disabled: {e}")
+                self.close()
+                self.disk_path = None
+
+    def _disk(self) -> sqlite3.Connection:
+        """The store connection, opened on first use. Call with _disk_lock held;
+        `with` on it commits or rolls back, it does not close."""
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.disk_path, timeout=5, check_same_thread=False)
+        return self._conn
+
+    def close(self) -> None:
+        with self._disk_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str, versions: dict) -> Optional[dict]:
+        """Cached entry for `key`, only if it was stored against the same table versions."""
+        entry = self.mem.get(key)
+        if entry is None and self.disk_path is not None:
+            with self._disk_lock, self._disk() as db:
+                row = db.execute("SELECT payload, stored_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and time.time() - row[1] < self.ttl_s:
+                entry = json.loads(row[0])
+                self.mem.put(key, entry)
+                self.disk_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry["versions"] != versions:
+            self.stale += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        self.mem.put(key, entry)
+        if self.disk_path is None:
+            return
+        with self._disk_lock, self._disk() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO results (key, payload, stored_at) VALUES (?, ?, ?)",
+                (key, json.dumps(entry, default=str), time.time()),
+            )
+            db.execute(
+                "DELETE FROM results WHERE key NOT IN "
+                "(SELECT key FROM results ORDER BY stored_at DESC LIMIT ?)", (self.maxsize * 4,)
+            )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": self.mem.stats()["size"],
+            "maxsize": self.maxsize,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "disk": str(self.disk_path or ""),
+            "disk_hits": self.disk_hits,
+        }
+
+
+_bq_result_cache = ResultCache(BQ_CACHE_SIZE, BQ_CACHE_TTL_S, BQ_CACHE_DIR)
+_table_versions: dict = {"at": 0.0, "versions": {}, "error": None}
+_table_versions_lock = asyncio.Lock()
+
+
+async def current_table_versions() -> dict[str, str]:
+    """{table: last_modified_time} for the dataset — one batched lookup, briefly memoized.
+
+    The same lookup records each table's size_bytes for scan-cost estimates.
+    A failed lookup is memoized for BQ_FRESHNESS_TTL_S too, so callers don't
+    each pay another failing round trip.
+    """
+    if time.monotonic() - _table_versions["at"] < BQ_FRESHNESS_TTL_S:
+        return _memoized_versions()
+    async with _table_versions_lock:
+        if time.monotonic() - _table_versions["at"] < BQ_FRESHNESS_TTL_S:
+            return _memoized_versions()
+        try:
+            rows = await _run_blocking(
+                _bq_fetch_rows,
+                f"SELECT table_id, last_modified_time, size_bytes FROM `{GCP_PROJECT}.{BQ_DATASET}.__TABLES__`",
+            )
+        except Exception as e:
+            _table_versions["error"] = str(e) or type(e).__name__
+            raise
+        else:
+            _table_versions["versions"] = {r["table_id"]: str(r["last_modified_time"]) for r in rows}
+            _table_versions["sizes"] = {r["table_id"]: int(r["size_bytes"]) for r in rows if r.get("size_bytes") is not None}
+            _table_versions["error"] = None
+        finally:
+            _table_versions["at"] = time.monotonic()
+        return _table_versions["versions"]
+
+
+def _memoized_versions() -> dict[str, str]:
+    if _table_versions["error"] is not None:
+        raise RuntimeError(f"table versions unavailable: {_table_versions['error']}")
+    return _table_versions["versions"]
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# RESULT ENCODING  (compact, token-budgeted rendering of query rows)
+# ══════════════════════════════════════════════════════════════════════════════
+# Rows go to the answer model as one header line plus one pipe-delimited line
+# per row — column names once, no JSON padding, floats rounded. A result over
+# its token budget becomes per-column summary statistics plus as many head /
+# tail rows as still fit, with the row count and truncation stated.
+#
+# RowStreamEncoder takes rows page by page as BigQuery returns them and tells
+# the fetcher to stop once BQ_MAX_ROWS rows are in or the rendering has passed
+# its token budget — rows past that point could only ever be summarized away.
+# A stream stopped early renders the rows it has, head first, and says how many
+# of the total were fetched.
+
+def _fmt_cell(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, float):
+        if math.isnan(v):
+            return ""
+        if v.is_integer() and abs(v) < 1e15:
+            return str(int(v))
+        return f"{v:.4f}".rstrip("0").rstrip(".") if abs(v) < 1000 else f"{v:.2f}".rstrip("0").rstrip(".")
+    text = str(v)
+    return text.replace("|", "/").replace("\n", " ").strip()
+
+
+def _column_summary(name: str, values: list) -> str:
+    present = [v for v in values if v is not None]
+    nums = [v for v in present if isinstance(v, (int, float)) and not isinstance(v, bool)]
+    nulls = f", {len(values) - len(present)} null" if len(present) < len(values) else ""
+    if present and len(nums) == len(present):
+        return (f"{name}: min {_fmt_cell(min(nums))}, max {_fmt_cell(max(nums))}, "
+                f"mean {_fmt_cell(sum(nums) / len(nums))}, sum {_fmt_cell(sum(nums))}{nulls}")
+    counts: dict[str, int] = {}
+    for v in present:
+        counts[_fmt_cell(v)] = counts.get(_fmt_cell(v), 0) + 1
+    top = sorted(counts.items(), key=lambda kv: -kv[1])[:5]
+    top_text = ", ".join(f"{k} ({n})" for k, n in top)
+    return f"{name}: {len(counts)} distinct{nulls}; top: {top_text}"
+
+
+class RowStreamEncoder:
+    """Accumulates (columns, rows) pages; `add` returns how many rows it kept."""
+
+    def __init__(self, budget_tokens: int, title: str = "Results",
+                 max_rows: Optional[int] = None, early_stop: bool = True):
+        self.budget_tokens = budget_tokens
+        self.title = title
+        self.max_rows = max_rows
+        self.early_stop = early_stop
+        self.columns: list[str] = []
+        self.rows: list[tuple] = []
+        self.lines: list[str] = []
+        self.chars = 0
+        self.stopped: Optional[str] = None        # "max_rows" | "token_budget"
+
+    def add(self, columns: list[str], rows: list) -> int:
+        if not self.columns:
+            self.columns = list(columns)
+            self.chars = len(self.title) + len(" | ".join(self.columns)) + 20
+        kept = 0
+        for row in rows:
+            if self.stopped:
+                break
+            line = " | ".join(_fmt_cell(v) for v in row)
+            self.rows.append(tuple(row))
+            self.lines.append(line)
+            self.chars += len(line) + 1
+            kept += 1
+            if self.max_rows is not None and len(self.rows) >= self.max_rows:
+                self.stopped = "max_rows"
+            elif self.early_stop and self.chars > self.budget_tokens * 4:
+                self.stopped = "token_budget"
+        return kept
+
+    def finish(self, total_rows: Optional[int] = None) -> tuple[str, dict]:
+        """Render within the budget. Returns (text, {rows, fetched, shown, truncated, tokens, stopped})."""
+        fetched = len(self.rows)
+        total = max(total_rows or 0, fetched)
+        info = {"rows": total, "fetched": fetched, "shown": 0, "truncated": False, "tokens": 0,
+                "stopped": self.stopped}
+        if not fetched:
+            return f"{self.title} ({total} rows)", info
+        header = " | ".join(self.columns)
+        full = f"{self.title} ({fetched} rows):\n{header}\n" + "\n".join(self.lines)
+        if fetched == total and estimate_tokens(full) <= self.budget_tokens:
+            return full, {**info, "shown": fetched, "tokens": estimate_tokens(full)}
+
+        complete = fetched == total
+        summary = "\n".join("  " + _column_summary(c, [r[i] for r in self.rows]) for i, c in enumerate(self.columns))
+        scope = "" if complete else f" — first {fetched} fetched"
+        prefix = (f"{self.title} ({total} rows{scope}; too large for the prompt; summary + sample rows):\n"
+                  f"Column summary{'' if complete else f' (first {fetched} rows)'}:\n{summary}\n{header}\n")
+        remaining = self.budget_tokens * 4 - len(prefix) - 80
+        lines = self.lines
+        head, tail = [], []
+        i, j = 0, len(lines) - 1
+        while i <= j:                   # alternate head / tail, head first, until the budget is spent
+            take_head = len(head) <= len(tail) or not complete     # unfetched rows have no tail to show
+            line = lines[i] if take_head else lines[j]
+            if len(line) + 1 > remaining:
+                break
+            remaining -= len(line) + 1
+            if take_head:
+                head.append(line)
+                i += 1
+            else:
+                tail.append(line)
+                j -= 1
+        shown = len(head) + len(tail)
+        omitted = total - shown
+        body = head + ([f"... {omitted} rows omitted ..."] if omitted else []) + tail[::-1]
+        text = prefix + "\n".join(body) + f"\n(showing {shown} of {total} rows)"
+        return text, {**info, "shown": shown, "truncated": True, "tokens": estimate_tokens(text)}
+
+
+def encode_rows(columns: list[str], rows: list, budget_tokens: int, title: str = "Results",
+                total_rows: Optional[int] = None) -> tuple[str, dict]:
+    """Render already-fetched rows within `budget_tokens` (see RowStreamEncoder.finish)."""
+    encoder = RowStreamEncoder(budget_tokens, title, early_stop=False)
+    encoder.add(columns, rows)
+    return encoder.finish(total_rows)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# LOCAL QUERY BACKEND  (bq_setup.sql in embedded SQLite, BigQuery client shape)
+# ══════════════════════════════════════════════════════════════════════════════
+# QUERY_BACKEND=local (or auto without a GCP project / BigQuery library) swaps
+# the BigQuery client for LocalBQClient: same .query(sql, job_config) →
+# .result() surface, so generate → dry-run → execute, parameters, the result
+# cache and its __TABLES__ freshness check all run unchanged offline, in CI and
+# under bench.py. A dialect shim rewrites BigQuery-isms on the way in;
+# LOCAL_BQ_LATENCY_MS adds a simulated round trip per call.
+
+_BQ_TYPES = {"int64": "INTEGER", "integer": "INTEGER", "float64": "REAL", "numeric": "REAL",
+             "bignumeric": "REAL", "string": "TEXT", "bool": "INTEGER", "boolean": "INTEGER",
+             "date": "TEXT", "datetime": "TEXT", "timestamp": "TEXT"}
+_DATE_PARTS = "DAY|WEEK|MONTH|QUARTER|YEAR"
+_DATE_PART_CALLS = re.compile(r"(?i)\b(?:DATE_DIFF|DATE_TRUNC)\s*\(")
+
+
+def _quote_date_parts(sql: str) -> str:
+    """DATE_DIFF(a, b, DAY) / DATE_TRUNC(d, MONTH) → the part as a string argument.
+
+    Only the last argument of those calls is touched — a column that happens to
+    be called `month` elsewhere (ORDER BY tier, month) stays a column.
+    """
+    masked = "".join(
+        " " * len(seg) if i % 2 else re.sub(r"--[^\n]*|/\*.*?\*/", lambda m: " " * len(m.group()), seg, flags=re.DOTALL)
+        for i, seg in enumerate(_SQL_SEGMENTS.split(sql))
+    )
+    spans = []
+    for call in _DATE_PART_CALLS.finditer(masked):
+        depth, last_comma = 1, None
+        for j in range(call.end(), len(masked)):
+            ch = masked[j]
+            if ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth -= 1
+                if depth == 0:
+                    break
+            elif ch == "," and depth == 1:
+                last_comma = j
+        else:
+            continue
+        if last_comma is not None and re.fullmatch(rf"\s*(?i:{_DATE_PARTS})\s*", masked[last_comma + 1:j]):
+            spans.append((last_comma + 1, j))
+    for start, end in reversed(spans):
+        sql = sql[:start] + f" '{sql[start:end].strip().upper()}'" + sql[end:]
+    return sql
+
+
+def bq_to_sqlite(sql: str) -> str:
+    """Rewrite BigQuery Standard SQL into SQLite. Quoted string literals pass through untouched."""
+    parts = []
+    segs = _SQL_SEGMENTS.split(_quote_date_parts(sql))
+    for i, seg in enumerate(segs):
+        if i % 2:
+            if seg.startswith("`"):                  # `project.dataset.table` → "table"
+                seg = '"' + seg.strip("`").split(".")[-1] + '"'
+            parts.append(seg)
+            continue
+        seg = re.sub(r"--[^\n]*|/\*.*?\*/", " ", seg, flags=re.DOTALL)
+        seg = seg.replace("/", " * 1.0 /")                   # BigQuery `/` always returns FLOAT64
+        seg = re.sub(r"(?i)\bCREATE\s+OR\s+REPLACE\s+TABLE\b", "CREATE TABLE", seg)
+        seg = re.sub(r"(?i)\bTABLESAMPLE\s+SYSTEM\s*\([^)]*\)", " ", seg)   # no sampling locally
+        if i + 1 < len(segs) and segs[i + 1].startswith("'"):                    # DATE '2024-01-01'
+            seg = re.sub(r"(?i)\b(?:TIMESTAMP|DATETIME|DATE)\s*$", "", seg)
+        seg = re.sub(r"(?i)\bINTERVAL\s+(-?\d+)\s+(" + _DATE_PARTS + r")\b", r"'\1 \2'", seg)
+        seg = re.sub(r"(?i)\bEXTRACT\s*\(\s*(\w+)\s+FROM\s+", r"BQ_EXTRACT('\1', ", seg)
+        seg = re.sub(r"(?i)\bCURRENT_(DATE|TIMESTAMP)\s*\(\s*\)", r"CURRENT_\1", seg)
+        seg = re.sub(r"(?i)\b(" + "|".join(_BQ_TYPES) + r")\b(?=\s*(?:[,)]|NOT\b|$))",
+                     lambda m: _BQ_TYPES[m.group(1).lower()], seg)
+        parts.append(seg)
+    return "".join(parts)
+
+
+def _split_sql_script(script: str) -> list[str]:
+    """Statements of a SQL script, split on top-level semicolons (comments stripped first)."""
+    segs = _SQL_SEGMENTS.split(script)
+    text = "".join(seg if i % 2 else re.sub(r"--[^\n]*", "", seg) for i, seg in enumerate(segs))
+    out, buf = [], []
+    for i, seg in enumerate(_SQL_SEGMENTS.split(text)):
+        if i % 2:
+            buf.append(seg)
+            continue
+        pieces = seg.split(";")
+        for piece in pieces[:-1]:
+            buf.append(piece)
+            out.append("".join(buf).strip())
+            buf = []
+        buf.append(pieces[-1])
+    out.append("".join(buf).strip())
+    return [stmt for stmt in out if stmt]
+
+
+def _as_date(v):
+    from datetime import date
+    return date.fromisoformat(str(v)[:10]) if v is not None else None
+
+
+def _date_diff(a, b, part):
+    a, b = _as_date(a), _as_date(b)
+    if a is None or b is None:
+        return None
+    part = part.upper()
+    if part == "DAY":
+        return (a - b).days
+    if part == "WEEK":
+        return (a - b).days // 7
+    months = (a.year - b.year) * 12 + (a.month - b.month)
+    return {"MONTH": months, "QUARTER": months // 3, "YEAR": a.year - b.year}[part]
+
+
+def _date_add(d, interval, sign=1):
+    import calendar
+    from datetime import timedelta
+    d = _as_date(d)
+    if d is None:
+        return None
+    n, part = str(interval).split()
+    n = int(n) * sign
+    part = part.upper()
+    if part in ("DAY", "WEEK"):
+        return (d + timedelta(days=n * (7 if part == "WEEK" else 1))).isoformat()
+    months = d.month - 1 + n * {"MONTH": 1, "QUARTER": 3, "YEAR": 12}[part]
+    year, month = d.year + months // 12, months % 12 + 1
+    # BigQuery clamps to the last day of the target month: 2024-01-31 + 1 MONTH = 2024-02-29
+    return d.replace(year=year, month=month, day=min(d.day, calendar.monthrange(year, month)[1])).isoformat()
+
+
+def _date_trunc(d, part):
+    d = _as_date(d)
+    if d is None:
+        return None
+    part = part.upper()
+    if part == "YEAR":
+        return d.replace(month=1, day=1).isoformat()
+    if part == "QUARTER":
+        return d.replace(month=(d.month - 1) // 3 * 3 + 1, day=1).isoformat()
+    if part == "MONTH":
+        return d.replace(day=1).isoformat()
+    if part == "WEEK":
+        from datetime import timedelta
+        return (d - timedelta(days=(d.weekday() + 1) % 7)).isoformat()
+    return d.isoformat()
+
+
+def _bq_extract(part, d):
+    d = _as_date(d)
+    if d is None:
+        return None
+    return {"YEAR": d.year, "MONTH": d.month, "DAY": d.day, "QUARTER": (d.month - 1) // 3 + 1,
+            "DAYOFWEEK": (d.weekday() + 1) % 7 + 1}.get(part.upper())
+
+
+class _CountIf:
+    def __init__(self):
+        self.n = 0
+
+    def step(self, cond):
+        self.n += 1 if cond else 0
+
+    def finalize(self):
+        return self.n
+
+
+class _LocalQueryJob:
+    def __init__(self, rows: list[dict], total_bytes_processed: int):
+        self._rows = rows
+        self.total_bytes_processed = total_bytes_processed
+
+    def result(self, *args, **kwargs) -> list[dict]:
+        return self._rows
+
+
+def _register_bq_functions(conn: sqlite3.Connection) -> None:
+    """BigQuery functions the dialect shim leaves as calls."""
+    for name, n, fn in (("SAFE_DIVIDE", 2, lambda a, b: a / b if a is not None and b else None),
+                        ("DATE_DIFF", 3, _date_diff), ("DATE_ADD", 2, _date_add),
+                        ("DATE_SUB", 2, lambda d, i: _date_add(d, i, -1)),
+                        ("DATE_TRUNC", 2, _date_trunc), ("BQ_EXTRACT", 2, _bq_extract),
+                        ("STARTS_WITH", 2, lambda s, p: int(str(s).startswith(str(p))) if s is not None else None),
+                        ("FORMAT_DATE", 2, lambda f, d: _as_date(d).strftime(f) if _as_date(d) else None)):
+        conn.create_function(name, n, fn, deterministic=True)
+    conn.create_aggregate("COUNTIF", 1, _CountIf)
+
+
+class LocalBQClient:
+    """Embedded SQLite loaded from bq_setup.sql, answering BigQuery-client calls."""
+
+    def __init__(self, seed_path: Path, latency_s: float = 0.0):
+        self.seed_path = seed_path
+        self.latency_s = latency_s
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        _register_bq_functions(self.conn)
+        self._lock = threading.Lock()
+        self.loaded_at_ms = int(time.time() * 1000)
+        self.queries = 0
+        with self._lock:
+            for stmt in _split_sql_script(seed_path.read_text()):
+                self.conn.execute(bq_to_sqlite(stmt))
+            self.conn.commit()
+        self.tables = [r[0] for r in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        # Rough on-disk size for __TABLES__.size_bytes: 8 bytes per cell
+        self.sizes = {
+            t: self.conn.execute(f'SELECT COUNT(*) FROM "{t}"').fetchone()[0]
+            * len(self.conn.execute(f'PRAGMA table_info("{t}")').fetchall()) * 8
+            for t in self.tables
+        }
+
+    def query(self, sql: str, job_config=None, **kwargs) -> _LocalQueryJob:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        if "__TABLES__" in sql:
+            return _LocalQueryJob([{"table_id": t, "last_modified_time": self.loaded_at_ms, "size_bytes": self.sizes[t]}
+                                   for t in self.tables], 0)
+        local_sql = bq_to_sqlite(sql)
+        params = {p.name: p.value for p in getattr(job_config, "query_parameters", None) or []}
+        with self._lock:
+            self.queries += 1
+            if getattr(job_config, "dry_run", False):
+                self.conn.execute("EXPLAIN QUERY PLAN " + local_sql, params).fetchall()
+                return _LocalQueryJob([], estimate_scan_bytes(sql, self.sizes) or 0)
+            rows = [dict(r) for r in self.conn.execute(local_sql, params).fetchall()]
+        return _LocalQueryJob(rows, len(json.dumps(rows, default=str)))
+
+    def stats(self) -> dict:
+        return {"seed": self.seed_path.name, "tables": len(self.tables),
+                "latency_ms": round(self.latency_s * 1000, 1), "queries": self.queries}
+
+
+def _use_local_backend() -> bool:
+    if QUERY_BACKEND == "local":
+        return True
+    if QUERY_BACKEND != "auto":
+        return False
+    try:
+        from google.cloud import bigquery  # noqa: F401
+    except ImportError:
+        return True
+    return not GCP_PROJECT
+
+
+BQ_BACKEND = "bigquery"
+if _use_local_backend() and not _SPAWNED_CHILD:
+    try:
+        _bq_client = LocalBQClient(Path(LOCAL_BQ_SEED) if LOCAL_BQ_SEED else BASE_DIR / "bq_setup.sql",
+                                   LOCAL_BQ_LATENCY_MS / 1000)
+        BQ_OK = True
+        BQ_BACKEND = "local"
+    except (OSError, sqlite3.Error) as e:
+        print(f"Local query backend unavailable: {e}")
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# LOCAL SQL VALIDATION  (schema check before anything leaves the process)
+# ══════════════════════════════════════════════════════════════════════════════
+# Generated SQL is translated with the dialect shim and EXPLAINed against an
+# empty SQLite copy of BQ_SCHEMA. SQLite resolves every table and column, so
+# "no such table / column" is a definitive error that goes straight into the
+# correction prompt. Anything the shim can't express (QUALIFY, FORMAT_DATE,
+# UNNEST…) is inconclusive and falls back to the remote dry-run. SQL that
+# passes locally skips the dry-run unless its estimated scan (table
+# size_bytes × share of columns read) reaches SQL_DRY_RUN_MIN_BYTES. SQL that
+# already ran successfully is trusted and skips validation entirely.
+
+_SQLITE_TYPES = {"STRING": "TEXT", "INT64": "INTEGER", "FLOAT64": "REAL", "BOOL": "INTEGER",
+                 "DATE": "TEXT", "TIMESTAMP": "TEXT"}
+_NOT_TABLES = frozenset({"unnest"})
+_NOT_COLUMNS = frozenset("""
+day week month quarter year hour minute second millisecond microsecond dayofweek dayofyear isoweek
+isoyear date datetime time timestamp true false null
+""".split())
+
+
+class LocalSqlValidator:
+    """EXPLAIN-based table/column check of BigQuery SQL against the static schema."""
+
+    def __init__(self, tables: dict[str, list[tuple[str, str, str]]]):
+        self.tables = tables
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        _register_bq_functions(self.conn)
+        for table, cols in tables.items():
+            defs = ", ".join(f'"{c}" {_SQLITE_TYPES.get(t, "TEXT")}' for c, t, _ in cols)
+            self.conn.execute(f'CREATE TABLE "{table}" ({defs})')
+        self._lock = threading.Lock()
+        self.counts = {"ok": 0, "error": 0, "inconclusive": 0}
+
+    def check(self, sql: str) -> tuple[str, str]:
+        """("ok" | "error" | "inconclusive", message)."""
+        status, message = self._check(sql)
+        with self._lock:
+            self.counts[status] += 1
+        return status, message
+
+    def _check(self, sql: str) -> tuple[str, str]:
+        statements = _split_sql_script(sql)
+        if len(statements) != 1:
+            return "error", "Write exactly one SQL statement."
+        if not re.match(r"\s*(?:\(\s*)*(?:select|with)\b", canonical_sql(statements[0])):
+            return "error", "Only a SELECT (or WITH … SELECT) query is allowed."
+        for ref in re.findall(r"`([^`]+)`", sql):
+            parts = ref.split(".")
+            if len(parts) >= 2 and parts[-1] not in self.tables:
+                return "error", (f"Table {ref} not found in dataset {BQ_DATASET}. "
+                                 f"Available tables: {', '.join(self.tables)}")
+        try:
+            with self._lock:
+                self.conn.execute("EXPLAIN " + bq_to_sqlite(statements[0])).fetchall()
+        except sqlite3.Error as e:
+            msg = str(e)
+            m = re.match(r"no such (table|column): ([\w.]+)", msg)
+            if m:
+                name = m.group(2).split(".")[-1].lower()
+                if (m.group(1) == "table" and name not in _NOT_TABLES) or (m.group(1) == "column" and name not in _NOT_COLUMNS):
+                    if m.group(1) == "column":
+                        return "error", f"Unrecognized name: {m.group(2)} — not a column of the table(s) it is read from."
+                    return "error", f"Table {m.group(2)} not found. Available tables: {', '.join(self.tables)}"
+            if msg.startswith("ambiguous column name"):
+                return "error", f"Column name is ambiguous: {msg.split(':', 1)[-1].strip()} — qualify it with a table alias."
+            return "inconclusive", msg
+        return "ok", ""
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"enabled": SQL_LOCAL_VALIDATE, **self.counts}
+
+
+def estimate_scan_bytes(sql: str, sizes: dict[str, int]) -> Optional[int]:
+    """Bytes BigQuery would scan: per table, size × share of its columns the SQL names. None if unknown."""
+    tables = sql_tables(sql)
+    if not tables or any(t not in sizes for t in tables):
+        return None
+    words = set(re.findall(r"\w+", canonical_sql(sql)))
+    star = re.search(r"(?:select|,|\.)\s*\*", canonical_sql(sql)) is not None
+    total = 0
+    for t in tables:
+        cols = [c for c, _, _ in BQ_TABLES.get(t, [])]
+        used = len(cols) if star else sum(c in words for c in cols)
+        scanned = sizes[t] * max(used, 1) // max(len(cols), 1)
+        sample = re.search(rf"\.{t}`(?:\s+(?:as\s+)?\w+)?\s+tablesample\s+system\s*\(([\d.]+)\s+percent",
+                           sql, re.IGNORECASE)
+        total += int(scanned * float(sample.group(1)) / 100) if sample else scanned
+    return total
+
+
+_sql_validator = LocalSqlValidator(BQ_TABLES)
+_trusted_sql = LRUCache(1024, BQ_CACHE_TTL_S)       # fingerprints of SQL that executed successfully
+_validation_totals = {"trusted": 0, "local_only": 0, "dry_runs": 0, "local_fixes": 0, "remote_fixes": 0}
+
+
+def validation_stats() -> dict:
+    return {**_sql_validator.stats(), **_validation_totals, "dry_run_min_bytes": SQL_DRY_RUN_MIN_BYTES}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# COST GUARD  (scan budget from the dry-run estimate)
+# ══════════════════════════════════════════════════════════════════════════════
+# Every job carries maximum_bytes_billed and a timeout, so BigQuery itself
+# refuses a runaway scan. Before that, a query whose estimate exceeds
+# BQ_MAX_BYTES_BILLED is rewritten to a cheaper plan, re-estimated by dry-run
+# after each step, cheapest-loss first:
+#   1. columns      SELECT * → the columns the question needs (+ identifiers)
+#   2. date_window  usage_metrics / support_tickets limited to BQ_ROLLING_DAYS
+#                   (only when the SQL doesn't already filter on that date)
+#   3. sample       TABLESAMPLE SYSTEM (BQ_SAMPLE_PERCENT) on the largest table
+# The answer model is told which rewrites applied. A query still over budget
+# is refused. Scans of SQL_DRY_RUN_MIN_BYTES or more run at most
+# BQ_EXPENSIVE_CONCURRENCY at a time so ad hoc questions can't take every slot.
+
+_DATE_WINDOWS = {
+    "support_tickets": ("created_date", "created_date >= DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY)"),
+    "usage_metrics": ("month", "month >= FORMAT_DATE('%Y-%m', DATE_SUB(CURRENT_DATE(), INTERVAL {days} DAY))"),
+}
+_ID_COLUMNS = ("customer_id", "name", "ticket_id", "sub_id", "month")
+_CLAUSE_WORDS = ("where", "join", "on", "group", "order", "limit", "left", "right", "inner", "full",
+                 "cross", "using", "union", "tablesample", "having", "qualify", "window")
+
+_expensive_scans = asyncio.Semaphore(BQ_EXPENSIVE_CONCURRENCY)
+_cost_totals = {"guarded": 0, "rewritten": 0, "refused": 0, "expensive_waits": 0}
+
+
+def _table_ref(table: str) -> re.Pattern:
+    """`project.dataset.table` [AS alias] — alias captured when present."""
+    not_clause = "|".join(_CLAUSE_WORDS)
+    return re.compile(rf"`[^`]*\.{table}`(?:\s+(?:AS\s+)?(?!(?:{not_clause})\b)(\w+))?", re.IGNORECASE)
+
+
+def _rewrite_columns(sql: str, question: str) -> tuple[str, str]:
+    tables = sql_tables(sql)
+    m = re.match(r"(?is)\s*select\s+\*\s+from\s+(`[^`]+`)", sql)
+    if len(tables) != 1 or not m:
+        return sql, ""
+    table = tables[0]
+    selection = _dictionary.select(question) or {}
+    cols = [c for c, _, _ in BQ_TABLES[table] if c in selection.get(table, set()) or c in _ID_COLUMNS]
+    if not cols or len(cols) == len(BQ_TABLES[table]):
+        return sql, ""
+    return sql[:m.start()] + f"SELECT {', '.join(cols)} FROM {m.group(1)}" + sql[m.end():], \
+        f"read only {', '.join(cols)} from {table}"
+
+
+def _rewrite_date_window(sql: str, question: str) -> tuple[str, str]:
+    notes = []
+    for table, (column, condition) in _DATE_WINDOWS.items():
+        if table not in sql_tables(sql) or re.search(rf"\b{column}\b", sql, re.IGNORECASE):
+            continue
+        def window(m, table=table, condition=condition):
+            alias = m.group(1) or table
+            return f"(SELECT * FROM {m.group(0).split()[0]} WHERE {condition.format(days=BQ_ROLLING_DAYS)}) AS {alias}"
+        sql = _table_ref(table).sub(window, sql)
+        notes.append(f"{table} limited to the last {BQ_ROLLING_DAYS} days")
+    return sql, "; ".join(notes)
+
+
+def _rewrite_sample(sql: str, question: str) -> tuple[str, str]:
+    sizes = _table_versions.get("sizes", {})
+    tables = sorted(sql_tables(sql), key=lambda t: -sizes.get(t, 0))
+    if not tables or "tablesample" in sql.lower():
+        return sql, ""
+    table = tables[0]
+    sample = f" TABLESAMPLE SYSTEM ({BQ_SAMPLE_PERCENT:g} PERCENT)"
+    new = _table_ref(table).sub(lambda m: m.group(0) + sample, sql, count=1)
+    return new, f"{table} sampled at {BQ_SAMPLE_PERCENT:g}% — counts and sums cover the sample only"
+
+
+_COST_REWRITES = (("columns", _rewrite_columns), ("date_window", _rewrite_date_window), ("sample", _rewrite_sample))
+
+
+async def apply_cost_guard(sql: str, question: str, scan_bytes: Optional[int]) -> tuple[str, dict]:
+    """Rewrite `sql` until its dry-run estimate fits BQ_MAX_BYTES_BILLED. Returns (sql, plan)."""
+    plan = {"bytes": scan_bytes, "budget": BQ_MAX_BYTES_BILLED, "rewrites": [], "over_budget": False}
+    if scan_bytes is None or scan_bytes <= BQ_MAX_BYTES_BILLED:
+        return sql, plan
+    _cost_totals["guarded"] += 1
+    for name, rewrite in _COST_REWRITES:
+        candidate, note = rewrite(sql, question)
+        if candidate == sql:
+            continue
+        try:
+            job = await _run_blocking(_bq_dry_run, candidate)
+        except Exception:
+            continue                    # rewrite broke the query — try the next one
+        new_bytes = getattr(job, "total_bytes_processed", None) or 0
+        if new_bytes >= plan["bytes"]:
+            continue                    # no saving (e.g. table not partitioned on that date) — keep the data
+        sql = candidate
+        plan["rewrites"].append({"rewrite": name, "note": note})
+        plan["bytes"] = new_bytes
+        if plan["bytes"] <= BQ_MAX_BYTES_BILLED:
+            break
+    plan["over_budget"] = plan["bytes"] > BQ_MAX_BYTES_BILLED
+    _cost_totals["refused" if plan["over_budget"] else "rewritten"] += 1
+    return sql, plan
+
+
+def _fmt_bytes(n: int) -> str:
+    return f"{n / (1 << 30):.1f} GB" if n >= 1 << 30 else f"{n / (1 << 20):.1f} MB"
+
+
+def cost_stats() -> dict:
+    return {**_cost_totals, "max_bytes_billed": BQ_MAX_BYTES_BILLED, "job_timeout_s": BQ_JOB_TIMEOUT_S,
+            "expensive_concurrency": BQ_EXPENSIVE_CONCURRENCY}
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # STAGE 2a: SQL GENERATION + VALIDATION + EXECUTION
 # ══════════════════════════════════════════════════════════════════════════════
@@ -472,83 +3285,327 @@ Write a single BigQuery SQL query. Rules:
 - For ambiguous columns, add a comment on your choice: -- using X not Y because reason
 - LIMIT to 500 rows maximum
 - If the question truly cannot be answered with SQL, return exactly: NO_SQL_NEEDED
+{plan_rule}
+Return ONLY the SQL or NO_SQL_NEEDED. No markdown fences, no explanation."""
+
+SQL_PLAN_RULE = """- If the question combines facts that don't need a row-by-row join (e.g. at-risk accounts, their
+  open P1 tickets and their last 3 months of seat utilization), write up to {max_parts} independent
+  queries instead of one large join. Put `-- part: <short label>` on the line before each query and
+  end each with `;`. Queries cannot reference each other — repeat a shared filter in each one
+  (e.g. customer_id IN (SELECT customer_id FROM ... WHERE ...)).
+"""
 
-Return ONLY the SQL query or NO_SQL_NEEDED. No markdown fences, no explanation."""
-
-
-async def generate_and_run_sql(question: str, sql_intent: str, history: list[dict]) -> dict:
-    """Generate SQL via Gemini, validate via dry-run, execute, return results."""
-    if not GENAI_OK or not BQ_OK or not _bq_client:
-        return {"status": "unavailable", "sql": None, "data": _bq_inline_fallback(), "row_count": 0}
 
-    history_text = "\n".join(
+def _sql_history_text(history: list[dict]) -> str:
+    return "\n".join(
         f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}"
         for m in history[-ROUTER_HISTORY_WIN:]
     ) or "(none)"
 
+
+async def _generate_sql(question: str, sql_intent: str, history: list[dict]) -> str:
+    """Pro-model SQL generation. Returns the SQL (or NO_SQL_NEEDED); raises on model errors."""
+    schema, data_dict = _dictionary.for_question(_prune_text(f"{question} {sql_intent}", history))
     prompt = SQL_GEN_PROMPT.format(
-        schema=BQ_SCHEMA,
-        data_dict=DATA_DICT,
-        history=history_text,
+        schema=schema,
+        data_dict=data_dict,
+        history=_sql_history_text(history),
         sql_intent=sql_intent,
         question=question,
         project=GCP_PROJECT,
         dataset=BQ_DATASET,
+        plan_rule=SQL_PLAN_RULE.format(max_parts=SQL_PLAN_MAX_PARTS) if SQL_PLAN_MAX_PARTS > 1 else "",
     )
+    text = await _generate_text(_answer_model, prompt)
+    return text.strip().replace("```sql", "").replace("```", "").strip()
 
-    try:
-        resp = _answer_model.generate_content(prompt)
-        sql = resp.text.strip().replace("```sql", "").replace("```", "").strip()
-    except Exception as e:
-        return {"status": "gen_error", "sql": None, "data": _bq_inline_fallback(), "error": str(e)}
+
+async def generate_and_run_sql(
+    question: str,
+    sql_intent: str,
+    history: list[dict],
+    metric: Optional[str] = None,
+    pregenerated: Optional[dict] = None,
+    on_page: Optional[Callable[[list[str], list[tuple], int], None]] = None,
+) -> dict:
+    """Generate SQL via Gemini, validate (locally, dry-run if needed), execute, return results.
+
+    Questions routed to a canonical metric compile straight from the semantic
+    layer and skip both the generation call and the dry-run. `pregenerated`
+    ({"sql", "validated", "scan_bytes"}) is SQL adopted from speculative generation;
+    `on_page` is passed through to _execute_sql. Generated text holding a
+    multi-part plan runs as concurrent sub-queries (see run_sql_plan).
+    """
+    if metric and BQ_OK and _bq_client and _semantic.can_compile(metric, question, _fast_router._entity_words(question)):
+        # Router-suggested metrics pass the same entity / value / period checks as the fast path
+        compiled = _semantic.compile(metric, question)
+        if compiled:
+            sql, params = compiled
+            result = await _execute_sql(sql, params, on_page=on_page)
+            result["metric"] = metric
+            result["validation"] = {"local": "template", "dry_run": False, "est_bytes": None, "fixed": False}
+            return result
+
+    if not GENAI_OK or not BQ_OK or not _bq_client:
+        return {"status": "unavailable", "sql": None, "data": _bq_inline_fallback(), "row_count": 0}
+
+    validated, scan_bytes = False, None
+    if pregenerated:
+        sql, validated = pregenerated["sql"], pregenerated.get("validated", False)
+        scan_bytes = pregenerated.get("scan_bytes")
+    else:
+        try:
+            sql = await _generate_sql(question, sql_intent, history)
+        except Exception as e:
+            return {"status": "gen_error", "sql": None, "data": _bq_inline_fallback(), "error": str(e)}
 
     if sql == "NO_SQL_NEEDED":
         return {"status": "not_needed", "sql": None, "data": "", "row_count": 0}
 
-    # Dry-run validation (zero cost, validates schema + syntax)
-    sql, result = await _validate_and_execute(sql, question, history_text)
+    plan = parse_sql_plan(sql)
+    if len(plan) > 1:
+        return await run_sql_plan(plan, question, _sql_history_text(history), on_page)
+    # Local schema check first; the remote dry-run only when it can't vouch or the scan is large
+    sql, result = await _validate_and_execute(plan[0]["sql"], question, _sql_history_text(history),
+                                              validated, on_page, scan_bytes)
     return result
 
 
-async def _validate_and_execute(sql: str, question: str, history_text: str) -> tuple[str, dict]:
-    """Dry-run → self-correct if needed → execute."""
-    from google.cloud import bigquery as bq
-
-    # Attempt 1: dry-run
-    try:
-        cfg = bq.QueryJobConfig(dry_run=True, use_query_cache=False)
-        _bq_client.query(sql, job_config=cfg)
-    except Exception as e1:
-        # Self-correction: feed error back to model
-        fix_prompt = (
-            f"Fix this BigQuery SQL. Return ONLY the corrected SQL, no markdown, no explanation.\n\n"
-            f"SQL:\n{sql}\n\nError:\n{e1}"
-        )
+async def _validate_and_execute(
+    sql: str, question: str, history_text: str, validated: bool = False,
+    on_page: Optional[Callable[[list[str], list[tuple], int], None]] = None,
+    scan_bytes: Optional[int] = None,
+) -> tuple[str, dict]:
+    """Local check → dry-run only if inconclusive or costly → cost guard → execute;
+    one correction round.
+
+    Local and remote errors both feed the correction prompt. `validated` SQL
+    already passed a dry-run that measured `scan_bytes`; SQL that executed
+    successfully before is trusted. Both skip the checks but not the cost guard.
+    """
+    report = {"local": None, "dry_run": validated, "est_bytes": None,
+              "bytes": scan_bytes if validated else None, "fixed": False}
+    if validated or _trusted_sql.get(sql_fingerprint(sql)) is not None:
+        _validation_totals["trusted"] += 1
+        report["local"] = "trusted"
+        error = None
+        if report["bytes"] is None:
+            report["est_bytes"] = await _estimate_bytes(sql)
+            if report["est_bytes"] is not None and report["est_bytes"] > BQ_MAX_BYTES_BILLED:
+                # The metadata estimate ignores pruning — measure before rewriting anything
+                _validation_totals["dry_runs"] += 1
+                try:
+                    job = await _run_blocking(_bq_dry_run, sql)
+                    report["dry_run"], report["bytes"] = True, getattr(job, "total_bytes_processed", None)
+                except Exception:
+                    pass    # the guard works from the estimate
+    else:
+        error, source = await _preflight(sql, report)
+    if error is not None:
+        _validation_totals[f"{source}_fixes"] += 1
         try:
-            fixed = _answer_model.generate_content(fix_prompt)
-            sql = fixed.text.strip().replace("```sql", "").replace("```", "").strip()
-            cfg = bq.QueryJobConfig(dry_run=True, use_query_cache=False)
-            _bq_client.query(sql, job_config=cfg)
-        except Exception as e2:
+            sql = await _fix_sql(sql, error, question)
+            report["fixed"] = True
+            error, source = await _preflight(sql, report)
+        except Exception as e:
+            error = str(e)
+        if error is not None:
             return sql, {
                 "status": "validation_failed",
                 "sql": sql,
                 "data": _bq_inline_fallback(),
-                "error": str(e2),
+                "error": error,
                 "row_count": 0,
+                "validation": report,
             }
 
-    # Execute (with LIMIT safety wrap)
+    sql, cost = await _guard_cost(sql, question, report)
+    if cost["over_budget"]:
+        return sql, _over_budget_result(sql, report, cost)
+
+    result = await _execute_sql(sql, scan_bytes=cost["bytes"], on_page=on_page)
+    if result["status"] == "exec_error" and not report["dry_run"] and not report["fixed"]:
+        # No dry-run ran, so a BigQuery-only error can surface here — correct once from it,
+        # and the correction goes through the same preflight and cost guard
+        _validation_totals["remote_fixes"] += 1
+        try:
+            fixed = await _fix_sql(sql, result.get("error", ""), question)
+        except Exception:
+            fixed = None
+        if fixed is not None:
+            sql = fixed
+            report["fixed"] = True
+            report["est_bytes"] = report["bytes"] = None
+            error, _ = await _preflight(sql, report)
+            if error is not None:
+                return sql, {
+                    "status": "validation_failed",
+                    "sql": sql,
+                    "data": _bq_inline_fallback(),
+                    "error": error,
+                    "row_count": 0,
+                    "validation": report,
+                }
+            sql, cost = await _guard_cost(sql, question, report)
+            if cost["over_budget"]:
+                return sql, _over_budget_result(sql, report, cost)
+            result = await _execute_sql(sql, scan_bytes=cost["bytes"], on_page=on_page)
+    if cost["rewrites"] and result["status"] == "success":
+        notes = "; ".join(r["note"] for r in cost["rewrites"])
+        result["data"] = f"Note — query narrowed to fit the scan budget: {notes}.\n" + result["data"]
+    result["validation"] = report
+    result["cost"] = cost
+    return sql, result
+
+
+async def _guard_cost(sql: str, question: str, report: dict) -> tuple[str, dict]:
+    """apply_cost_guard with the best byte count the report holds (dry-run over estimate)."""
+    scan_bytes = report["bytes"] if report["bytes"] is not None else report["est_bytes"]
+    return await apply_cost_guard(sql, question, scan_bytes)
+
+
+def _over_budget_result(sql: str, report: dict, cost: dict) -> dict:
+    return {
+        "status": "over_budget",
+        "sql": sql,
+        "data": (f"Query not run: it would scan about {_fmt_bytes(cost['bytes'])}, over the "
+                 f"{_fmt_bytes(BQ_MAX_BYTES_BILLED)} per-query budget even after cheaper rewrites. "
+                 "Ask the user to narrow it (date range, specific accounts, fewer columns)."),
+        "row_count": 0,
+        "validation": report,
+        "cost": cost,
+    }
+
+
+async def _estimate_bytes(sql: str) -> Optional[int]:
+    """Scan estimate from table metadata (no dry-run); None when sizes are unavailable."""
     try:
-        safe_sql = f"SELECT * FROM ({sql}) LIMIT 500"
-        rows = [dict(row) for row in _bq_client.query(safe_sql).result()]
-        data_text = (
-            f"BigQuery results ({len(rows)} rows):\n"
-            + json.dumps(rows, indent=2, default=str)
-        )
-        return sql, {"status": "success", "sql": sql, "data": data_text, "row_count": len(rows)}
+        await current_table_versions()
+        return estimate_scan_bytes(sql, _table_versions.get("sizes", {}))
+    except Exception:
+        return None
+
+
+async def _preflight(sql: str, report: dict) -> tuple[Optional[str], str]:
+    """(error or None, "local" | "remote"). Dry-runs only when the local check can't vouch for the SQL."""
+    status, message = "inconclusive", ""
+    if SQL_LOCAL_VALIDATE:
+        status, message = await _run_blocking(_sql_validator.check, sql)
+    report["local"] = status
+    if status == "error":
+        return message, "local"
+    if status == "ok":
+        report["est_bytes"] = await _estimate_bytes(sql)
+        if report["est_bytes"] is not None and report["est_bytes"] < SQL_DRY_RUN_MIN_BYTES:
+            _validation_totals["local_only"] += 1
+            return None, "local"
+    _validation_totals["dry_runs"] += 1
+    report["dry_run"] = True
+    try:
+        job = await _run_blocking(_bq_dry_run, sql)
     except Exception as e:
-        return sql, {
+        return str(e), "remote"
+    report["bytes"] = getattr(job, "total_bytes_processed", None)
+    return None, "remote"
+
+
+async def _fix_sql(sql: str, error: str, question: str) -> str:
+    """One Pro-model correction of `sql` given its error and the question's schema."""
+    schema, _ = _dictionary.for_question(question)
+    fix_prompt = (
+        f"Fix this BigQuery SQL. Return ONLY the corrected SQL, no markdown, no explanation.\n\n"
+        f"Schema:\n{schema}\n\nQuestion: {question}\n\nSQL:\n{sql}\n\nError:\n{error}"
+    )
+    fixed = await _generate_text(_answer_model, fix_prompt)
+    return fixed.strip().replace("```sql", "").replace("```", "").strip()
+
+
+def _top_level_sql(sql: str) -> str:
+    """`sql` with quoted text, comments and everything inside parentheses blanked.
+    Same length, so match offsets apply to the original."""
+    parts = []
+    for i, seg in enumerate(_SQL_SEGMENTS.split(sql)):
+        if i % 2:
+            parts.append(" " * len(seg))
+        else:
+            parts.append(re.sub(r"--[^\n]*|/\*.*?\*/", lambda m: " " * len(m.group()), seg, flags=re.DOTALL))
+    out, depth = [], 0
+    for ch in "".join(parts):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth = max(depth - 1, 0)
+        out.append(ch if depth == 0 and ch not in "()" else " ")
+    return "".join(out)
+
+
+def _cap_rows(sql: str, cap: int) -> str:
+    """The statement with its result capped at `cap` rows, its own ORDER BY still in force.
+
+    An outer `SELECT * FROM (...) LIMIT n` does not guarantee the inner order,
+    so a trailing LIMIT is lowered to the cap and a trailing ORDER BY gets the
+    cap appended. Only unordered statements (or a non-literal LIMIT) are wrapped.
+    """
+    sql = sql.strip().rstrip(";").rstrip()
+    top = _top_level_sql(sql)
+    m = re.search(r"\bLIMIT\s+(\d+)(?:\s+OFFSET\s+\d+)?\s*$", top, re.IGNORECASE)
+    if m:
+        return sql if int(m.group(1)) <= cap else sql[:m.start(1)] + str(cap) + sql[m.end(1):]
+    if re.search(r"\bORDER\s+BY\b", top, re.IGNORECASE) and not re.search(r"\bLIMIT\b", top, re.IGNORECASE):
+        return f"{sql}\nLIMIT {cap}"
+    return f"SELECT * FROM ({sql}) LIMIT {cap}"
+
+
+async def _execute_sql(sql: str, params: Optional[dict[str, str]] = None,
+                       scan_bytes: Optional[int] = None,
+                       on_page: Optional[Callable[[list[str], list[tuple], int], None]] = None) -> dict:
+    """Execute validated (or trusted) SQL with a BQ_MAX_ROWS row cap (see _cap_rows).
+
+    Served from the result cache when the same canonical SQL already ran and
+    none of the tables it reads have been modified since. Scans estimated at
+    SQL_DRY_RUN_MIN_BYTES or more queue for one of the expensive-scan slots.
+    Rows stream page by page into the encoder; `on_page(columns, rows, fetched)`
+    sees each page as it lands.
+    """
+    key = sql_fingerprint(sql, params)
+    tables = sql_tables(sql)
+    current = None              # freshness unknown → never served from / stored in the cache
+    if tables:                  # no resolvable tables → nothing to check freshness against
+        try:
+            versions = await current_table_versions()
+            current = {t: versions.get(t) for t in tables}
+        except Exception:
+            pass
+
+    if current is not None:
+        entry = await _run_blocking(_bq_result_cache.get, key, current)
+        if entry is not None:
+            _trusted_sql.put(sql_fingerprint(sql), True)
+            if "columns" not in entry:      # stored before results were columnar
+                columns = list(dict.fromkeys(c for r in entry["rows"] for c in r))
+                entry = {**entry, "columns": columns,
+                         "rows": [[r.get(c) for c in columns] for r in entry["rows"]]}
+            encoder = RowStreamEncoder(RESULT_TOKEN_BUDGET, "BigQuery results", early_stop=False)
+            encoder.add(entry["columns"], entry["rows"])
+            return _rows_result(sql, encoder, entry.get("total_rows"), cache="hit")
+
+    try:
+        safe_sql = _cap_rows(sql, BQ_MAX_ROWS)     # caps rows returned, not bytes scanned
+        if scan_bytes is not None and scan_bytes >= SQL_DRY_RUN_MIN_BYTES:
+            if _expensive_scans.locked():
+                _cost_totals["expensive_waits"] += 1
+            async with _expensive_scans:
+                encoder, total = await _stream_rows(safe_sql, params, on_page)
+        else:
+            encoder, total = await _stream_rows(safe_sql, params, on_page)
+        if current is not None:
+            rows = json.loads(json.dumps(encoder.rows, default=str))
+            await _run_blocking(_bq_result_cache.put, key, {"columns": encoder.columns, "rows": rows,
+                                                            "total_rows": total, "versions": current})
+        _trusted_sql.put(sql_fingerprint(sql), True)
+        return _rows_result(sql, encoder, total, cache="miss")
+    except Exception as e:
+        return {
             "status": "exec_error",
             "sql": sql,
             "data": _bq_inline_fallback(),
@@ -557,6 +3614,68 @@ async def _validate_and_execute(sql: str, question: str, history_text: str) -> t
         }
 
 
+_stream_totals = {"queries": 0, "pages": 0, "rows": 0, "early_stops": 0, "arrow": 0, "first_page_ms": []}
+
+
+async def _stream_rows(sql: str, params: Optional[dict[str, str]],
+                       on_page: Optional[Callable[[list[str], list[tuple], int], None]] = None
+                       ) -> tuple[RowStreamEncoder, Optional[int]]:
+    """Pull pages from _bq_iter_pages one pool hop at a time until the encoder has enough.
+
+    Stopping early closes the page iterator, so BigQuery is never asked for the
+    pages after it (or, over the Storage Read API, the stream is cancelled).
+    """
+    encoder = RowStreamEncoder(RESULT_TOKEN_BUDGET, "BigQuery results", max_rows=BQ_MAX_ROWS)
+    total = None
+    pages = _bq_iter_pages(sql, params)
+    loop = asyncio.get_running_loop()
+    t0 = time.perf_counter()
+    _stream_totals["queries"] += 1
+    try:
+        while not encoder.stopped:
+            page = await loop.run_in_executor(_io_pool, next, pages, None)
+            if page is None:
+                break
+            columns, rows, total = page
+            if t0 is not None:              # time to first data: job wait + first page
+                _record_first_page((time.perf_counter() - t0) * 1000)
+                t0 = None
+            kept = encoder.add(columns, rows)
+            _stream_totals["pages"] += 1
+            _stream_totals["rows"] += kept
+            if on_page is not None:
+                on_page(encoder.columns, rows[:kept], len(encoder.rows))
+        if encoder.stopped:
+            _stream_totals["early_stops"] += 1
+    finally:
+        try:
+            pages.close()
+        except ValueError:          # still running on a pool thread after a cancel; it ends with the job
+            pass
+    return encoder, total
+
+
+def _record_first_page(ms: float) -> None:
+    samples = _stream_totals["first_page_ms"]
+    samples.append(ms)
+    del samples[:-200]
+
+
+def result_streaming_stats() -> dict:
+    samples = sorted(_stream_totals["first_page_ms"])
+    return {**{k: v for k, v in _stream_totals.items() if k != "first_page_ms"},
+            "first_page_p50_ms": round(samples[len(samples) // 2], 1) if samples else None,
+            "max_rows": BQ_MAX_ROWS, "page_size": BQ_PAGE_SIZE,
+            "arrow_available": ARROW_OK, "storage_api": _bqstorage["client"] is not None}
+
+
+def _rows_result(sql: str, encoder: RowStreamEncoder, total_rows: Optional[int], cache: str) -> dict:
+    data_text, encoding = encoder.finish(total_rows)
+    return {"status": "success", "sql": sql, "data": data_text, "row_count": encoding["rows"],
+            "cache": cache, "encoding": encoding, "columns": encoder.columns, "rows": encoder.rows,
+            "total_rows": encoding["rows"]}
+
+
 def _bq_inline_fallback() -> str:
     """Inline fallback data when BQ is unavailable. Keeps demo runnable offline."""
     return json.dumps({
@@ -582,15 +3701,702 @@ def _bq_inline_fallback() -> str:
     }, indent=2)
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# MULTI-QUERY SQL PLANS  (independent sub-queries, executed concurrently)
+# ══════════════════════════════════════════════════════════════════════════════
+# A question spanning facts that need no row-by-row join ("at-risk accounts,
+# their open P1 tickets and seat utilization") comes back from SQL generation
+# as up to SQL_PLAN_MAX_PARTS labelled statements instead of one wide join.
+# Each part goes through validation, the cost guard and the result cache on
+# its own and all parts run at once, so the fetch takes as long as the slowest
+# part. Results reach the answer prompt as one block per part.
+
+_PLAN_PART_RE = re.compile(r"^[ \t]*--[ \t]*part:[ \t]*(.+?)[ \t]*$", re.IGNORECASE | re.MULTILINE)
+_plan_totals = {"plans": 0, "parts": 0, "dropped": 0, "wall_ms": 0.0, "serial_ms": 0.0}
+
+
+def parse_sql_plan(text: str) -> list[dict]:
+    """[{"label", "sql"}] — one unlabelled part unless the text has two or more `-- part:` markers."""
+    marks = list(_PLAN_PART_RE.finditer(text))
+    if len(marks) < 2:
+        return [{"label": None, "sql": text.strip().rstrip(";").rstrip()}]
+    parts = []
+    for mark, nxt in zip(marks, marks[1:] + [None]):
+        sql = text[mark.end():nxt.start() if nxt else len(text)].strip().rstrip(";").rstrip()
+        if sql:
+            parts.append({"label": mark.group(1), "sql": sql})
+    return parts
+
+
+async def run_sql_plan(plan: list[dict], question: str, history_text: str,
+                       on_page: Optional[Callable[..., None]] = None) -> dict:
+    """Validate and execute every part concurrently. Returns a merged result with "parts"."""
+    dropped = max(0, len(plan) - SQL_PLAN_MAX_PARTS)
+    plan = plan[:SQL_PLAN_MAX_PARTS]
+
+    async def run(part: dict) -> dict:
+        t0 = time.perf_counter()
+        page_cb = functools.partial(on_page, part=part["label"]) if on_page is not None else None
+        sql, result = await _validate_and_execute(part["sql"], question, history_text, on_page=page_cb)
+        return {**result, "sql": sql, "label": part["label"], "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+    t0 = time.perf_counter()
+    parts = await asyncio.gather(*(run(p) for p in plan))
+    wall_ms = (time.perf_counter() - t0) * 1000
+    serial_ms = sum(p["ms"] for p in parts)
+    _plan_totals["plans"] += 1
+    _plan_totals["parts"] += len(parts)
+    _plan_totals["dropped"] += dropped
+    _plan_totals["wall_ms"] += wall_ms
+    _plan_totals["serial_ms"] += serial_ms
+
+    ok = [p for p in parts if p["status"] == "success"]
+    for p in parts[1 if not ok else 0:]:
+        if p["status"] in ("exec_error", "validation_failed"):
+            # One copy of the offline fallback at most — other failed parts just say why
+            p["data"] = f"This part failed ({p['status']}): {str(p.get('error', ''))[:300]}"
+    return {
+        "status": "success" if ok else parts[0]["status"],
+        "sql": "\n\n".join(f"-- part: {p['label']}\n{p['sql']}" for p in parts),
+        "row_count": sum(p.get("row_count", 0) for p in parts),
+        "parts": parts,
+        "plan": {"parts": len(parts), "ok": len(ok), "dropped": dropped,
+                 "wall_ms": round(wall_ms, 1), "serial_ms": round(serial_ms, 1)},
+    }
+
+
+def sql_plan_stats() -> dict:
+    return {"max_parts": SQL_PLAN_MAX_PARTS,
+            **{k: round(v, 1) if isinstance(v, float) else v for k, v in _plan_totals.items()}}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# FOLLOW-UP RESULT REUSE  (per-conversation result sets, re-queried locally)
+# ══════════════════════════════════════════════════════════════════════════════
+# The last CONV_RESULTS_PER_CONV BigQuery result sets of each conversation are
+# kept in an LRU (CONV_RESULTS_MAX conversations, CONV_RESULTS_TTL_S idle
+# expiry). A follow-up ("sort that by ARR", "only Enterprise", "what about
+# their seats?", "top 5") is parsed locally into filter / sort / limit /
+# projection steps over the newest set that has every column it mentions and
+# answered from those rows — no SQL generation, no BigQuery job. Like the
+# fast-path router this is all-or-nothing: a word that names data the set
+# doesn't hold, or that the parser doesn't understand, sends the question down
+# the normal path, as does any period or time word ("last year", "trend"). Filters, sorts and limits need the complete result; a set
+# cut short by BQ_MAX_ROWS or the token budget only supports projection.
+
+class ConversationResults:
+    """conversation_id → newest-first result sets ({label, sql, columns, rows, complete, ...})."""
+
+    def __init__(self, max_conversations: int, per_conversation: int, ttl_s: float):
+        self.cache = LRUCache(max_conversations, ttl_s)
+        self.per_conversation = per_conversation
+        self.reused = 0
+        self.declined = 0
+
+    def get(self, conversation_id: Optional[str]) -> list[dict]:
+        if not conversation_id:
+            return []
+        return self.cache.get(conversation_id) or []
+
+    def put(self, conversation_id: Optional[str], sets: list[dict]) -> None:
+        if conversation_id and sets:
+            self.cache.put(conversation_id, (sets + self.get(conversation_id))[:self.per_conversation])
+
+    def stats(self) -> dict:
+        return {"enabled": FOLLOWUP_REUSE, "per_conversation": self.per_conversation,
+                "reused": self.reused, "declined": self.declined, **self.cache.stats()}
+
+
+_conversation_results = ConversationResults(CONV_RESULTS_MAX, CONV_RESULTS_PER_CONV, CONV_RESULTS_TTL_S)
+
+# Column-name tokens too generic to identify a column on their own
+_GENERIC_COLUMN_WORDS = frozenset("id usd pct at per count date".split())
+# Any of these means a different period than the retained rows cover
+_TIME_WORDS = frozenset(_stem(w) for w in """
+day daily week weekly month monthly quarter quarterly year yearly annual annually trend time period
+ytd qtd mtd yoy fy last this previous prior next since ago recent recently today yesterday
+""".split()) | frozenset(_MONTHS)
+_FOLLOWUP_FILLER = (_STOPWORDS | _ANALYTIC_WORDS | _FOLLOWUP_REFS) - _TIME_WORDS | frozenset(_stem(w) for w in """
+sort sorted order ordered rank ranked by only just now instead please ones one rows row result results
+again same first then also include including exclude excluding except without not no filter filtered keep
+drop remove where whose account accounts customer customers asc ascending desc descending highest lowest
+largest smallest biggest fewest see view display want need like ok okay thanks how about and bottom
+is of
+""".split())
+_COLUMN_WORDS = frozenset(
+    _stem(w) for cols in BQ_TABLES.values() for col, _, _ in cols for w in col.split("_")
+) - _GENERIC_COLUMN_WORDS - _FOLLOWUP_FILLER
+_NEGATIONS = r"(?:not|no|excluding|except|without|exclude|drop|remove)\s+(?:the\s+)?$"
+_DIRECTIONS = {"asc": False, "ascending": False, "lowest first": False, "smallest first": False,
+               "fewest first": False, "least first": False, "desc": True, "descending": True,
+               "highest first": True, "largest first": True, "biggest first": True, "most first": True}
+_COMPARATORS = {"over": ">", "above": ">", "greater than": ">", "more than": ">", "at least": ">=",
+                "under": "<", "below": "<", "less than": "<", "fewer than": "<", "at most": "<=",
+                ">=": ">=", "<=": "<=", ">": ">", "<": "<"}
+
+
+def _column_matches(words: list[str], columns: list[str]) -> list[str]:
+    """Columns of the set that `words` (stemmed) name, best fit first; [] when none do."""
+    want = set(words)
+    scored = []
+    for col in columns:
+        tokens = {_stem(t) for t in col.split("_")} - _GENERIC_COLUMN_WORDS
+        if want <= tokens:
+            scored.append((len(tokens - want), col))
+    if not scored:
+        return []
+    best = min(score for score, _ in scored)
+    return [col for score, col in scored if score == best]
+
+
+def _column_phrase(text: str, columns: list[str], backwards: bool = False) -> tuple[list[str], int]:
+    """Longest run of column words at the start (or end) of `text` → (matching columns, chars consumed)."""
+    words = list(re.finditer(r"[a-z0-9]+", text))
+    if backwards:
+        words = words[::-1]
+    run = []
+    for m in words:
+        stem = _stem(m.group())
+        if stem not in _COLUMN_WORDS:
+            break
+        run.append(m)
+    while run:
+        matches = _column_matches([_stem(m.group()) for m in run], columns)
+        if matches:
+            span = (run[-1].start() if backwards else run[-1].end())
+            return matches, (len(text) - span if backwards else span)
+        run.pop()
+    return [], 0
+
+
+def _column_spans(text: str, columns: list[str]) -> list[tuple[int, int]]:
+    """(start, end) of every run of two or more column words in `text` that names a column."""
+    spans = []
+    run: list[re.Match] = []
+    for m in list(re.finditer(r"[a-z0-9]+", text)) + [None]:
+        if m is not None and _stem(m.group()) in _COLUMN_WORDS:
+            run.append(m)
+            continue
+        if len(run) > 1 and _column_matches([_stem(w.group()) for w in run], columns):
+            spans.append((run[0].start(), run[-1].end()))
+        run = []
+    return spans
+
+
+def _parse_number(text: str, unit: str) -> Optional[float]:
+    try:
+        value = float(text.replace(",", ""))
+    except ValueError:
+        return None
+    return value * {"k": 1e3, "m": 1e6}.get(unit, 1)
+
+
+def plan_followup(question: str, sets: list[dict]) -> Optional[dict]:
+    """Local plan for a follow-up over the newest retained set that covers it, or None."""
+    for result_set in sets:
+        steps = _parse_followup(question, result_set)
+        if steps is not None:
+            return {"set": result_set, **steps}
+    return None
+
+
+def _parse_followup(question: str, result_set: dict) -> Optional[dict]:
+    if _TIME_WORDS.intersection(_route_tokens(question)) or _PERIOD_RE.search(question):
+        return None                             # time-scoped — the retained rows cover one period only
+    columns = result_set["columns"]
+    rows = result_set["rows"]
+    q = " " + question.lower().strip().rstrip("?!. ") + " "
+    filters: list[tuple[str, str, object]] = []
+    sort: Optional[tuple[str, bool]] = None
+    limit: Optional[int] = None
+
+    def blank(start: int, end: int) -> None:
+        nonlocal q
+        q = q[:start] + " " * (end - start) + q[end:]
+
+    # Multi-word column names ("active seats" → seats_active) are projections, even
+    # when one of their words is also a cell value ("Active" status).
+    column_spans = _column_spans(q, columns)
+
+    # Values of text columns: "only Enterprise", "excluding EMEA", "at-risk ones"
+    values = sorted({(str(r[i]).lower(), col) for i, col in enumerate(columns) for r in rows
+                     if isinstance(r[i], str) and r[i].strip()}, key=lambda vc: -len(vc[0]))
+    value_cols: dict[str, set[str]] = {}
+    for value, col in values:
+        value_cols.setdefault(value, set()).add(col)
+    matched: dict[tuple[str, bool], list[str]] = {}
+    for value, col in values:
+        m = re.search(r"(?<![\w-])" + re.escape(value) + r"(?![\w-])", q)
+        if m is None or any(a <= m.start() and m.end() <= b for a, b in column_spans):
+            continue
+        if len(value_cols[value]) > 1:
+            return None                         # the value is in several columns — which one?
+        neg = re.search(_NEGATIONS, q[:m.start()])
+        matched.setdefault((col, neg is not None), []).append(value)
+        blank(neg.start() if neg else m.start(), m.end())
+    filters += [(col, "not_in" if negated else "in", vals) for (col, negated), vals in matched.items()]
+
+    # Numeric comparisons: "with ARR over 100k", "health score below 50"
+    for m in list(re.finditer(r"(" + "|".join(re.escape(c) for c in sorted(_COMPARATORS, key=len, reverse=True))
+                              + r")\s*\$?([\d][\d,]*(?:\.\d+)?)\s*(k|m|%)?(?![\w])", q))[::-1]:
+        cols, used = _column_phrase(re.sub(r"\s+(?:is|of|with)\s*$", "", q[:m.start()]), columns, backwards=True)
+        value = _parse_number(m.group(2), m.group(3) or "")
+        if len(cols) != 1 or value is None:
+            return None
+        idx = columns.index(cols[0])
+        if m.group(3) == "%" and all(abs(r[idx]) <= 1 for r in rows if isinstance(r[idx], (int, float))):
+            value /= 100        # stored as a fraction
+        filters.append((cols[0], _COMPARATORS[m.group(1)], value))
+        blank(m.start(), m.end())
+        head = re.sub(r"\s+(?:is|of|with)\s*$", "", q[:m.start()])
+        blank(len(head) - used, len(head))
+
+    # "top 5" / "bottom 3" / "first 10"
+    m = re.search(r"\b(top|bottom|first)\s+(\d+)\b", q)
+    if m:
+        limit = int(m.group(2))
+        blank(m.start(), m.end())
+        direction = {"top": True, "bottom": False}.get(m.group(1))
+    else:
+        direction = None
+
+    # "by ARR", "highest seat utilization first"
+    m = re.search(r"\bby\s+", q) or re.search(r"\b(?:highest|largest|biggest|most|lowest|smallest|fewest|least)\s+", q)
+    if m:
+        cols, used = _column_phrase(q[m.end():], columns)
+        if len(cols) != 1:
+            return None
+        word = m.group().split()[0]
+        if word != "by":
+            direction = word in ("highest", "largest", "biggest", "most")
+            # "which one has the highest …" asks for a single row; "which ones …" is unclear
+            if limit is None and re.search(r"\b(?:which|what)\s+(?:one|customer|account|company|client)\b"
+                                           r"|\bwho\s+(?:has|is|had)\b", q):
+                limit = 1
+            elif limit is None and re.search(r"\b(?:which|what|who)\b", q):
+                return None
+        sort = (cols[0], direction)
+        blank(m.start(), m.end() + used)
+    for phrase, desc in _DIRECTIONS.items():
+        m = re.search(r"\b" + phrase + r"\b", q)
+        if m:
+            if sort is None:
+                return None
+            sort = (sort[0], desc)
+            blank(m.start(), m.end())
+    if limit is not None and sort is None and direction is not None:
+        return None                             # "top 5" of what? let the model decide
+    if sort is not None and sort[1] is None:
+        idx = columns.index(sort[0])
+        sort = (sort[0], any(isinstance(r[idx], (int, float)) for r in rows))   # numbers high → low
+
+    # Whatever is left: column words → projection; anything unknown → not a local follow-up
+    table_words = {_stem(w) for t in sql_tables(result_set["sql"]) for w in t.split("_")}
+    project: list[str] = []
+    run: list[str] = []
+    for word in re.findall(r"[a-z0-9]+", q) + [""]:
+        stem = _stem(word)
+        if stem in _COLUMN_WORDS and stem not in table_words:
+            run.append(stem)
+            continue
+        if run:
+            cols = _column_matches(run, columns)
+            if not cols:
+                return None                     # names data the retained set doesn't have
+            project += [c for c in cols if c not in project]
+            run = []
+        if word and stem not in _FOLLOWUP_FILLER and stem not in table_words:
+            return None
+
+    if not (filters or sort or limit or project):
+        return None
+    if (filters or sort or limit) and not result_set.get("complete"):
+        return None
+    return {"filters": filters, "sort": sort, "limit": limit, "project": project}
+
+
+def run_followup(plan: dict, question: str) -> dict:
+    """Apply a plan_followup plan to its retained rows. Returns a new result set."""
+    result_set = plan["set"]
+    columns = result_set["columns"]
+    rows = list(result_set["rows"])
+    applied = []
+    for col, op, value in plan["filters"]:
+        i = columns.index(col)
+        if op in ("in", "not_in"):
+            keep = op == "in"
+            rows = [r for r in rows if (str(r[i]).lower() in value) == keep]
+            applied.append(f"{col} {'in' if keep else 'not in'} ({', '.join(value)})")
+        else:
+            check = {">": float.__gt__, ">=": float.__ge__, "<": float.__lt__, "<=": float.__le__}[op]
+            rows = [r for r in rows if isinstance(r[i], (int, float)) and check(float(r[i]), value)]
+            applied.append(f"{col} {op} {_fmt_cell(value)}")
+    if plan["sort"] is not None:
+        col, desc = plan["sort"]
+        i = columns.index(col)
+        present = sorted((r for r in rows if r[i] is not None), key=lambda r: r[i], reverse=desc)
+        rows = present + [r for r in rows if r[i] is None]
+        applied.append(f"sorted by {col} {'desc' if desc else 'asc'}")
+    if plan["limit"] is not None:
+        rows = rows[:plan["limit"]]
+        applied.append(f"first {plan['limit']} rows")
+    if plan["project"]:
+        ids = [c for c in columns if c.endswith("_id") or c == "name"]
+        extra = [c for c, _, _ in plan["filters"]] + ([plan["sort"][0]] if plan["sort"] else [])
+        keep = [c for c in columns if c in ids or c in plan["project"] or c in extra]
+        idx = [columns.index(c) for c in keep]
+        rows = [tuple(r[i] for i in idx) for r in rows]
+        columns = keep
+        applied.append(f"columns {', '.join(plan['project'])}")
+    return {"label": result_set.get("label"), "sql": result_set["sql"], "columns": columns, "rows": rows,
+            "total_rows": len(rows), "complete": result_set.get("complete", False),
+            "question": question, "applied": "; ".join(applied)}
+
+
+def _retained_sets(result: dict, question: str) -> list[dict]:
+    """Result sets worth keeping from one BigQuery fetch (each plan part separately)."""
+    out = []
+    for part in result.get("parts", [result]):
+        if part.get("status") == "success" and part.get("columns"):
+            encoding = part.get("encoding") or {}
+            out.append({"label": part.get("label"), "sql": part["sql"], "columns": part["columns"],
+                        "rows": part["rows"], "total_rows": part["total_rows"], "question": question,
+                        "complete": encoding.get("fetched") == encoding.get("rows")
+                        and encoding.get("rows", 0) < BQ_MAX_ROWS})
+    return out
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# SPECULATIVE SQL  (generation overlapped with LLM routing)
+# ══════════════════════════════════════════════════════════════════════════════
+# The LLM router sends nearly every business question to BigQuery, so when a
+# question needs a Gemini routing round trip, SQL generation (and optionally
+# its dry-run) starts at the same time. Once the route is known the work is
+# adopted, or cancelled if the route needs no generated SQL. Each request
+# reports saved vs wasted time; totals accumulate on /health for tuning.
+
+_speculation_totals = {"started": 0, "adopted": 0, "discarded": 0, "failed": 0,
+                       "saved_ms": 0.0, "wasted_ms": 0.0}
+
+
+class SqlSpeculation:
+    """One request's speculative SQL generation."""
+
+    def __init__(self, question: str, history: list[dict]):
+        self.question = question
+        self.history = history
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = 0.0
+        self.finished_at: Optional[float] = None
+        self.report = {"outcome": "not_started", "saved_ms": 0.0, "wasted_ms": 0.0}
+
+    def start(self) -> None:
+        if not (SPECULATIVE_SQL and GENAI_OK and BQ_OK and _bq_client):
+            return
+        self.started_at = time.perf_counter()
+        self.task = asyncio.create_task(self._run())
+        _speculation_totals["started"] += 1
+
+    async def _run(self) -> dict:
+        try:
+            sql = await _generate_sql(self.question, self.question, self.history)
+            validated, scan_bytes = False, None
+            if SPECULATIVE_DRY_RUN and sql != "NO_SQL_NEEDED" and len(parse_sql_plan(sql)) == 1:
+                try:
+                    job = await _run_blocking(_bq_dry_run, sql)
+                    validated, scan_bytes = True, getattr(job, "total_bytes_processed", None)
+                except Exception:
+                    pass    # the normal path self-corrects
+            return {"sql": sql, "validated": validated, "scan_bytes": scan_bytes}
+        finally:
+            self.finished_at = time.perf_counter()
+
+    def wanted(self, route: dict) -> bool:
+        """Whether this route will need model-generated SQL at all."""
+        return bool(
+            route.get("needs_sql") and "bigquery" in route.get("sources", ["bigquery"])
+            and not (route.get("metric") and _semantic.can_compile(
+                route["metric"], self.question, _fast_router._entity_words(self.question)))
+        )
+
+    async def resolve(self, route: dict) -> Optional[dict]:
+        """Adopt the speculative SQL for this route, or discard it. Returns {"sql", "validated", "scan_bytes"} or None."""
+        if self.task is None or self.report["outcome"] != "not_started":
+            return None
+        routed_at = time.perf_counter()
+        if not self.wanted(route):
+            self.task.cancel()
+            end = self.finished_at or routed_at
+            self._close("discarded", wasted_ms=(end - self.started_at) * 1000)
+            return None
+        try:
+            result = await self.task
+        except Exception:
+            self._close("failed", wasted_ms=((self.finished_at or routed_at) - self.started_at) * 1000)
+            return None
+        # Without speculation generation would have started at routed_at.
+        duration = self.finished_at - self.started_at
+        saved = min(duration, routed_at - self.started_at)
+        self._close("adopted", saved_ms=saved * 1000)
+        return result
+
+    def _close(self, outcome: str, saved_ms: float = 0.0, wasted_ms: float = 0.0) -> None:
+        self.report = {"outcome": outcome, "saved_ms": round(saved_ms, 1), "wasted_ms": round(wasted_ms, 1)}
+        _speculation_totals[outcome] += 1
+        _speculation_totals["saved_ms"] += saved_ms
+        _speculation_totals["wasted_ms"] += wasted_ms
+
+
+def speculation_stats() -> dict:
+    return {
+        "enabled": SPECULATIVE_SQL,
+        "dry_run": SPECULATIVE_DRY_RUN,
+        **{k: round(v, 1) if isinstance(v, float) else v for k, v in _speculation_totals.items()},
+    }
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# STAGE 2: SOURCE FAN-OUT  (every selected source fetched concurrently)
+# ══════════════════════════════════════════════════════════════════════════════
+# Each source registers an async fetcher with its own deadline. The scheduler
+# starts every selected fetcher at once and relays events as they happen —
+# including one `source_done` per source — so Stage 2 takes as long as the
+# slowest source, not the sum. Blocks are assembled in registration order so
+# the answer prompt is stable regardless of which source finished first.
+#
+# Fetcher signature:  async fn(ctx, emit) -> {"block": str, ...}
+#   ctx   {"question", "history", "route", "speculation", "conversation_id", "followup"}
+#   emit  callback for intermediate SSE payloads (dicts)
+
+SOURCE_FETCHERS: dict[str, dict] = {}
+
+
+def source_fetcher(name: str, deadline_s: float, selected: Callable[[dict], bool]):
+    """Register a Stage 2 source. `selected(route)` decides whether it runs for a query."""
+    def register(fn):
+        SOURCE_FETCHERS[name] = {"fn": fn, "deadline_s": deadline_s, "selected": selected}
+        return fn
+    return register
+
+
+@source_fetcher(
+    "bigquery", BQ_DEADLINE_S,
+    lambda route: bool(route.get("needs_sql")) and "bigquery" in route.get("sources", ["bigquery"]),
+)
+async def fetch_bigquery(ctx: dict, emit: Callable[[dict], None]) -> dict:
+    route = ctx["route"]
+    if ctx.get("followup") is not None:
+        if route.get("query_type") == "followup":
+            return _followup_source(ctx, emit)
+        _conversation_results.declined += 1
+    speculation: Optional[SqlSpeculation] = ctx.get("speculation")
+    pregenerated = None
+    if speculation is not None and speculation.task is not None:
+        pregenerated = await speculation.resolve(route)
+        emit({"event": "speculation", **speculation.report})
+    preview: dict[Optional[str], int] = {}
+
+    def on_page(columns: list[str], rows: list[tuple], fetched: int, part: Optional[str] = None) -> None:
+        # First BQ_PREVIEW_ROWS rows (per plan part) go to the frontend as they land; later pages report progress only
+        rows = rows[:max(0, BQ_PREVIEW_ROWS - preview.get(part, 0))]
+        preview[part] = preview.get(part, 0) + len(rows)
+        emit({"event": "rows", "source": "bigquery", "part": part, "columns": columns,
+              "rows": json.loads(json.dumps(rows, default=str)), "fetched": fetched})
+
+    result = await generate_and_run_sql(
+        ctx["question"], route.get("sql_intent") or ctx["question"], ctx["history"],
+        route.get("metric"), pregenerated, on_page,
+    )
+    if result.get("sql"):
+        emit({
+            "event": "sql", "sql": result["sql"], "status": result.get("status"),
+            "metric": result.get("metric"), "cache": result.get("cache"),
+            "encoding": result.get("encoding"), "validation": result.get("validation"),
+            "cost": result.get("cost"), "plan": result.get("plan"),
+            "parts": [{k: p.get(k) for k in ("label", "status", "row_count", "ms", "cache", "validation", "cost")}
+                      for p in result.get("parts", [])] or None,
+        })
+    _conversation_results.put(ctx.get("conversation_id"), _retained_sets(result, ctx["question"]))
+    blocks = [_bq_block(part, part.get("label")) for part in result.get("parts", [result])]
+    out = {"block": "".join(block for block, _ in blocks), "status": result.get("status"), "kind": "sql"}
+    if any(compact for _, compact in blocks):
+        sizes = [max(1, estimate_tokens(block)) for block, _ in blocks]
+
+        def compact_all(tokens: int) -> str:
+            # Each part keeps a share of the budget proportional to its full size
+            return "".join(compact(tokens * size // sum(sizes)) if compact else block
+                           for (block, compact), size in zip(blocks, sizes))
+        out["compact"] = compact_all
+    return out
+
+
+def _followup_source(ctx: dict, emit: Callable[[dict], None]) -> dict:
+    """Answer the BigQuery side of a follow-up from the retained result set."""
+    derived = run_followup(ctx["followup"], ctx["question"])
+    _conversation_results.reused += 1
+    _conversation_results.put(ctx.get("conversation_id"), [derived])
+    columns, rows = derived["columns"], derived["rows"]
+    sql = f"-- previous result, re-queried locally: {derived['applied']}\n{derived['sql']}"
+    emit({"event": "rows", "source": "bigquery", "part": derived["label"], "columns": columns,
+          "rows": json.loads(json.dumps(rows[:BQ_PREVIEW_ROWS], default=str)), "fetched": len(rows)})
+    emit({"event": "sql", "sql": sql, "status": "success", "cache": "followup",
+          "followup": {"applied": derived["applied"], "rows": len(rows),
+                       "from_rows": len(ctx["followup"]["set"]["rows"])}})
+    data, encoding = encode_rows(columns, rows, RESULT_TOKEN_BUDGET, "BigQuery results")
+    result = {"status": "success", "sql": sql, "columns": columns, "rows": rows, "total_rows": len(rows),
+              "data": f"Re-queried locally from the previous answer's result ({derived['applied']}).\n{data}"}
+    block, compact = _bq_block(result, derived["label"])
+    return {"block": block, "status": "followup", "kind": "sql", "compact": compact}
+
+
+def _bq_block(result: dict, label: Optional[str] = None) -> tuple[str, Optional[Callable[[int], str]]]:
+    """(source block, compaction fn or None) for one BigQuery result or plan part."""
+    data = result.get("data", "")
+    title = f"BigQuery ({BQ_DATASET})" + (f" — {label}" if label else "")
+    head = f"\n{'='*50}\nSOURCE: {title}\n{'='*50}\n" + (f"SQL: {result['sql']}\n" if label else "")
+    if not data:
+        return "", None
+    if not result.get("rows"):
+        return f"{head}{data}\n", None
+    columns, rows, total = result["columns"], result["rows"], result["total_rows"]
+    return f"{head}{data}\n", lambda tokens: head + encode_rows(
+        columns, rows, tokens - estimate_tokens(head), "BigQuery results", total)[0] + "\n"
+
+
+def _wants_upload_sql(route: dict) -> bool:
+    return bool(route.get("upload_sql")) and _upload_tables.has_tables()
+
+
+@source_fetcher(
+    "uploaded", UPLOADS_DEADLINE_S,
+    lambda route: "uploaded" in route.get("sources", ["bigquery"]) and bool(_upload_index)
+    and not _wants_upload_sql(route),
+)
+async def fetch_uploads(ctx: dict, emit: Callable[[dict], None]) -> dict:
+    header, passages = await _run_blocking(upload_passages, ctx["question"])
+    if not passages:
+        return {"block": ""}
+    head = f"\n{'='*50}\nSOURCE: USER UPLOADS ({len(_upload_index)} file(s))\n{'='*50}\n"
+
+    def render(keep: list[str]) -> str:
+        return f"{head}{header}\nShowing {len(keep)} most relevant passage(s).\n\n" + "\n\n".join(keep) + "\n"
+
+    def compact(tokens: int) -> str:
+        # Passages are ranked — drop from the tail, then clip the top one if even that is too long
+        keep = list(passages)
+        while len(keep) > 1 and estimate_tokens(render(keep)) > tokens:
+            keep.pop()
+        return _trim_to_tokens(render(keep), tokens)
+
+    return {"block": render(passages), "kind": "uploads", "compact": compact}
+
+
+UPLOAD_SQL_PROMPT = """You write SQLite SQL over tables loaded from the user's uploaded spreadsheets.
+
+Tables (with example rows):
+{tables}
+
+Conversation history:
+{history}
+
+Intent from router: {intent}
+User question: {question}
+{error}
+Write ONE SQLite SELECT statement. Use only the tables and columns above, quote nothing
+unless needed, aggregate in SQL rather than returning raw rows, LIMIT 200.
+Return ONLY the SQL. No markdown fences, no explanation."""
+
+
+async def run_upload_sql(question: str, intent: str, history: list[dict]) -> dict:
+    """Generate SQLite SQL over the upload tables and run it locally; one retry with the error."""
+    error = ""
+    sql = ""
+    for _ in range(2):
+        prompt = UPLOAD_SQL_PROMPT.format(
+            tables=_upload_tables.schema_text(), history=_sql_history_text(history),
+            intent=intent, question=question, error=error,
+        )
+        text = await _generate_text(_answer_model, prompt)
+        sql = text.strip().replace("```sql", "").replace("```", "").strip()
+        try:
+            columns, rows = await _run_blocking(_upload_tables.query, sql)
+        except (sqlite3.Error, ValueError) as e:
+            error = f"\nYour previous SQL failed:\n{sql}\nError: {e}\nFix it.\n"
+            continue
+        data, _ = encode_rows(columns, rows, RESULT_TOKEN_BUDGET, "Rows")
+        return {"status": "success", "sql": sql, "row_count": len(rows), "data": data,
+                "columns": columns, "rows": rows}
+    return {"status": "failed", "sql": sql, "error": error.strip()}
+
+
+@source_fetcher("upload_tables", UPLOADS_DEADLINE_S, _wants_upload_sql)
+async def fetch_upload_tables(ctx: dict, emit: Callable[[dict], None]) -> dict:
+    route = ctx["route"]
+    try:
+        result = await run_upload_sql(ctx["question"], route.get("upload_sql") or ctx["question"], ctx["history"])
+    except Exception as e:      # model unavailable / errored
+        result = {"status": "failed", "sql": None, "error": str(e)}
+    emit({"event": "upload_sql", "sql": result.get("sql"), "status": result["status"],
+          "row_count": result.get("row_count", 0)})
+    if result["status"] != "success":
+        # No usable local SQL — fall back to passage retrieval so the answer still has the data
+        out = await fetch_uploads(ctx, emit)
+        return {**out, "status": "fallback"}
+    head = f"\n{'='*50}\nSOURCE: Uploaded tables (local SQL)\n{'='*50}\nSQL: {result['sql']}\n"
+    columns, rows = result["columns"], result["rows"]
+    return {"block": f"{head}{result['data']}\n", "status": "ok", "kind": "sql",
+            "compact": lambda tokens: head + encode_rows(columns, rows, tokens - estimate_tokens(head), "Rows")[0] + "\n"}
+
+
+async def fan_out_sources(ctx: dict, results: dict[str, dict]) -> AsyncIterator[dict]:
+    """Run every selected fetcher concurrently; yield SSE payloads as they occur.
+
+    Fills `results` with {source: {"block", "status", "ms", ...}} in registration order.
+    """
+    selected = [name for name, f in SOURCE_FETCHERS.items() if f["selected"](ctx["route"])]
+    if not selected:
+        return
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def run_one(name: str):
+        spec = SOURCE_FETCHERS[name]
+        t0 = time.perf_counter()
+        try:
+            out = await asyncio.wait_for(spec["fn"](ctx, queue.put_nowait), timeout=spec["deadline_s"])
+            out.setdefault("status", "ok")
+        except asyncio.TimeoutError:
+            out = {"status": "timeout",
+                   "block": f"\n{'='*50}\nSOURCE: {name} — no data (timed out after {spec['deadline_s']:.0f}s)\n{'='*50}\n"}
+        except Exception as e:
+            out = {"status": "error", "error": str(e), "block": ""}
+        out["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        results[name] = out
+        queue.put_nowait({"event": "source_done", "source": name, "status": out["status"], "ms": out["ms"]})
+
+    tasks = [asyncio.create_task(run_one(name)) for name in selected]
+    try:
+        pending = len(tasks)
+        while pending:
+            payload = await queue.get()
+            if payload.get("event") == "source_done":
+                pending -= 1
+            yield payload
+    finally:
+        for t in tasks:
+            t.cancel()
+
+    ordered = {name: results[name] for name in selected}
+    results.clear()
+    results.update(ordered)
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # STAGE 3: ANSWER GENERATION (streaming)
 # ══════════════════════════════════════════════════════════════════════════════
 
 ANSWER_SYSTEM = """You are the saasmetrics.ai Enterprise Data Assistant.
 You help business leaders get accurate, grounded answers from enterprise data.
-
-DATA DICTIONARY — Column disambiguation rules:
-{data_dict}
+Each request carries the data dictionary entries relevant to its question.
 
 STRICT RULES — follow every one:
 1. GROUND every claim in the source data provided. Never use training memory for numbers.
@@ -606,7 +4412,10 @@ STRICT RULES — follow every one:
 
 Respond in markdown with inline citations. Be concise and direct. Lead with the answer, not the method."""
 
-ANSWER_USER = """SOURCE DATA:
+ANSWER_USER = """DATA DICTIONARY — Column disambiguation rules:
+{data_dict}
+
+SOURCE DATA:
 {source_blocks}
 
 CONVERSATION HISTORY:
@@ -618,47 +4427,174 @@ Also include at the end of your response this JSON block on its own line (do not
 METADATA::{{"sources_used": {sources_list}, "disambiguation_notes": "...", "confidence": "high/medium/low", "query_type": "{query_type}", "intent_tag": "{intent_tag}"}}"""
 
 
+# ── Prompt budget ─────────────────────────────────────────────────────────────
+# The answer prompt is measured component by component before the call. When
+# it exceeds ANSWER_TOKEN_BUDGET, components are compacted lowest priority
+# first — dictionary, then history, then upload passages, then SQL results —
+# each down to at most its floor, until the prompt fits. Sources compact via
+# the "compact" callback their fetcher returned (re-encoding rows, dropping
+# low-ranked passages); anything else is clipped at a line boundary.
+
+PROMPT_PRIORITY = ("sql", "uploads", "history", "dictionary")   # keep-first order
+PROMPT_FLOORS = {"sql": 600, "uploads": 400, "history": 150, "dictionary": 1000}
+
+
+def _trim_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    marker = "\n... (trimmed to fit the prompt budget)\n"
+    keep = max(0, max_tokens * 4 - len(marker))
+    cut = text.rfind("\n", 0, keep)
+    return text[: cut if cut > keep // 2 else keep] + marker
+
+
+def _history_text(history: list[dict], max_tokens: Optional[int] = None) -> str:
+    """Most recent HISTORY_WINDOW turns; with `max_tokens`, as many of the latest as fit."""
+    lines = [
+        f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}"
+        for m in history[-HISTORY_WINDOW:]
+    ]
+    if max_tokens is not None:
+        kept, used = [], 0
+        for line in reversed(lines):
+            used += estimate_tokens(line) + 1
+            if used > max_tokens:
+                if not kept:        # even the last turn is too long — keep its head
+                    kept.append(_trim_to_tokens(line, max_tokens))
+                break
+            kept.append(line)
+        lines = kept[::-1]
+    return "\n".join(lines) or "(none)"
+
+
+def allocate_prompt_budget(parts: dict[str, dict], fixed_tokens: int, budget: int) -> dict:
+    """Shrink `parts` ({kind: {"text", "compact"}}) in place to fit `budget`; return the allocation."""
+    original = {k: estimate_tokens(p["text"]) for k, p in parts.items()}
+    over = fixed_tokens + sum(original.values()) - budget
+    for kind in reversed(PROMPT_PRIORITY):
+        if over <= 0:
+            break
+        part = parts.get(kind)
+        if part is None:
+            continue
+        size = estimate_tokens(part["text"])
+        target = max(PROMPT_FLOORS.get(kind, 0), size - over)
+        if target >= size:
+            continue
+        part["text"] = part["compact"](target)
+        over -= size - estimate_tokens(part["text"])
+    final = {k: estimate_tokens(p["text"]) for k, p in parts.items()}
+    return {
+        "budget": budget,
+        "fixed": fixed_tokens,
+        "total": fixed_tokens + sum(final.values()),
+        "components": {k: {"tokens": final[k], "original": original[k], "trimmed": final[k] < original[k]}
+                       for k in parts},
+        "over_budget": over > 0,
+    }
+
+
+def _source_part(blocks: list[dict]) -> dict:
+    """Several source blocks as one budget component; compaction splits tokens by current size."""
+    def compact(tokens: int) -> str:
+        total = sum(estimate_tokens(b["block"]) for b in blocks) or 1
+        out = []
+        for b in blocks:
+            share = tokens * estimate_tokens(b["block"]) // total
+            fn = b.get("compact") or (lambda t, text=b["block"]: _trim_to_tokens(text, t))
+            out.append(fn(share))
+        return "".join(out)
+    return {"text": "".join(b["block"] for b in blocks), "compact": compact}
+
+
+def build_answer_prompt(
+    question: str,
+    history: list[dict],
+    source_results: dict[str, dict],
+    sources_used: list[str],
+    query_type: str,
+    intent_tag: str,
+    budget: int = ANSWER_TOKEN_BUDGET,
+) -> tuple[str, str, dict]:
+    """(system, user message, allocation) for Stage 3, fitted to `budget` tokens."""
+    # Blocks without a kind (timeouts, future sources) are kept verbatim as fixed cost
+    by_kind: dict[str, list[dict]] = {}
+    for r in source_results.values():
+        if r.get("block"):
+            by_kind.setdefault(r.get("kind", "other"), []).append(r)
+    parts = {kind: _source_part(by_kind[kind]) for kind in ("sql", "uploads") if kind in by_kind}
+    parts["history"] = {"text": _history_text(history),
+                        "compact": lambda tokens: _history_text(history, tokens)}
+    prune_text = _prune_text(question, history)
+    selection = _dictionary.select(prune_text)
+    data_dict = _dictionary.render_dictionary(selection, prune_text)
+    _dictionary.record(selection, data_dict)
+
+    def compact_dictionary(tokens: int) -> str:
+        if tokens <= 0:
+            return "(omitted to fit the prompt budget)"
+        return _trim_to_tokens(_dictionary.render_dictionary(selection, prune_text, examples=False), tokens)
+
+    parts["dictionary"] = {"text": data_dict, "compact": compact_dictionary}
+
+    skeleton_user = ANSWER_USER.format(
+        data_dict="",
+        source_blocks="".join(r["block"] for kind, rs in by_kind.items() if kind not in parts for r in rs),
+        history="", question=question, sources_list=json.dumps(sources_used),
+        query_type=query_type, intent_tag=intent_tag,
+    )
+    allocation = allocate_prompt_budget(
+        parts, estimate_tokens(ANSWER_SYSTEM) + estimate_tokens(skeleton_user), budget)
+
+    # Reassemble in registration order: compacted kinds take the place of their first block
+    blocks, placed = [], set()
+    for r in source_results.values():
+        kind = r.get("kind", "other")
+        if kind in ("sql", "uploads") and kind in parts:
+            if kind not in placed:
+                blocks.append(parts[kind]["text"])
+                placed.add(kind)
+        elif r.get("block"):
+            blocks.append(r["block"])
+
+    user_msg = ANSWER_USER.format(
+        data_dict=parts["dictionary"]["text"],
+        source_blocks="".join(blocks),
+        history=parts["history"]["text"],
+        question=question,
+        sources_list=json.dumps(sources_used),
+        query_type=query_type,
+        intent_tag=intent_tag,
+    )
+    return ANSWER_SYSTEM, user_msg, allocation
+
+
 async def stream_answer(
     question: str,
     history: list[dict],
-    source_blocks: str,
+    source_results: dict[str, dict],
     sources_used: list[str],
     query_type: str,
     intent_tag: str,
 ) -> AsyncIterator[str]:
-    """Stage 3: Stream answer tokens via SSE."""
+    """Stage 3: Stream answer tokens via SSE. The done event reports the prompt allocation."""
     if not GENAI_OK:
         yield "data: " + json.dumps({"token": "⚠️ GEMINI_API_KEY not configured.", "done": False}) + "\n\n"
         yield "data: " + json.dumps({"done": True, "metadata": {}}) + "\n\n"
         return
 
-    history_text = "\n".join(
-        f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content']}"
-        for m in history[-HISTORY_WINDOW:]
-    ) or "(none)"
-
-    system = ANSWER_SYSTEM.format(data_dict=DATA_DICT)
-    user_msg = ANSWER_USER.format(
-        source_blocks=source_blocks,
-        history=history_text,
-        question=question,
-        sources_list=json.dumps(sources_used),
-        query_type=query_type,
-        intent_tag=intent_tag,
+    system, user_msg, allocation = build_answer_prompt(
+        question, history, source_results, sources_used, query_type, intent_tag,
     )
 
     try:
-        model = genai.GenerativeModel(
-            ANSWER_MODEL,
-            system_instruction=system,
-        )
-        stream = model.generate_content(user_msg, stream=True)
-
+        model = await _run_blocking(_prompt_cache.model, ANSWER_MODEL, system)
         full_text = ""
-        for chunk in stream:
-            if chunk.text:
-                full_text += chunk.text
-                yield "data: " + json.dumps({"token": chunk.text, "done": False}) + "\n\n"
+        usage: dict = {}
+        async for text in _stream_text(model, user_msg, usage):
+            full_text += text
+            yield "data: " + json.dumps({"token": text, "done": False}) + "\n\n"
+        _prompt_cache.record_usage(usage)
 
         # Extract metadata JSON from end of response
         metadata = {}
@@ -668,6 +4604,7 @@ async def stream_answer(
                 metadata = json.loads(meta_match.group(1))
             except Exception:
                 metadata = {}
+        metadata["prompt_budget"] = allocation
 
         yield "data: " + json.dumps({"done": True, "metadata": metadata}) + "\n\n"
 
@@ -691,15 +4628,22 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def startup():
-    """Re-index uploads from local on startup. Non-blocking."""
-    try:
-        loop = asyncio.get_event_loop()
-        await asyncio.wait_for(
-            loop.run_in_executor(None, restore_uploads_from_storage),
-            timeout=5.0
-        )
-    except Exception:
-        pass  # Never block startup
+    """Re-index uploads in the background. Non-blocking; /health reports progress.
+
+    Restore runs to completion rather than under a deadline, so slow storage
+    delays files instead of dropping them from the index.
+    """
+    asyncio.get_running_loop().run_in_executor(None, restore_uploads_from_storage)
+    _ensure_upload_workers()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Stop ingest worker processes and parse threads; close the result-cache store."""
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=False, cancel_futures=True)
+    _ingest_threads.shutdown(wait=False, cancel_futures=True)
+    _bq_result_cache.close()
 
 
 # ── Health ────────────────────────────────────────────────────────────────────
@@ -709,6 +4653,7 @@ def health():
         "status": "ok",
         "gemini": GENAI_OK,
         "bigquery": BQ_OK,
+        "query_backend": _bq_client.stats() if isinstance(_bq_client, LocalBQClient) else BQ_BACKEND,
         "gcs": GCS_OK,
         "router_model": ROUTER_MODEL,
         "answer_model": ANSWER_MODEL,
@@ -716,6 +4661,25 @@ def health():
 
         },
         "uploads_indexed": len(_upload_index),
+        "uploads_ready": _restore_state["ready"],
+        "uploads_restore": _restore_state,
+        "parse_cache": parse_cache_stats(),
+        "upload_jobs": upload_job_stats(),
+        "upload_tables": _upload_tables.stats(),
+        "upload_chunks": _chunk_index.stats(),
+        "upload_vectors": _vector_index.stats() if _vector_index is not None else None,
+        "router_cache": _router_cache.stats(),
+        "router_fastpath": _fast_router.stats(),
+        "dictionary_pruning": _dictionary.stats(),
+        "sql_validation": validation_stats(),
+        "cost_guard": cost_stats(),
+        "result_streaming": result_streaming_stats(),
+        "sql_plans": sql_plan_stats(),
+        "followup_reuse": _conversation_results.stats(),
+        "prompt_cache": _prompt_cache.stats(),
+        "semantic_layer": _semantic.stats(),
+        "bq_result_cache": _bq_result_cache.stats(),
+        "speculative_sql": speculation_stats(),
     }
 
 
@@ -727,6 +4691,7 @@ class Message(BaseModel):
 class QueryRequest(BaseModel):
     question: str
     history: List[Message] = []
+    conversation_id: Optional[str] = None     # enables follow-up reuse of earlier result sets
 
 
 @app.post("/query")
@@ -735,11 +4700,16 @@ async def query(req: QueryRequest):
     history  = [m.model_dump() for m in req.history]
 
     async def event_stream():
-        # ── Stage 1: Route ────────────────────────────────────────────────
-        route = await run_router(question, history)
+        # A follow-up the previous result can answer needs no speculative SQL
+        followup = None
+        retained = _conversation_results.get(req.conversation_id) if FOLLOWUP_REUSE and history else []
+        if retained:
+            followup = await _run_blocking(plan_followup, question, retained)
+
+        # ── Stage 1: Route (SQL generation speculates alongside LLM routing) ─
+        speculation = SqlSpeculation(question, history)
+        route = await run_router(question, history, on_llm_route=None if followup else speculation.start)
         sources   = route.get("sources", ["bigquery"])
-        needs_sql = route.get("needs_sql", False)
-        sql_intent= route.get("sql_intent", question)
         query_type= route.get("query_type", "single_source")
         intent_tag= route.get("intent_tag", "other")
 
@@ -750,42 +4720,25 @@ async def query(req: QueryRequest):
             "query_type": query_type,
             "intent_tag": intent_tag,
             "reasoning": route.get("reasoning", ""),
+            "router": route.get("router", "llm"),
         }) + "\n\n"
 
-        # ── Stage 2: Parallel source fetch ────────────────────────────────
-        source_blocks = ""
-        sql_used = None
-
-        # BQ + file sources fetched concurrently
-        tasks = {}
-        if needs_sql and "bigquery" in sources:
-            tasks["bq"] = asyncio.create_task(
-                generate_and_run_sql(question, sql_intent, history)
-            )
+        # Speculative SQL this route doesn't need is cancelled right away;
+        # otherwise the BigQuery fetcher adopts it.
+        if speculation.task is not None and not speculation.wanted(route):
+            await speculation.resolve(route)
+            yield "data: " + json.dumps({"event": "speculation", **speculation.report}) + "\n\n"
 
-        # Await BQ task
-        bq_result = None
-        if "bq" in tasks:
-            bq_result = await tasks["bq"]
-
-        # Assemble source blocks
-        if bq_result:
-            sql_used = bq_result.get("sql")
-            data = bq_result.get("data", "")
-            if data:
-                source_blocks += f"\n{'='*50}\nSOURCE: BigQuery ({BQ_DATASET})\n{'='*50}\n{data}\n"
-            # Emit SQL to frontend
-            if sql_used:
-                yield "data: " + json.dumps({"event": "sql", "sql": sql_used, "status": bq_result.get("status")}) + "\n\n"
-
-        if "uploaded" in sources and _upload_index:
-            uploads_text = get_uploads_text()
-            if uploads_text:
-                source_blocks += f"\n{'='*50}\nSOURCE: USER UPLOADS ({len(_upload_index)} file(s))\n{'='*50}\n{uploads_text}\n"
+        # ── Stage 2: Parallel source fetch ────────────────────────────────
+        results: dict[str, dict] = {}
+        ctx = {"question": question, "history": history, "route": route, "speculation": speculation,
+               "conversation_id": req.conversation_id, "followup": followup}
+        async for payload in fan_out_sources(ctx, results):
+            yield "data: " + json.dumps(payload) + "\n\n"
 
         # ── Stage 3: Stream answer ─────────────────────────────────────────
         async for chunk in stream_answer(
-            question, history, source_blocks,
+            question, history, results,
             sources, query_type, intent_tag
         ):
             yield chunk
@@ -801,7 +4754,7 @@ async def query(req: QueryRequest):
 
 
 # ── Uploads ───────────────────────────────────────────────────────────────────
-@app.post("/upload")
+@app.post("/upload", status_code=202)
 async def upload(file: UploadFile = File(...)):
     if Path(file.filename).suffix.lower() not in ALLOWED_EXTENSIONS:
         raise HTTPException(400, f"Unsupported type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}")
@@ -813,22 +4766,43 @@ async def upload(file: UploadFile = File(...)):
 
     safe_name = Path(file.filename).name.replace(" ", "_")
 
-    # Save to GCS (or local)
-    in_gcs = _gcs_upload(safe_name, content)
+    # Save to GCS (or local) before acknowledging; parse + index run as a job
+    in_gcs = await _run_blocking(_gcs_upload, safe_name, content)
     if not in_gcs:
-        (UPLOAD_DIR / safe_name).write_bytes(content)
+        await _run_blocking((UPLOAD_DIR / safe_name).write_bytes, content)
 
-    entry = _index_upload(safe_name, content, storage="gcs" if in_gcs else "local")
+    job = enqueue_upload(safe_name, content, storage="gcs" if in_gcs else "local")
     return {
         "success": True,
-        "filename": entry["filename"],
-        "source_type": entry["source_type"],
-        "size_kb": entry["size_kb"],
-        "storage": entry["storage"],
-        "preview": entry["preview"],
+        "job_id": job["job_id"],
+        "filename": safe_name,
+        "state": job["state"],
+        "storage": job["storage"],
+        "status_url": f"/upload/jobs/{job['job_id']}",
+        "events_url": f"/upload/jobs/{job['job_id']}/events",
     }
 
 
+@app.get("/upload/jobs/{job_id}")
+def get_upload_job(job_id: str):
+    job = _upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Unknown upload job")
+    return _job_view(job)
+
+
+@app.get("/upload/jobs/{job_id}/events")
+async def upload_job_stream(job_id: str):
+    job = _upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Unknown upload job")
+    return StreamingResponse(
+        upload_job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/uploads")
 def list_uploads():
     return {"files": get_uploads_manifest(), "count": len(_upload_index)}
@@ -837,15 +4811,22 @@ def list_uploads():
 @app.delete("/upload/{filename}")
 def delete_upload(filename: str):
     global _upload_index
-    existing = [f for f in _upload_index if f["filename"] == filename]
-    if not existing:
-        raise HTTPException(404, "File not found in index")
-    _upload_index = [f for f in _upload_index if f["filename"] != filename]
+    with _index_lock:
+        existing = [f for f in _upload_index if f["filename"] == filename]
+        cancelled = cancel_upload_jobs(filename)
+        if not existing and not cancelled:
+            raise HTTPException(404, "File not found in index")
+        _upload_index = [f for f in _upload_index if f["filename"] != filename]
+        _chunk_index.remove(filename)
+        if _vector_index is not None:
+            _vector_index.remove(filename)
+        _upload_tables.drop(filename)
+        _on_uploads_changed()
     _gcs_delete(filename)
     local = UPLOAD_DIR / filename
     if local.exists():
         local.unlink()
-    return {"success": True, "filename": filename}
+    return {"success": True, "filename": filename, "cancelled_jobs": cancelled}
 
 
 @app.post("/reload")
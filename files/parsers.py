@@ -0,0 +1,261 @@
+"""
+saasmetrics.ai  |  Upload parsers
+═══════════════════════════════════════════════════════════════
+Pure file parsers: bytes in, text / typed tables out. This is the only
+module the ingest process pool's workers import. Workers are spawned, so
+whatever a pickled task references gets imported fresh in each one;
+keeping the parsers here (stdlib + the optional parser libraries, no
+clients, no backends, no threads) means a worker never re-runs main.py's
+module-level setup — no genai.configure, BigQuery / GCS clients or
+LocalBQClient build per worker.
+
+Limits are read from the same env vars as main.py; spawned workers
+inherit the parent's environment (after load_dotenv), so both agree.
+═══════════════════════════════════════════════════════════════
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import math
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+EXCEL_MAX_ROWS        = int(os.getenv("EXCEL_MAX_ROWS", "500"))
+PDF_MAX_PAGES         = int(os.getenv("PDF_MAX_PAGES", "60"))
+UPLOAD_TABLE_MAX_ROWS = int(os.getenv("UPLOAD_TABLE_MAX_ROWS", "100000"))
+
+# ── Optional dependency imports ───────────────────────────────────────────────
+try:
+    import openpyxl
+    EXCEL_OK = True
+except Exception:
+    EXCEL_OK = False
+
+try:
+    import pdfplumber
+    PDF_OK = True
+except Exception:
+    PDF_OK = False
+
+try:
+    from docx import Document as _DocxDoc
+    DOCX_OK = True
+except Exception:
+    DOCX_OK = False
+
+SOURCE_TYPES = {
+    ".xlsx": "Excel", ".xls": "Excel",
+    ".pdf":  "PDF",
+    ".docx": "Word",
+    ".csv":  "CSV",
+}
+
+
+def file_source_type(filename: str) -> str:
+    return SOURCE_TYPES.get(Path(filename).suffix.lower(), "Unknown")
+
+
+# ── Text ─────────────────────────────────────────────────────────────────────
+
+def parse_excel_bytes(content: bytes, label: str, max_rows: Optional[int] = None) -> str:
+    """Read-only streaming parse: rows are pulled one at a time and reading
+    stops at the per-sheet row budget, so memory stays flat however large the
+    workbook is."""
+    if not EXCEL_OK:
+        return f"[Excel parser not available — pip install openpyxl]"
+    max_rows = EXCEL_MAX_ROWS if max_rows is None else max_rows
+    wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    parts = [f"=== {label} ==="]
+    try:
+        for ws in wb.worksheets:
+            ws.reset_dimensions()   # exporters often write a wrong <dimension>; don't trust it
+            rows = []
+            truncated = False
+            for row in ws.iter_rows(values_only=True):
+                if not any(v is not None for v in row):
+                    continue
+                if len(rows) >= max_rows:
+                    truncated = True
+                    break
+                rows.append("\t".join(str(v) if v is not None else "" for v in row))
+            if truncated:
+                rows.append(f"... (truncated at {max_rows} rows)")
+            if rows:
+                parts.append(f"--- Sheet: {ws.title} ---\n" + "\n".join(rows))
+    finally:
+        wb.close()
+    return "\n\n".join(parts)
+
+def extract_pdf_pages(content: bytes, pages: list[int]) -> dict[int, str]:
+    """Text of the given 0-based pages. Pure — runs in ingest worker processes."""
+    out = {}
+    with pdfplumber.open(io.BytesIO(content)) as pdf:
+        for i in pages:
+            out[i] = pdf.pages[i].extract_text() or ""
+    return out
+
+def parse_docx_bytes(content: bytes, label: str) -> str:
+    if not DOCX_OK:
+        return f"[Word parser not available — pip install python-docx]"
+    doc = _DocxDoc(io.BytesIO(content))
+    lines = [f"=== {label} ==="]
+    for p in doc.paragraphs:
+        if p.text.strip():
+            lines.append(p.text)
+    for table in doc.tables:
+        for row in table.rows:
+            cells = [c.text.strip() for c in row.cells if c.text.strip()]
+            if cells:
+                lines.append(" | ".join(cells))
+    return "\n".join(lines)
+
+def parse_csv_bytes(content: bytes, label: str) -> str:
+    lines = [f"=== {label} ==="]
+    reader = csv.reader(io.StringIO(content.decode("utf-8", errors="replace")))
+    for i, row in enumerate(reader):
+        if i > 1000:
+            lines.append("... (truncated at 1000 rows)")
+            break
+        lines.append("\t".join(row))
+    return "\n".join(lines)
+
+
+def parse_pdf_bytes(content: bytes, label: str) -> str:
+    """Serial extraction of up to PDF_MAX_PAGES pages (main.py has the cached,
+    page-parallel version; this one serves callers without a pool)."""
+    if not PDF_OK:
+        return f"[PDF parser not available — pip install pdfplumber]"
+    with pdfplumber.open(io.BytesIO(content)) as pdf:
+        page_count = min(len(pdf.pages), PDF_MAX_PAGES)
+    pages = extract_pdf_pages(content, list(range(page_count)))
+    parts = [f"=== {label} ==="]
+    for i in range(page_count):
+        if pages.get(i):
+            parts.append(f"--- Page {i+1} ---\n{pages[i]}")
+    return "\n\n".join(parts)
+
+
+def parse_text(filename: str, content: bytes, label: str) -> str:
+    ext = Path(filename).suffix.lower()
+    if ext in (".xlsx", ".xls"):
+        return parse_excel_bytes(content, label)
+    elif ext == ".pdf":
+        return parse_pdf_bytes(content, label)
+    elif ext == ".docx":
+        return parse_docx_bytes(content, label)
+    elif ext == ".csv":
+        return parse_csv_bytes(content, label)
+    return f"[Unsupported: {ext}]"
+
+
+def parse_artifact(filename: str, content: bytes, digest: str, text: Optional[str] = None) -> dict:
+    """Parse bytes into a cacheable artifact. `text` is for callers that
+    extracted it themselves (main.py's page-parallel PDF path)."""
+    source_type = file_source_type(filename)
+    if text is None:
+        text = parse_text(filename, content, f"Uploaded {source_type}: {filename}")
+    return {
+        "source_type": source_type,
+        "text":        text,
+        "tables":      extract_tables(filename, content) if source_type in ("Excel", "CSV") else [],
+        "size_bytes":  len(content),
+        "sha256":      digest,
+    }
+
+
+# ── Typed tables (Excel sheets / CSV → columns for local SQL) ────────────────
+NUMERIC_TEXT = re.compile(r"^\s*[-+]?\$?\s*(?:\d{1,3}(?:,\d{3})+|\d+)?(?:\.\d+)?\s*%?\s*$")
+
+
+def sql_ident(text: str, fallback: str = "col") -> str:
+    ident = re.sub(r"[^a-z0-9]+", "_", str(text).lower()).strip("_")[:60] or fallback
+    return f"t_{ident}" if ident[0].isdigit() else ident
+
+
+def cell_value(v):
+    """Spreadsheet / CSV cell → int | float | str | None."""
+    if v is None or (isinstance(v, str) and not v.strip()):
+        return None
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, (int, float)):
+        return v
+    if hasattr(v, "isoformat"):
+        return v.isoformat()
+    text = str(v).strip()
+    if NUMERIC_TEXT.match(text) and any(ch.isdigit() for ch in text):
+        num = text.replace("$", "").replace(",", "").replace("%", "").strip()
+        return float(num) if "." in num else int(num)
+    return text
+
+
+def rows_to_table(name: str, sheet: str, rows: list[list], max_rows: int) -> Optional[dict]:
+    """Header detection + per-column type inference. Returns a column-major table dict."""
+    rows = [[cell_value(v) for v in r] for r in rows]
+    rows = [r for r in rows if any(v is not None for v in r)]
+    if len(rows) < 2:
+        return None
+    # Header = first row (of the first 10) that is all text and fills at least half the width —
+    # skips the title / subtitle rows exporters put above the real table.
+    width = max(sum(v is not None for v in r) for r in rows[:10])
+    header_i = next(
+        (i for i, r in enumerate(rows[:10])
+         if sum(v is not None for v in r) >= max(2, math.ceil(width / 2))
+         and all(isinstance(v, str) for v in r if v is not None)),
+        None,
+    )
+    if header_i is None:
+        return None
+    header = rows[header_i]
+    body = rows[header_i + 1:header_i + 1 + max_rows]
+    keep = [j for j, h in enumerate(header) if h is not None]
+    names: list[str] = []
+    for j in keep:
+        base = sql_ident(header[j], f"col_{j + 1}")
+        names.append(base if base not in names else f"{base}_{j + 1}")
+
+    columns, data = [], []
+    for name_, j in zip(names, keep):
+        values = [r[j] if j < len(r) else None for r in body]
+        present = [v for v in values if v is not None]
+        if present and all(isinstance(v, int) for v in present):
+            col_type = "INTEGER"
+        elif present and all(isinstance(v, (int, float)) for v in present):
+            col_type = "REAL"
+        else:
+            col_type = "TEXT"
+            values = [None if v is None else str(v) for v in values]
+        columns.append({"name": name_, "type": col_type, "label": str(header[j])})
+        data.append(values)
+    return {"name": name, "sheet": sheet, "columns": columns, "data": data,
+            "rows": len(body), "truncated": len(rows) - header_i - 1 > max_rows}
+
+
+def extract_tables(filename: str, content: bytes, max_rows: Optional[int] = None) -> list[dict]:
+    """Typed tables from a spreadsheet / CSV upload (one per sheet). Pure — runs in ingest workers."""
+    max_rows = UPLOAD_TABLE_MAX_ROWS if max_rows is None else max_rows
+    ext = Path(filename).suffix.lower()
+    stem = sql_ident(Path(filename).stem, "upload")
+    tables = []
+    if ext == ".csv":
+        reader = csv.reader(io.StringIO(content.decode("utf-8", errors="replace")))
+        rows = [row for _, row in zip(range(max_rows + 11), reader)]
+        table = rows_to_table(stem, "", rows, max_rows)
+        if table:
+            tables.append(table)
+    elif ext in (".xlsx", ".xls") and EXCEL_OK:
+        wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                ws.reset_dimensions()
+                rows = [list(r) for _, r in zip(range(max_rows + 11), ws.iter_rows(values_only=True))]
+                table = rows_to_table(f"{stem}__{sql_ident(ws.title, 'sheet')}", ws.title, rows, max_rows)
+                if table:
+                    tables.append(table)
+        finally:
+            wb.close()
+    return tables
@@ -0,0 +1,29 @@
+"""Tests run against the embedded SQLite backend (bq_setup.sql) — no GCP, no Gemini."""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("QUERY_BACKEND", "local")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def local_bq() -> "main.LocalBQClient":
+    return main.LocalBQClient(main.BASE_DIR / "bq_setup.sql")
+
+
+@pytest.fixture
+def query(local_bq):
+    """Run BigQuery SQL on the local backend; list of row dicts."""
+    def run(sql: str, params: dict[str, str] | None = None) -> list[dict]:
+        config = main._query_job_config(params=params)
+        return local_bq.query(sql, job_config=config).result()
+    return run
+
+
+def table(name: str) -> str:
+    return f"`{main.GCP_PROJECT}.{main.BQ_DATASET}.{name}`"
@@ -0,0 +1,64 @@
+"""Follow-up planning over a retained result set (customers, from the local backend)."""
+import pytest
+
+import main
+from conftest import table
+
+COLUMNS = ["customer_id", "name", "tier", "region", "status", "arr_usd",
+           "seats_contracted", "seats_active", "health_score"]
+
+
+@pytest.fixture
+def customers(query) -> dict:
+    sql = f"SELECT {', '.join(COLUMNS)} FROM {table('customers')}"
+    rows = [tuple(r[c] for c in COLUMNS) for r in query(sql)]
+    return {"sql": sql, "columns": COLUMNS, "rows": rows, "complete": True, "total_rows": len(rows)}
+
+
+def _run(question: str, result_set: dict):
+    plan = main.plan_followup(question, [result_set])
+    return None if plan is None else main.run_followup(plan, question)
+
+
+def test_column_name_is_a_projection_not_a_filter(customers):
+    result = _run("what about active seats?", customers)
+    assert len(result["rows"]) == len(customers["rows"])
+    assert "seats_active" in result["columns"] and "seats_contracted" not in result["columns"]
+    assert not any("status" in step for step in result["applied"])
+
+
+def test_projection_keeps_real_value_filters(customers):
+    result = _run("show active seats for Enterprise", customers)
+    tier = COLUMNS.index("tier")
+    assert len(result["rows"]) == sum(r[tier] == "Enterprise" for r in customers["rows"])
+    assert "seats_active" in result["columns"]
+    assert not any("status" in step for step in result["applied"])
+
+
+def test_value_filter(customers):
+    result = _run("only active ones", customers)
+    status = COLUMNS.index("status")
+    assert len(result["rows"]) == sum(r[status] == "Active" for r in customers["rows"])
+
+
+@pytest.mark.parametrize("question, column, pick", [
+    ("which one has the highest health score?", "health_score", max),
+    ("who has the lowest health score?", "health_score", min),
+    ("which account has the most active seats?", "seats_active", max),
+])
+def test_single_row_superlative(customers, question, column, pick):
+    result = _run(question, customers)
+    i = COLUMNS.index(column)
+    assert len(result["rows"]) == 1
+    assert result["rows"][0][result["columns"].index(column)] == pick(r[i] for r in customers["rows"] if r[i] is not None)
+
+
+def test_top_n(customers):
+    result = _run("top 3 by health score", customers)
+    i = COLUMNS.index("health_score")
+    assert [r[result["columns"].index("health_score")] for r in result["rows"]] == \
+        sorted((r[i] for r in customers["rows"] if r[i] is not None), reverse=True)[:3]
+
+
+def test_unclear_question_falls_back_to_sql(customers):
+    assert main.plan_followup("which customers have the highest ARR?", [customers]) is None
@@ -0,0 +1,77 @@
+"""Dialect shim and semantic-layer templates, executed on the local backend."""
+import pytest
+
+import main
+from conftest import table
+
+
+@pytest.mark.parametrize("expr, expected", [
+    ("DATE_ADD(DATE '2024-01-31', INTERVAL 1 MONTH)", "2024-02-29"),
+    ("DATE_ADD(DATE '2023-01-31', INTERVAL 1 MONTH)", "2023-02-28"),
+    ("DATE_SUB(DATE '2024-03-31', INTERVAL 1 MONTH)", "2024-02-29"),
+    ("DATE_ADD(DATE '2024-08-31', INTERVAL 1 QUARTER)", "2024-11-30"),
+    ("DATE_ADD(DATE '2024-02-29', INTERVAL 1 YEAR)", "2025-02-28"),
+    ("DATE_SUB(DATE '2024-12-31', INTERVAL 10 MONTH)", "2024-02-29"),
+    ("DATE_ADD(DATE '2024-02-28', INTERVAL 2 DAY)", "2024-03-01"),
+])
+def test_date_shift_clamps_to_month_end(query, expr, expected):
+    assert query(f"SELECT {expr} AS d") == [{"d": expected}]
+
+
+def test_date_parts_are_quoted_inside_date_functions(query):
+    rows = query("SELECT DATE_DIFF(DATE '2024-10-31', DATE '2024-01-31', MONTH) AS m, "
+                 "DATE_TRUNC(DATE '2024-05-17', quarter) AS q")
+    assert rows == [{"m": 9, "q": "2024-04-01"}]
+
+
+def test_window_order_by_month_column_is_left_alone(query):
+    sql = (
+        "SELECT customer_id, month, active_users, "
+        "LAG(active_users) OVER (PARTITION BY customer_id ORDER BY customer_id, month) AS prev "
+        f"FROM {table('usage_metrics')} WHERE customer_id = 'C001' ORDER BY month"
+    )
+    assert "'MONTH'" not in main.bq_to_sqlite(sql)
+    rows = query(sql)
+    assert [r["month"] for r in rows] == sorted(r["month"] for r in rows)
+    assert rows[0]["prev"] is None
+    assert all(b["prev"] == a["active_users"] for a, b in zip(rows, rows[1:]))
+
+
+def test_string_literals_pass_through(query):
+    assert query("SELECT 'DATE_DIFF(a, b, month)' AS s") == [{"s": "DATE_DIFF(a, b, month)"}]
+
+
+def _match(question: str):
+    return main._semantic.match(question, main._fast_router._entity_words(question))
+
+
+@pytest.mark.parametrize("question", [
+    "How many support tickets were resolved?",
+    "How many closed tickets do we have?",
+    "What is the average resolution time for P1 tickets?",
+    "How many customers have open tickets?",
+    "What is our average ARR?",
+    "What is the per-seat price for Mid-Market customers?",
+])
+def test_metric_templates_decline(question):
+    assert _match(question) is None
+    assert not main._semantic.can_compile("open_tickets", question, main._fast_router._entity_words(question))
+
+
+def test_escalated_tickets_compile_to_escalated_only(query):
+    question = "How many support tickets were escalated?"
+    assert _match(question) == "open_tickets"
+    sql, params = main._semantic.compile("open_tickets", question)
+    (row,) = query(sql, params)
+    expected = query(f"SELECT COUNT(*) AS n FROM {table('support_tickets')} WHERE status = 'Escalated'")
+    assert row["open_tickets"] == expected[0]["n"]
+
+
+def test_open_tickets_count_open_and_escalated(query):
+    question = "How many open support tickets do we have?"
+    assert _match(question) == "open_tickets"
+    sql, params = main._semantic.compile("open_tickets", question)
+    (row,) = query(sql, params)
+    expected = query(f"SELECT COUNT(*) AS n FROM {table('support_tickets')} "
+                     "WHERE status IN ('Open', 'Escalated')")
+    assert row["open_tickets"] == expected[0]["n"]